@@ -0,0 +1,111 @@
+"""
+Expiry Benchmark
+
+Compares reactor loop latency with one deferLater per cached entry (how
+ResolverCache used to expire entries) against the timing wheel it uses now.
+
+Usage:
+
+    $ bin/python benchmarks/expiry.py [size ...]
+
+Sizes default to 10k, 100k and 1M entries.
+"""
+
+from twisted.internet import reactor, task, defer
+
+from awsdns.cache import ResolverCache
+
+import sys
+import time
+
+SIZES = [10000, 100000, 1000000]
+
+# number of trips through the reactor to time
+HOPS = 5000
+
+TTL = 3600
+
+def hop_latency():
+    """
+    Bounce a call through the reactor HOPS times, and fire with the average
+    time each trip took, in microseconds.
+    """
+    d = defer.Deferred()
+    state = {'count': 0, 'start': time.time()}
+    
+    def hop():
+        state['count'] += 1
+        if state['count'] >= HOPS:
+            d.callback((time.time() - state['start']) / HOPS * 1000000)
+        else:
+            reactor.callLater(0, hop)
+    
+    reactor.callLater(0, hop)
+    
+    return d
+
+def fill_deferlater(size):
+    """
+    The old behavior - one reactor call per entry.
+    """
+    cache = {}
+    timers = []
+    
+    def remove(name):
+        cache.pop(name, None)
+    
+    for i in xrange(size):
+        name = ("host%s" % (i,), 1, 1)
+        cache[name] = ([], [], [])
+        # spread expiry times out, like real traffic
+        timer = task.deferLater(reactor, TTL + (i % 600), remove, name)
+        timer.addErrback(lambda failure: failure.trap(defer.CancelledError))
+        timers.append(timer)
+    
+    def cleanup():
+        for timer in timers:
+            timer.cancel()
+    
+    return cleanup
+
+def fill_wheel(size):
+    """
+    The timing wheel.
+    """
+    cache = ResolverCache(lambda key: None)
+    
+    for i in xrange(size):
+        name = ("host%s" % (i,), 1, 1)
+        cache.cache((name, ([], [], []), TTL + (i % 600)))
+    
+    def cleanup():
+        cache._sweeper.stop()
+    
+    return cleanup
+
+@defer.inlineCallbacks
+def run(sizes):
+    baseline = yield hop_latency()
+    print "%-12s %10s %16s %14s" % ("method", "entries", "delayed calls", "hop (usec)")
+    print "%-12s %10s %16s %14.2f" % ("empty", 0, len(reactor.getDelayedCalls()), baseline)
+    
+    for size in sizes:
+        for method, fill in (("deferLater", fill_deferlater), ("wheel", fill_wheel)):
+            cleanup = fill(size)
+            
+            calls = len(reactor.getDelayedCalls())
+            latency = yield hop_latency()
+            
+            print "%-12s %10s %16s %14.2f" % (method, size, calls, latency)
+            
+            cleanup()
+            # let the reactor clear out cancelled calls
+            yield hop_latency()
+    
+    reactor.stop()
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    
+    reactor.callWhenRunning(run, sizes)
+    reactor.run()
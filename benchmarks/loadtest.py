@@ -0,0 +1,395 @@
+"""
+Load Test
+
+Runs awsdns against a local fake EC2 (see awsdns.fakeec2) serving a
+synthetic inventory, replays a mix of queries at a target rate, and reports
+throughput, latency percentiles and how much the server's memory grew. No
+AWS account is needed.
+
+Usage:
+
+    $ bin/python benchmarks/loadtest.py [--instances N] [--latency SECONDS]
+        [--rate QPS] [--duration SECONDS] [--tcp] [--option KEY=VALUE ...]
+        [mix ...]
+
+Mixes:
+
+    hit - mostly the same few hundred names, so mostly cache hits
+    miss - mostly names that don't exist
+    ptr - mostly reverse lookups
+    scan - every name in turn, once each, so a cold cache throughout
+
+All four are run by default. Each mix gets a fresh server, in its own
+process, so the load generator doesn't compete with it for the reactor.
+Instances are named host0.loadtest, host1.loadtest, etc, with addresses
+from 10.0.0.1 up. --option sets any other awsdns option for the server,
+e.g. --option inventory=true --option wire_cache=true.
+"""
+
+from twisted.internet import reactor, protocol, defer, task
+from twisted.names import dns
+from twisted.web import server as web_server
+
+import argparse
+import ConfigParser
+import os
+import random
+import StringIO
+import struct
+import sys
+
+DOMAIN = "loadtest"
+
+MIXES = ['hit', 'miss', 'ptr', 'scan']
+
+# seconds to wait for answers after the last query is sent
+GRACE = 2
+
+# queries sent at once, over TCP
+TCP_CONNECTIONS = 4
+
+def address(i):
+    """
+    The private address of synthetic instance i (see fakeec2.synthetic).
+    """
+    i += 1
+    return "10.%s.%s.%s" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+def reverse_name(ip):
+    parts = ip.split(".")
+    parts.reverse()
+    return "%s.in-addr.arpa" % (".".join(parts),)
+
+def mix(name, instances, seed=0):
+    """
+    Return a function that returns the next (name, type) to query, for the
+    given mix.
+    """
+    rng = random.Random(seed)
+    hot = min(200, instances)
+    counter = [0]
+    
+    def existing():
+        return ("host%s.%s" % (rng.randrange(instances), DOMAIN), dns.A)
+    
+    def hit():
+        if rng.random() < 0.95:
+            return ("host%s.%s" % (rng.randrange(hot), DOMAIN), dns.A)
+        return existing()
+    
+    def miss():
+        if rng.random() < 0.9:
+            return ("missing%s.%s" % (rng.randrange(10 ** 9), DOMAIN), dns.A)
+        return existing()
+    
+    def ptr():
+        if rng.random() < 0.8:
+            return (reverse_name(address(rng.randrange(instances))), dns.PTR)
+        return existing()
+    
+    def scan():
+        counter[0] += 1
+        return ("host%s.%s" % (counter[0] % instances, DOMAIN), dns.A)
+    
+    return {'hit': hit, 'miss': miss, 'ptr': ptr, 'scan': scan}[name]
+
+def rss(pid):
+    """
+    Resident memory of process pid, in MB, or None if it can't be read
+    (/proc is Linux only).
+    """
+    try:
+        with open("/proc/%s/status" % (pid,)) as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        return None
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def serve(args):
+    """
+    The server process - a fake EC2, and awsdns in front of it.
+    """
+    from awsdns import fakeec2, make_server
+    from awsdns.resolver import EC2Resolver
+    
+    instances = fakeec2.synthetic(args.instances, DOMAIN)
+    ec2 = reactor.listenTCP(0, web_server.Site(fakeec2.FakeEC2(instances, args.latency)), interface="127.0.0.1")
+    
+    config = ConfigParser.ConfigParser()
+    config.readfp(StringIO.StringIO("\n".join([
+        "[awsdns]",
+        "dns_server = 127.0.0.1",
+        "aws_access_key_id = loadtest",
+        "aws_secret_access_key = loadtest",
+        "aws_region = us-east-1",
+        "ec2_client = async",
+        "ec2_endpoint = http://127.0.0.1:%s/" % (ec2.getHost().port,),
+        # everything goes to EC2 - there's no upstream
+        "zones = %s" % (DOMAIN,),
+        "networks = 10.0.0.0/8",
+        "api_rate = 1000",
+        "api_burst = 1000",
+    ] + [option.replace("=", " = ", 1) for option in args.option])))
+    
+    resolver = EC2Resolver(config, servers=[("127.0.0.1", 53)])
+    f, p = make_server(resolver)
+    
+    udp = reactor.listenUDP(0, p, interface="127.0.0.1")
+    reactor.listenTCP(udp.getHost().port, f, interface="127.0.0.1")
+    
+    def ready():
+        resolver.start()
+        sys.stdout.write("READY %s\n" % (udp.getHost().port,))
+        sys.stdout.flush()
+    
+    reactor.callWhenRunning(ready)
+    reactor.run()
+
+class ServerProcess(protocol.ProcessProtocol):
+    """
+    Starts the server, and fires ready with its port once it's listening.
+    """
+    
+    def __init__(self):
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+        self.buffer = ""
+    
+    def outReceived(self, data):
+        self.buffer += data
+        if self.ready is not None and "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            d, self.ready = self.ready, None
+            d.callback(int(line.split()[1]))
+    
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+class Stats(object):
+    """
+    Send times of outstanding queries, and latencies of answered ones.
+    """
+    
+    def __init__(self):
+        self.outstanding = {}
+        self.latencies = []
+        self.sent = 0
+        self.errors = 0
+    
+    def sent_query(self, key):
+        self.sent += 1
+        self.outstanding[key] = reactor.seconds()
+    
+    def answered(self, key, data):
+        started = self.outstanding.pop(key, None)
+        if started is None:
+            return
+        
+        self.latencies.append(reactor.seconds() - started)
+        
+        # SERVFAIL and friends - NXDOMAIN and empty answers are fine
+        if ord(data[3]) & 0x0f not in (dns.OK, dns.ENAME):
+            self.errors += 1
+
+class Encoder(object):
+    """
+    Encodes queries, minus the message id.
+    """
+    
+    def __init__(self):
+        self._encoded = {}
+    
+    def encode(self, name, type):
+        try:
+            return self._encoded[(name, type)]
+        except KeyError:
+            pass
+        
+        m = dns.Message(recDes=1)
+        m.queries = [dns.Query(name, type, dns.IN)]
+        data = m.toStr()[2:]
+        
+        # don't keep every one-off name (e.g. the miss mix)
+        if len(self._encoded) < 100000:
+            self._encoded[(name, type)] = data
+        
+        return data
+
+class UDPClient(protocol.DatagramProtocol):
+    def __init__(self, port, stats):
+        self.port = port
+        self.stats = stats
+        self.id = 0
+    
+    def send(self, data):
+        self.id = (self.id + 1) & 0xffff
+        self.stats.sent_query(self.id)
+        self.transport.write(struct.pack("!H", self.id) + data, ("127.0.0.1", self.port))
+    
+    def datagramReceived(self, data, addr):
+        self.stats.answered(struct.unpack("!H", data[:2])[0], data)
+
+class TCPClient(protocol.Protocol):
+    def __init__(self, stats, number):
+        self.stats = stats
+        self.number = number
+        self.id = 0
+        self.buffer = ""
+    
+    def send(self, data):
+        self.id = (self.id + 1) & 0xffff
+        self.stats.sent_query((self.number, self.id))
+        message = struct.pack("!H", self.id) + data
+        self.transport.write(struct.pack("!H", len(message)) + message)
+    
+    def dataReceived(self, data):
+        self.buffer += data
+        
+        while len(self.buffer) >= 2:
+            length = struct.unpack("!H", self.buffer[:2])[0]
+            if len(self.buffer) < 2 + length:
+                break
+            
+            message, self.buffer = self.buffer[2:2 + length], self.buffer[2 + length:]
+            self.stats.answered((self.number, struct.unpack("!H", message[:2])[0]), message)
+
+@defer.inlineCallbacks
+def connect(port, stats, tcp):
+    """
+    Return a list of clients to send queries through.
+    """
+    if not tcp:
+        client = UDPClient(port, stats)
+        reactor.listenUDP(0, client, interface="127.0.0.1")
+        defer.returnValue([client])
+    
+    clients = []
+    for number in range(TCP_CONNECTIONS):
+        client = yield protocol.ClientCreator(reactor, TCPClient, stats, number).connectTCP("127.0.0.1", port)
+        clients.append(client)
+    
+    defer.returnValue(clients)
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+@defer.inlineCallbacks
+def run_mix(name, args):
+    """
+    Start a server, send it queries from mix name for args.duration seconds,
+    and return a dictionary of results.
+    """
+    server = ServerProcess()
+    command = [sys.executable, os.path.abspath(__file__), "serve",
+               "--instances", str(args.instances), "--latency", str(args.latency)]
+    for option in args.option:
+        command.extend(["--option", option])
+    
+    process = reactor.spawnProcess(server, sys.executable, command, env=os.environ, childFDs={0: "w", 1: "r", 2: 2})
+    port = yield server.ready
+    # let the server settle (e.g. the inventory's first sweep)
+    yield sleep(1)
+    
+    stats = Stats()
+    clients = yield connect(port, stats, args.tcp)
+    queries = mix(name, args.instances)
+    encoder = Encoder()
+    
+    rss_start = rss(process.pid)
+    started = reactor.seconds()
+    state = {'next': 0}
+    
+    def tick():
+        # send whatever's due to keep up the target rate
+        due = int((reactor.seconds() - started) * args.rate) - stats.sent
+        for i in xrange(max(0, due)):
+            query_name, type = queries()
+            clients[state['next'] % len(clients)].send(encoder.encode(query_name, type))
+            state['next'] += 1
+    
+    loop = task.LoopingCall(tick)
+    loop.start(0.005)
+    yield sleep(args.duration)
+    loop.stop()
+    elapsed = reactor.seconds() - started
+    
+    yield sleep(GRACE)
+    rss_end = rss(process.pid)
+    
+    process.signalProcess("TERM")
+    yield server.ended
+    
+    latencies = sorted(stats.latencies)
+    
+    defer.returnValue({
+        'mix': name,
+        'protocol': args.tcp and "tcp" or "udp",
+        'sent': stats.sent,
+        'answered': len(latencies),
+        'lost': len(stats.outstanding),
+        'errors': stats.errors,
+        'qps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+        'rss_start': rss_start,
+        'rss_end': rss_end,
+    })
+
+def ms(value):
+    if value is None:
+        return "-"
+    return "%.2f" % (value * 1000,)
+
+def mb(value):
+    if value is None:
+        return "-"
+    return "%.1f" % (value,)
+
+@defer.inlineCallbacks
+def run(args):
+    print "%d instances, EC2 latency %ss, %s queries/s for %ss" % (args.instances, args.latency, args.rate, args.duration)
+    print "%-6s %-5s %8s %8s %6s %6s %9s %9s %9s %9s %13s" % (
+        "mix", "proto", "sent", "answered", "lost", "errors", "qps", "p50 (ms)", "p99 (ms)", "p999 (ms)", "rss (MB)")
+    
+    try:
+        for name in args.mix or MIXES:
+            result = yield run_mix(name, args)
+            print "%-6s %-5s %8d %8d %6d %6d %9.1f %9s %9s %9s %13s" % (
+                result['mix'], result['protocol'], result['sent'], result['answered'], result['lost'],
+                result['errors'], result['qps'], ms(result['p50']), ms(result['p99']), ms(result['p999']),
+                "%s -> %s" % (mb(result['rss_start']), mb(result['rss_end'])))
+    finally:
+        reactor.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test awsdns against a fake EC2.")
+    parser.add_argument("mix", nargs="*", help="query mixes to run: %s (default: all)" % (", ".join(MIXES),))
+    parser.add_argument("--instances", type=int, default=10000, help="number of synthetic instances")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake EC2 takes to answer")
+    parser.add_argument("--rate", type=int, default=1000, help="queries per second to send")
+    parser.add_argument("--duration", type=int, default=10, help="seconds to send queries for")
+    parser.add_argument("--tcp", action="store_true", help="send queries over TCP instead of UDP")
+    parser.add_argument("--option", action="append", default=[], metavar="KEY=VALUE",
+        help="set an awsdns option for the server")
+    
+    if sys.argv[1:2] == ["serve"]:
+        serve(parser.parse_args(sys.argv[2:]))
+        return
+    
+    args = parser.parse_args()
+    for name in args.mix:
+        if name not in MIXES:
+            parser.error("unknown mix: %s" % (name,))
+    
+    reactor.callWhenRunning(run, args)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
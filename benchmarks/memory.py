@@ -0,0 +1,147 @@
+"""
+Memory Benchmark
+
+Fills a ResolverCache with the answers awsdns would give for a fleet of
+instances - an A entry and a PTR entry per instance, optionally with TXT
+extras in the additional section (see extra_additional) - plus negative
+entries, and reports how much memory it takes with and without
+compact messages (see awsdns.compact). Also reports how long a cache hit
+takes, since compact messages are turned back into Twisted records on every
+hit.
+
+Usage:
+
+    $ bin/python benchmarks/memory.py [--names N] [--negative N] [--extra N]
+
+Defaults to 100k names, 10k negative entries and no extras. Each
+mode is measured in its own process, so they don't share memory.
+"""
+
+from twisted.internet import task
+from twisted.names import dns
+
+import argparse
+import gc
+import json
+import subprocess
+import sys
+import time
+
+from awsdns.cache import ResolverCache
+from awsdns import compact
+
+MODES = ['plain', 'compact']
+
+TTL = 3600
+
+# number of cache hits to time
+HITS = 20000
+
+def rss():
+    """
+    Resident memory of this process, in bytes.
+    """
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+
+def address(i):
+    i += 1
+    return "10.%s.%s.%s" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+def reverse_name(ip):
+    parts = ip.split(".")
+    parts.reverse()
+    return "%s.in-addr.arpa" % (".".join(parts),)
+
+def message(name, record, extras):
+    """
+    Build a message the way EC2Resolver.create_message() does.
+    """
+    answers = [dns.RRHeader(name, type=record.TYPE, payload=record, ttl=TTL)]
+    additional = [
+        dns.RRHeader(name, type=dns.TXT, payload=dns.Record_TXT(extra), ttl=TTL)
+        for extra in extras
+    ]
+    return (answers, [], additional)
+
+def fill(cache, args):
+    for i in xrange(args.names):
+        name = "host%s.fleet" % (i,)
+        ip = address(i)
+        extras = [
+            "tag:Role = role%s" % (i % 50,),
+            "placement = us-east-1%s" % ("abcd"[i % 4],),
+            "tag:Owner = team%s" % (i % 20,),
+        ][:args.extra]
+        
+        cache.cache(((name, dns.IN, dns.A), message(name, dns.Record_A(ip), extras), TTL))
+        cache.cache(((reverse_name(ip), dns.IN, dns.PTR), message(reverse_name(ip), dns.Record_PTR(name), extras), TTL))
+    
+    for i in xrange(args.negative):
+        name = "missing%s.fleet" % (i,)
+        cache.cache(((name, dns.IN, dns.A), ([], [], []), TTL))
+
+def measure(mode, args):
+    """
+    Fill a cache, and return a dictionary with how much memory it took and
+    how long a hit takes, in microseconds.
+    """
+    kwargs = {}
+    if mode == 'compact':
+        kwargs = {'pack': compact.pack, 'unpack': compact.unpack}
+    
+    cache = ResolverCache(None, clock=task.Clock(), negative_ttl=TTL, negative_size=args.negative, **kwargs)
+    
+    gc.collect()
+    before = rss()
+    
+    fill(cache, args)
+    
+    gc.collect()
+    after = rss()
+    
+    keys = ["host%s.fleet" % (i % args.names,) for i in xrange(HITS)]
+    start = time.time()
+    for name in keys:
+        cache.__getdeferred__((name, dns.IN, dns.A))
+    hit = (time.time() - start) / HITS * 1000000
+    
+    stats = cache.stats()
+    
+    return {
+        'mode': mode,
+        'entries': stats['entries'],
+        'negative_entries': stats['negative_entries'],
+        'bytes': after - before,
+        'hit': hit,
+    }
+
+def run(args):
+    print "%-8s %10s %10s %10s %14s %10s" % ("mode", "entries", "negative", "MB", "bytes/entry", "hit (us)")
+    
+    for mode in MODES:
+        command = [sys.executable, __file__, "measure", mode,
+                   "--names", str(args.names), "--negative", str(args.negative), "--extra", str(args.extra)]
+        result = json.loads(subprocess.check_output(command))
+        
+        entries = result['entries'] + result['negative_entries']
+        print "%-8s %10s %10s %10.1f %14.0f %10.1f" % (
+            mode, result['entries'], result['negative_entries'],
+            result['bytes'] / 1024.0 / 1024.0, float(result['bytes']) / max(entries, 1), result['hit'])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory used by cached answers.")
+    parser.add_argument("--names", type=int, default=100000, help="number of instances")
+    parser.add_argument("--negative", type=int, default=10000, help="number of negative entries")
+    parser.add_argument("--extra", type=int, default=0, choices=[0, 1, 2, 3], help="TXT extras per name")
+    
+    if sys.argv[1:2] == ["measure"]:
+        mode = sys.argv[2]
+        print json.dumps(measure(mode, parser.parse_args(sys.argv[3:])))
+    else:
+        run(parser.parse_args())
+
+if __name__ == '__main__':
+    main()
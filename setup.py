@@ -11,7 +11,8 @@ setup(
     ],
     entry_points = {
         'console_scripts': [
-            'awsdns = awsdns:main'
+            'awsdns = awsdns:main',
+            'awsdns-fakeec2 = awsdns.fakeec2:main',
         ],
     },
 )
@@ -4,12 +4,18 @@ AWSDNS - DNS for EC2 instances in Amazon Web Services
 Main module - entry points
 """
 import os, sys
+import argparse
 import ConfigParser
 
 from twisted.internet import reactor
-from twisted.names import server, dns
+from twisted.names import dns
 
 from resolver import EC2Resolver
+from wire import WireCache, CachingDNSDatagramProtocol, wire_key
+from workers import Supervisor, listen_reuseport
+from reverse import AuthoritativeServerFactory
+import metrics
+import admin
 
 import logging
 from twisted.python import log
@@ -17,22 +23,85 @@ from tx_logging.observers import LevelFileLogObserver
 
 import util
 
+def make_server(resolver):
+    """
+    Return the DNS server factory (for TCP) and protocol (for UDP) that 
+    answer queries with resolver.
+    """
+    f = AuthoritativeServerFactory(clients=[resolver])
+    
+    if resolver.wire_cache:
+        wire_cache = WireCache(resolver.wire_cache_size, resolver.negative_ttl)
+        p = CachingDNSDatagramProtocol(f, wire_cache)
+        
+        resolver.metrics.callback(
+            "awsdns_wire_cache_requests_total", "Wire cache requests, by outcome.", "counter",
+            lambda: {("hit",): wire_cache.hits, ("miss",): wire_cache.misses},
+            ("result",)
+        )
+        
+        # entries invalidated through the admin API shouldn't live on here,
+        # under any of the names that share them
+        def invalidated((name, cls, type)):
+            for variant in resolver.canonicalizer.variants(name):
+                wire_cache.remove(wire_key(variant, type, cls))
+        
+        resolver.cache.listeners.append(invalidated)
+    else:
+        p = dns.DNSDatagramProtocol(f)
+    
+    return f, p
+
 def main():
+    parser = argparse.ArgumentParser(description="DNS for EC2 instances.")
+    parser.add_argument("--workers", type=int, default=0,
+        help="answer queries in this many worker processes, sharing port 53")
+    # set for the worker processes themselves, to their number
+    parser.add_argument("--worker", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
     config = ConfigParser.ConfigParser()
     
     config.read(["/etc/awsdns.ini", os.path.abspath("./awsdns.ini"), os.path.expanduser("~/awsnds.ini")])
     
-    # TODO: what happens if we use more than one DNS server?
     resolver = EC2Resolver(
         config,
-        servers=[(config.get('awsdns', 'dns_server'), 53)]
+        servers=util.parse_servers(config.get('awsdns', 'dns_server')),
+        worker=args.worker is not None
     )
     
-    f = server.DNSServerFactory(clients=[resolver])
-    p = dns.DNSDatagramProtocol(f)
+    if args.workers and (resolver.inventory is None or resolver.snapshot is None):
+        parser.error("--workers needs the inventory and snapshot options set")
+    
+    reactor.callWhenRunning(resolver.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', resolver.stop)
+    
+    if args.workers:
+        # this process just keeps the snapshot up to date for the workers
+        supervisor = Supervisor(args.workers)
+        reactor.callWhenRunning(supervisor.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', supervisor.stop)
+    else:
+        f, p = make_server(resolver)
+        
+        if args.worker is not None:
+            listen_reuseport(53, p, f)
+        else:
+            reactor.listenUDP(53, p)
+            reactor.listenTCP(53, f)
+    
+    if resolver.metrics_port:
+        port = resolver.metrics_port
+        if args.worker is not None:
+            # each worker gets its own port, after the main process's
+            port += 1 + args.worker
+        metrics.listen(port, resolver.metrics, resolver.metrics_interface)
     
-    reactor.listenUDP(53, p)
-    reactor.listenTCP(53, f)
+    if resolver.admin_port:
+        port = resolver.admin_port
+        if args.worker is not None:
+            port += 1 + args.worker
+        admin.listen(port, admin.CacheManager(resolver), resolver.admin_token, resolver.admin_interface)
     
     try:
         loglevel = util.logging_constant(config.get('awsdns', 'loglevel'))
@@ -0,0 +1,313 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Admin - a small HTTP/JSON API for managing the resolver cache: listing
+entries, invalidating and refreshing them, and pre-warming names. Meant for
+local use (e.g. from a deploy pipeline), so long TTLs can be used safely.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.names import dns
+from twisted.web import resource, server
+
+import hmac
+import json
+
+import tx_logging
+
+from awsdns.routing import ROUTE_UPSTREAM
+
+def record_type(name, type=None):
+    """
+    The record type to use for name - type (a name like 'A', or a number)
+    if given, otherwise PTR for in-addr.arpa names and A for everything else.
+    """
+    if type is None:
+        if str(name).lower().rstrip('.').endswith('.in-addr.arpa'):
+            return dns.PTR
+        return dns.A
+    
+    if isinstance(type, basestring):
+        try:
+            return dns.REV_TYPES[type.upper()]
+        except KeyError:
+            raise ValueError, "Unknown record type: '%s'" % (type,)
+    
+    return int(type)
+
+def record_value(record):
+    """
+    The value of an A, PTR or TXT record, as a string.
+    """
+    if record.type == dns.A:
+        return str(record.payload.dottedQuad())
+    elif record.type == dns.PTR:
+        return str(record.payload.name)
+    
+    return " ".join([str(data) for data in record.payload.data])
+
+class CacheManager(object):
+    """
+    Lists and changes the entries in an EC2Resolver's cache.
+    
+    Entries are picked by name (case-insensitive, and any form of the name
+    that has the same canonical name - see routing.Canonicalizer) or name
+    prefix, and optionally record type. Entries are removed or refreshed in the
+    resolver cache, and dropped from the wire cache, if there is one (see
+    awsdns.wire).
+    """
+    
+    resolver = None
+    log = None
+    
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.log = tx_logging.getLogger("awsdns:admin")
+    
+    @property
+    def cache(self):
+        return self.resolver.cache
+    
+    def select(self, names=(), prefix=None, type=None):
+        """
+        Return the keys of the cache entries named in names, or starting
+        with prefix - of the given record type, if there is one.
+        """
+        canonical = self.resolver.canonicalizer.canonical
+        names = set([canonical(name).lower() for name in names])
+        if prefix is not None:
+            prefix = str(prefix).lower()
+        if type is not None:
+            type = record_type(None, type)
+        
+        output = []
+        
+        for key in self.cache.keys():
+            name, cls, key_type = key
+            name = str(name).lower()
+            
+            if type is not None and key_type != type:
+                continue
+            
+            if name in names or (prefix is not None and name.startswith(prefix)):
+                output.append(key)
+        
+        return output
+    
+    def list(self, prefix=None):
+        """
+        Return a list of dictionaries describing each entry (see
+        ResolverCache.details()), sorted by name.
+        """
+        output = []
+        
+        for entry in self.cache.details():
+            name, cls, type = entry['key']
+            
+            if prefix is not None and not str(name).lower().startswith(str(prefix).lower()):
+                continue
+            
+            answers, authority, additional = entry['message']
+            
+            output.append({
+                'name': str(name),
+                'type': dns.QUERY_TYPES.get(type, type),
+                'age': round(entry['age'], 3),
+                'ttl': round(entry['ttl'], 3),
+                'negative': entry['negative'],
+                'stale': entry['ttl'] <= 0,
+                'answers': [record_value(record) for record in answers if record.type in (dns.A, dns.PTR, dns.TXT)],
+            })
+        
+        output.sort(key=lambda entry: (entry['name'], entry['type']))
+        
+        return output
+    
+    def invalidate(self, names=(), prefix=None, type=None):
+        """
+        Drop the selected entries (see select()). Returns the number dropped.
+        """
+        keys = self.select(names, prefix, type)
+        removed = len([key for key in keys if self.cache.remove(key)])
+        
+        self.log.info("Invalidated %s entries" % (removed,))
+        
+        return removed
+    
+    def refresh(self, names=(), prefix=None, type=None):
+        """
+        Look the selected entries up again now (see select()). Returns a
+        deferred that fires with the number refreshed and the number that
+        failed, once they're all done.
+        """
+        keys = self.select(names, prefix, type)
+        
+        # EC2 needs names in the case they were given (see
+        # EC2Resolver._lookup_wrapper()) - entries picked by prefix go by the
+        # case their instances were last found under
+        canonical = self.resolver.canonicalizer.canonical
+        given = dict([(canonical(name).lower(), name) for name in names])
+        
+        return self._gather(
+            [self.cache.refresh(key, given.get(str(key[0]).lower())) for key in keys],
+            "Refreshed"
+        )
+    
+    def prewarm(self, names, type=None):
+        """
+        Look up names that aren't cached yet, so the first query for each
+        one is a hit. Names that only the upstream DNS servers answer (see
+        awsdns.routing) are skipped. Returns a deferred that fires with the
+        number looked up and the number that failed.
+        """
+        lookups = []
+        
+        for given in names:
+            name = self.resolver.canonicalizer.canonical(given)
+            
+            if self.resolver.router.route(name) == ROUTE_UPSTREAM:
+                self.log.debug("Not pre-warming %s - it's not in an EC2 zone" % (name,))
+                continue
+            
+            lookups.append(self.cache.get((name, dns.IN, record_type(name, type)), given))
+        
+        return self._gather(lookups, "Pre-warmed")
+    
+    def sweep(self):
+        """
+        Refresh the inventory now, if there is one, instead of waiting for
+        its next sweep. Returns a deferred.
+        """
+        if self.resolver.static is not None:
+            self.resolver.static.reload()
+            return defer.succeed(True)
+        
+        if self.resolver.inventory is None or self.resolver.worker:
+            return defer.succeed(False)
+        
+        return self.resolver.inventory.sweep().addCallback(lambda _: True)
+    
+    def _gather(self, deferreds, action):
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        
+        def done(results):
+            succeeded = len([ok for ok, result in results if ok])
+            failed = len(results) - succeeded
+            
+            self.log.info("%s %s entries (%s failed)" % (action, succeeded, failed))
+            
+            return (succeeded, failed)
+        
+        return d.addCallback(done)
+
+class AdminResource(resource.Resource):
+    """
+    twisted.web resource for a CacheManager. Every request needs an
+    Authorization header with the token: "Authorization: Bearer <token>".
+    
+    GET /cache[?prefix=...] - list entries.
+    POST /cache/invalidate - drop entries.
+    POST /cache/refresh - look entries up again.
+    POST /cache/prewarm - look up names that aren't cached yet.
+    POST /inventory/sweep - refresh the inventory.
+    
+    POST bodies are JSON objects, with any of "names" (a list), "prefix" and
+    "type" - e.g. {"names": ["web1", "web2"], "type": "A"}. Responses are
+    JSON.
+    """
+    
+    isLeaf = True
+    
+    manager = None
+    token = None
+    
+    def __init__(self, manager, token):
+        resource.Resource.__init__(self)
+        self.manager = manager
+        self.token = token
+    
+    def authorized(self, request):
+        header = request.getHeader("Authorization") or ""
+        scheme, _, token = header.partition(" ")
+        
+        if scheme.lower() != "bearer":
+            return False
+        
+        return hmac.compare_digest(token.strip(), self.token)
+    
+    def respond(self, request, code, body):
+        request.setResponseCode(code)
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(body) + "\n"
+    
+    def body(self, request):
+        data = request.content.read()
+        if not data.strip():
+            return {}
+        
+        body = json.loads(data)
+        if not isinstance(body, dict):
+            raise ValueError, "Expected a JSON object"
+        
+        return body
+    
+    def render_GET(self, request):
+        if not self.authorized(request):
+            return self.respond(request, 401, {'error': "unauthorized"})
+        
+        if request.path.rstrip("/") != "/cache":
+            return self.respond(request, 404, {'error': "not found"})
+        
+        prefix = request.args.get('prefix', [None])[0]
+        
+        return self.respond(request, 200, {'entries': self.manager.list(prefix)})
+    
+    def render_POST(self, request):
+        if not self.authorized(request):
+            return self.respond(request, 401, {'error': "unauthorized"})
+        
+        path = request.path.rstrip("/")
+        
+        try:
+            body = self.body(request)
+            names = body.get('names', [])
+            prefix = body.get('prefix')
+            type = body.get('type')
+            
+            if path == "/cache/invalidate":
+                if not names and prefix is None:
+                    raise ValueError, "Give names or a prefix"
+                return self.respond(request, 200, {'invalidated': self.manager.invalidate(names, prefix, type)})
+            elif path == "/cache/refresh":
+                if not names and prefix is None:
+                    raise ValueError, "Give names or a prefix"
+                d = self.manager.refresh(names, prefix, type)
+                d.addCallback(lambda (refreshed, failed): {'refreshed': refreshed, 'failed': failed})
+            elif path == "/cache/prewarm":
+                d = self.manager.prewarm(names, type)
+                d.addCallback(lambda (warmed, failed): {'warmed': warmed, 'failed': failed})
+            elif path == "/inventory/sweep":
+                d = self.manager.sweep()
+                d.addCallback(lambda swept: {'swept': swept})
+            else:
+                return self.respond(request, 404, {'error': "not found"})
+        except (ValueError, AttributeError, TypeError), e:
+            return self.respond(request, 400, {'error': str(e)})
+        
+        def done(body):
+            request.write(self.respond(request, 200, body))
+            request.finish()
+        
+        def failed(reason):
+            request.write(self.respond(request, 500, {'error': reason.getErrorMessage()}))
+            request.finish()
+        
+        d.addCallbacks(done, failed)
+        
+        return server.NOT_DONE_YET
+
+def listen(port, manager, token, interface='127.0.0.1'):
+    """
+    Serve the admin API for manager over HTTP, on the given port.
+    """
+    return reactor.listenTCP(port, server.Site(AdminResource(manager, token)), interface=interface)
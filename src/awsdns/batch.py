@@ -0,0 +1,132 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Batching - combines lookups that arrive close together into a single API
+call.
+"""
+
+from twisted.internet import defer, reactor
+
+import tx_logging
+
+import util
+
+class Batch(object):
+    """
+    Lookups waiting on a single filter.
+    """
+    
+    def __init__(self, name, prop):
+        self.name = name
+        self.prop = prop
+        self.waiting = {}
+        self.timer = None
+
+class LookupBatcher(object):
+    """
+    Collects lookups that arrive within window seconds of each other, and
+    sends them as a single DescribeInstances call, with a multi-valued filter
+    (e.g. tag:Name = [web1, web2, ...]). The instances found are split back
+    out to each lookup, by the value of prop.
+    
+    A batch is sent as soon as size different values are waiting, or when
+    window seconds have passed since its first lookup, whichever comes
+    first. Lookups for the same value within a batch share the result.
+    
+    ec2 - an EC2 client (see awsdns.ec2client).
+    window - seconds to wait for more lookups, after the first.
+    size - maximum number of values in a single call.
+    fold_case - set to True to hand instances out ignoring case, so lookups
+                for 'WebServer' and 'webserver' in the same batch both get
+                the instance tagged 'WebServer'. EC2 filters themselves are
+                always case-sensitive.
+    """
+    
+    ec2 = None
+    window = None
+    size = None
+    fold_case = False
+    clock = None
+    log = None
+    calls = 0
+    lookups = 0
+    
+    def __init__(self, ec2, window=0.005, size=50, clock=None, fold_case=False):
+        self.ec2 = ec2
+        self.window = window
+        self.size = size
+        self.fold_case = fold_case
+        self.clock = clock or reactor
+        self.log = tx_logging.getLogger("awsdns:batch")
+        self._batches = {}
+    
+    def lookup(self, name, prop, value):
+        """
+        Find the instances where filter name matches value. prop is the tag
+        or property (see util.tag_or_property) that the filter matches on.
+        
+        Returns a deferred that fires with a list of instances.
+        """
+        self.lookups += 1
+        
+        try:
+            batch = self._batches[name]
+        except KeyError:
+            batch = self._batches[name] = Batch(name, prop)
+            batch.timer = self.clock.callLater(self.window, self.flush, name)
+        
+        d = defer.Deferred()
+        batch.waiting.setdefault(value, []).append(d)
+        
+        if len(batch.waiting) >= self.size:
+            self.flush(name)
+        
+        return d
+    
+    def flush(self, name):
+        """
+        Send the batch for the given filter now.
+        """
+        try:
+            batch = self._batches.pop(name)
+        except KeyError:
+            return
+        
+        if batch.timer.active():
+            batch.timer.cancel()
+        
+        self.calls += 1
+        values = sorted(batch.waiting)
+        self.log.debug("Looking up %s %s: %s" % (len(values), name, values))
+        
+        d = self.ec2.get_all_reservations(filters={name: values})
+        d.addCallback(util.instances)
+        
+        def fold(value):
+            # queries are bytes - tags from the API may not be
+            value = util.encode(value)
+            if self.fold_case:
+                return value.lower()
+            return value
+        
+        def split(instances):
+            found = {}
+            for instance in instances:
+                value = util.tag_or_property(instance, batch.prop)
+                if value:
+                    found.setdefault(fold(value), []).append(instance)
+            
+            for value, waiting in batch.waiting.items():
+                for waiter in waiting:
+                    waiter.callback(list(found.get(fold(value), [])))
+        
+        def failed(failure):
+            # covers failures in split() too - every waiter must hear back,
+            # or its lookup never finishes
+            for waiting in batch.waiting.values():
+                for waiter in waiting:
+                    if not waiter.called:
+                        waiter.errback(failure)
+        
+        d.addCallback(split)
+        d.addErrback(failed)
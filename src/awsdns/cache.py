@@ -3,16 +3,22 @@ AWSDNS - DNS for EC2 instances in Amazon Web Services
 
 Semi-generic caching class.
 
-TODO: persist to disk using something like shelve?
+Entries can be saved to disk, and restored at startup - see 
+awsdns.snapshot.
 """
 
 from twisted.internet import reactor
 from twisted.internet import task
 from twisted.internet import defer
+from twisted.python import failure
 
 import tx_logging
 
 import pprint
+import collections
+
+from awsdns.wheel import TimingWheel
+from awsdns.forward import cap_records
 
 class ResolverCache(object):
     """
@@ -30,50 +36,205 @@ class ResolverCache(object):
     
     Callback takes a single argument, the name to look up, and returns a tuple, 
     containing the name, the 'message' (the thing to cache) and a TTL value.
+    Any extra arguments given to get() or refresh() (e.g. how the name was
+    written in the query) are passed on to it. Messages with a TTL of 0 are
+    handed out, but not kept.
     
     autorefresh - set to True to automatically re-call the callback function 
                   whenever the cache item expires.
-                  
-    TODO: assumes the "usual" reactor - support other reactors.
-    TODO: debugging log output
+    clock - the reactor (or an IReactorTime provider) to use for timing.
+    negative_ttl - if set, 'negative' messages (ones with no answers) are 
+                   kept apart from the rest of the cache, for at most this
+                   many seconds.
+    negative_size - maximum number of negative messages to keep. When full,
+                    the oldest one is dropped.
+    stale_grace - seconds to keep serving an entry after it expires. The 
+                  first request for a stale entry starts a single refresh in
+                  the background; the new value replaces the old one once it
+                  arrives. Entries that aren't requested during the grace 
+                  period are dropped. Ignored when autorefresh is on. Stale
+                  answers go out with TTLs of at most stale_ttl seconds (or 
+                  the grace time left, if that's less), so nobody downstream
+                  keeps them for long.
+    pack - function that turns a message into the value to keep in the
+           cache (e.g. awsdns.compact.pack), or None to keep messages as-is.
+    unpack - function that turns a value made by pack back into a message.
+    
+    Expiry times are kept in a single TimingWheel, which is advanced once 
+    every resolution seconds - so the reactor is never asked to track more 
+    than one call, no matter how many entries are cached. Entries are also
+    checked for expiry when they're read, so the resolution doesn't affect 
+    how long entries are served for.
+    
+    Concurrent requests for a key that isn't cached yet share a single call
+    to the callback - while it's in flight, later requests get a deferred 
+    that fires with the same result. hits, misses, coalesced, stale_hits and
+    negative_hits count how each request was handled.
+    
+    Entries can also be managed directly - see remove() and refresh(). 
+    Functions in listeners are called with the key of every entry that's 
+    removed or refreshed that way, so copies kept elsewhere (e.g. the wire
+    cache) can be dropped too.
     """
     
     _cache = None
-    _pending = None
+    _negative = None
+    _inflight = None
+    _wheel = None
+    _sweeper = None
     callback = None
     autorefresh = False
+    clock = None
+    resolution = 1.0
+    negative_ttl = None
+    negative_size = None
+    stale_grace = 0
+    # RFC 8767 suggests 30 seconds
+    stale_ttl = 30
     log = None
+    hits = 0
+    misses = 0
+    coalesced = 0
+    stale_hits = 0
+    negative_hits = 0
+    listeners = None
+    pack = None
+    unpack = None
     
-    def __init__(self, callback, autorefresh=False):
+    def __init__(self, callback, autorefresh=False, clock=None, negative_ttl=None, negative_size=10000,
+                 stale_grace=0, pack=None, unpack=None):
         self._cache = {}
+        self._negative = collections.OrderedDict()
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
         self.callback = callback
         self.autorefresh = autorefresh
+        
+        # autorefresh keeps entries fresh already
+        if not autorefresh:
+            self.stale_grace = stale_grace
+        
+        self.clock = clock or reactor
         self.log = tx_logging.getLogger("awsdns:cache")
-        self._pending = {}
+        self._inflight = {}
+        self.listeners = []
+        self.pack = pack or (lambda message: message)
+        self.unpack = unpack or (lambda value: value)
+        self._wheel = TimingWheel(self.resolution, clock=self.clock.seconds)
+        self._sweeper = task.LoopingCall(self._sweep)
+        self._sweeper.clock = self.clock
     
-    def __getdeferred__(self, key):
+    def stats(self):
+        """
+        Return a dictionary of statistics - how requests were handled, and
+        the number of entries.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'stale_hits': self.stale_hits,
+            'negative_hits': self.negative_hits,
+            'entries': len(self._cache),
+            'negative_entries': len(self._negative),
+        }
+    
+    def __getdeferred__(self, key, *args):
         """
         Wrap the functionality of __getitem__ such that it can possibly return
         a deferred.
         """
         try:
-            val = self._cache.__getitem__(key)
+            expires, stored, val = self._negative[key]
+        except KeyError:
+            pass
+        else:
+            if expires > self.clock.seconds():
+                self.log.debug("negative hit: %s" % (key,))
+                self.negative_hits += 1
+                return self.unpack(val)
+            
+            del self._negative[key]
+        
+        try:
+            expires, stored, val = self._cache.__getitem__(key)
+            
+            now = self.clock.seconds()
+            
+            if expires <= now:
+                if now < expires + self.stale_grace:
+                    self.log.debug("stale hit: %s" % (key,))
+                    self.stale_hits += 1
+                    
+                    if key not in self._inflight:
+                        self.revalidate(key, *args)
+                    
+                    ttl = max(1, int(min(self.stale_ttl, expires + self.stale_grace - now)))
+                    return tuple([cap_records(section, ttl) for section in self.unpack(val)])
+                
+                # the sweeper hasn't got to it yet
+                self.expire(key)
+                raise KeyError(key)
+            
             self.log.debug("hit: %s" % (key,))
-            return val
+            self.hits += 1
+            return self.unpack(val)
         except KeyError:
             self.log.debug("miss: %s" % (key,))
             try:
-                # if there is a pending request for this key,
-                self._pending[key]
-                self.log.debug("Request pending for: %s" % (key,))
-                # return nothing
-                return ([], [], [])
+                # if there is a request in flight for this key,
+                waiters = self._inflight[key]
             except KeyError:
                 # otherwise, go ahead
-                self.log.debug("No request pending for: %s" % (key,))
-                d = defer.maybeDeferred(self.callback, key)
-                d.addCallback(self.cache)
-                return d
+                self.log.debug("No request in flight for: %s" % (key,))
+                self.misses += 1
+                return self._fetch(key, *args)
+            
+            # wait for it to finish
+            self.log.debug("Request in flight for: %s" % (key,))
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiters.append(d)
+            return d
+    
+    def _fetch(self, key, *args):
+        """
+        Call the callback for key, and cache the result. Any requests for the 
+        same key made before it finishes are handed the same result.
+        """
+        waiters = self._inflight[key] = []
+        
+        d = defer.maybeDeferred(self.callback, key, *args)
+        d.addCallback(self.cache)
+        
+        def done(result):
+            del self._inflight[key]
+            
+            for waiter in waiters:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+            
+            return result
+        
+        d.addBoth(done)
+        
+        return d
+    
+    def revalidate(self, key, *args):
+        """
+        Refresh a stale entry in the background. It's served as-is until the
+        new value arrives, or the grace period runs out.
+        """
+        self.log.debug("Revalidating %s" % (key,))
+        
+        d = self._fetch(key, *args)
+        
+        def failed(reason):
+            self.log.warning("Couldn't refresh %s: %s" % (key, reason.getErrorMessage()))
+        
+        d.addErrback(failed)
                 
     
     def __getitem__(self, key):
@@ -81,7 +242,13 @@ class ResolverCache(object):
         Return a deferred - will be from the cache if it exists, will be the
         result of calling (and caching) the callback if not.
         """
-        d = defer.maybeDeferred(self.__getdeferred__, key)
+        return self.get(key)
+    
+    def get(self, key, *args):
+        """
+        Like self[key], but passes args on to the callback, if it's called.
+        """
+        d = defer.maybeDeferred(self.__getdeferred__, key, *args)
         
         return d
                 
@@ -99,28 +266,173 @@ class ResolverCache(object):
         """
         name, message, ttl = info
         self.log.debug("NAME: %s, MESSAGE: %s, TTL: %s" % (name, message, ttl))
-        self._cache[name] = message
         
-        def remove(name):
-            try:
-                self.log.debug("Removing %s" % (name,))
-                del self._pending[name]
-                del self._cache[name]
-            except KeyError:
-                pass
-            return name
+        if ttl <= 0:
+            # not to be kept
+            return message
         
-        def refresh(name):
-            self.log.debug("Refreshing %s" % (name,))
-            self.__getdeferred__(name)
-            return name
+        if self.negative_ttl is not None and self.is_negative(message):
+            return self.cache_negative(name, message, ttl)
+        
+        self._negative.pop(name, None)
+        stored = self.clock.seconds()
+        # (expires, stored, value) - one tuple per entry, rather than a
+        # dictionary for each, keeps the per-entry overhead down
+        self._cache[name] = (stored + ttl, stored, self.pack(message))
+        # stale entries are kept around until the grace period is over
+        self._wheel.add(name, ttl + self.stale_grace)
+        
+        if not self._sweeper.running:
+            self._sweeper.start(self.resolution, now=False)
+        
+        return message
+    
+    def is_negative(self, message):
+        """
+        Returns True if message has no answers.
+        """
+        return not message[0]
+    
+    def cache_negative(self, name, message, ttl):
+        """
+        Keep a negative message, apart from the rest of the cache. Negative 
+        messages are never refreshed - they just expire.
+        """
+        if name in self._cache:
+            self._cache.pop(name)
+            self._wheel.remove(name)
+        
+        self._negative.pop(name, None)
+        stored = self.clock.seconds()
+        self._negative[name] = (stored + min(ttl, self.negative_ttl), stored, self.pack(message))
+        
+        while len(self._negative) > self.negative_size:
+            self._negative.popitem(last=False)
+        
+        return message
+    
+    def entries(self):
+        """
+        Return a list of (name, message, ttl) tuples - one for every entry
+        that hasn't expired (or gone stale) yet, negative ones included - 
+        where ttl is the number of seconds it has left.
+        """
+        now = self.clock.seconds()
+        output = []
+        
+        for name, (expires, stored, message) in self._cache.items():
+            ttl = expires - now
+            if ttl > 0:
+                output.append((name, self.unpack(message), ttl))
+        
+        for name, (expires, stored, message) in self._negative.items():
+            if expires > now:
+                output.append((name, self.unpack(message), expires - now))
+        
+        return output
+    
+    def details(self):
+        """
+        Return a dictionary for every entry, stale ones included, with its
+        key, message, age (seconds since it was cached), ttl (seconds it has
+        left to live - below 0 once it's stale) and whether it's negative.
+        """
+        now = self.clock.seconds()
+        output = []
+        
+        for name, (expires, stored, message) in self._cache.items():
+            output.append({
+                'key': name,
+                'message': self.unpack(message),
+                'age': now - stored,
+                'ttl': expires - now,
+                'negative': False,
+            })
+        
+        for name, (expires, stored, message) in self._negative.items():
+            if expires > now:
+                output.append({
+                    'key': name,
+                    'message': self.unpack(message),
+                    'age': now - stored,
+                    'ttl': expires - now,
+                    'negative': True,
+                })
+        
+        return output
+    
+    def keys(self):
+        """
+        Return the keys of every entry, negative ones included.
+        """
+        return self._cache.keys() + self._negative.keys()
+    
+    def _notify(self, key):
+        for listener in self.listeners:
+            listener(key)
+    
+    def remove(self, key):
+        """
+        Drop an entry, without refreshing it (even if autorefresh is on) - 
+        the next request for it calls the callback. Returns True if there 
+        was an entry to drop.
+        """
+        found = key in self._cache or key in self._negative
+        
+        self._cache.pop(key, None)
+        self._negative.pop(key, None)
+        self._wheel.remove(key)
+        
+        if found:
+            self.log.debug("Invalidated %s" % (key,))
+            self._notify(key)
         
+        return found
+    
+    def refresh(self, key, *args):
+        """
+        Call the callback for key now, whether it's cached or not. The old
+        entry is served until the new one arrives. Returns a deferred that
+        fires with the new message.
+        """
         try:
-            self._pending[name]
+            waiters = self._inflight[key]
         except KeyError:
-            self._pending[name] = task.deferLater(reactor, ttl, remove, name)
+            self.log.debug("Refreshing %s" % (key,))
+            
+            d = self._fetch(key, *args)
+            
+            def refreshed(message):
+                self._notify(key)
+                return message
+            
+            return d.addCallback(refreshed)
         
-            if self.autorefresh:
-                self._pending[name].addCallback(refresh)
+        # already on its way
+        d = defer.Deferred()
+        waiters.append(d)
+        return d
+    
+    def expire(self, name):
+        """
+        Remove an entry from the cache - and look it up again, if autorefresh 
+        is on.
+        """
+        self.log.debug("Removing %s" % (name,))
         
-        return message
+        self._cache.pop(name, None)
+        self._wheel.remove(name)
+        
+        if self.autorefresh:
+            self.log.debug("Refreshing %s" % (name,))
+            self.__getdeferred__(name)
+    
+    def _sweep(self):
+        """
+        Expire everything that's due. Runs every resolution seconds.
+        """
+        for name in self._wheel.advance():
+            self.expire(name)
+        
+        if not self._cache:
+            self._sweeper.stop()
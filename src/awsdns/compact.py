@@ -0,0 +1,152 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Compact messages - a smaller way to keep the messages the resolver builds
+in its cache. They're turned back into Twisted records only when they're
+served.
+"""
+
+from twisted.names import dns
+
+import socket
+
+class CompactMessage(object):
+    """
+    A message where every record has the same name, TTL and authority: A,
+    PTR or single-string TXT answers, and single-string TXT additional
+    records - the shape of the messages EC2Resolver.create_message() builds.
+    
+    Records are kept as plain strings, with no Twisted objects: IPv4
+    addresses are packed, 4 bytes each, into a single string, and TXT
+    strings are interned, since the same few (e.g. 'tag:Role = web') repeat
+    across most entries.
+    
+    name - the name of every record.
+    ttl - the TTL of every record.
+    type - dns.A, dns.PTR or dns.TXT.
+    answers - packed addresses (A), or a tuple of names (PTR) or strings
+              (TXT).
+    additional - a tuple of TXT strings.
+    auth - True if every record is authoritative (see awsdns.reverse).
+    """
+    
+    __slots__ = ('name', 'ttl', 'type', 'answers', 'additional', 'auth')
+    
+    def __init__(self, name, ttl, type, answers, additional, auth=False):
+        self.name = name
+        self.ttl = ttl
+        self.type = type
+        self.answers = answers
+        self.additional = additional
+        self.auth = auth
+    
+    def __repr__(self):
+        return "CompactMessage:%s" % (self.name,)
+    
+    def records(self):
+        """
+        Return the answer records, as RRHeaders.
+        """
+        if self.type == dns.A:
+            payloads = [
+                dns.Record_A(socket.inet_ntoa(self.answers[i:i + 4]))
+                for i in range(0, len(self.answers), 4)
+            ]
+        elif self.type == dns.PTR:
+            payloads = [dns.Record_PTR(name) for name in self.answers]
+        else:
+            payloads = [dns.Record_TXT(string) for string in self.answers]
+        
+        return [
+            dns.RRHeader(self.name, type=self.type, payload=payload, ttl=self.ttl, auth=self.auth)
+            for payload in payloads
+        ]
+    
+    def expand(self):
+        """
+        Return the message as a tuple of answer, authority and additional
+        lists of RRHeaders.
+        """
+        if self is EMPTY:
+            return ([], [], [])
+        
+        additional = [
+            dns.RRHeader(self.name, type=dns.TXT, payload=dns.Record_TXT(string), ttl=self.ttl, auth=self.auth)
+            for string in self.additional
+        ]
+        
+        return (self.records(), [], additional)
+
+# every message with no records at all (e.g. negative ones) shares this
+EMPTY = CompactMessage(None, 0, None, (), ())
+
+def simple(record, name, ttl, auth):
+    """
+    Returns True if record can be kept in a CompactMessage with the given
+    name, TTL and authority.
+    """
+    return (
+        record.name.name == name and
+        record.ttl == ttl and
+        record.cls == dns.IN and
+        bool(record.auth) == auth
+    )
+
+def pack(message):
+    """
+    Return a CompactMessage holding message (a tuple of answer, authority
+    and additional lists), or message itself, if it can't be packed (e.g.
+    answers from the upstream DNS servers with CNAMEs or SOAs in them).
+    """
+    answers, authority, additional = message
+    
+    if not answers and not authority and not additional:
+        return EMPTY
+    
+    if authority or not answers:
+        return message
+    
+    first = answers[0]
+    name = first.name.name
+    ttl = first.ttl
+    type = first.type
+    auth = bool(first.auth)
+    
+    if type not in (dns.A, dns.PTR, dns.TXT):
+        return message
+    
+    for record in answers:
+        if record.type != type or not simple(record, name, ttl, auth):
+            return message
+        if type == dns.TXT and len(record.payload.data) != 1:
+            return message
+    
+    for record in additional:
+        if record.type != dns.TXT or len(record.payload.data) != 1 or not simple(record, name, ttl, auth):
+            return message
+    
+    if type == dns.A:
+        packed = "".join([record.payload.address for record in answers])
+    elif type == dns.PTR:
+        packed = tuple([str(record.payload.name.name) for record in answers])
+    else:
+        packed = tuple([intern(str(record.payload.data[0])) for record in answers])
+    
+    return CompactMessage(
+        name,
+        ttl,
+        type,
+        packed,
+        tuple([intern(str(record.payload.data[0])) for record in additional]),
+        auth
+    )
+
+def unpack(value):
+    """
+    Return the message (a tuple of answer, authority and additional lists)
+    for a value returned by pack().
+    """
+    if isinstance(value, CompactMessage):
+        return value.expand()
+    
+    return value
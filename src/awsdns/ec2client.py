@@ -0,0 +1,603 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+EC2 clients - a thin, deferred-returning interface to DescribeInstances.
+
+BotoEC2Client wraps boto (which blocks) in the reactor's thread pool.
+AsyncEC2Client talks to the API directly, using twisted.web's Agent with a
+pool of persistent connections, and parses responses as they arrive (see
+AsyncAPIClient, which awsdns.elb uses too).
+StaticEC2Client (see awsdns.static) reads instances from a file instead.
+MultiRegionEC2Client asks one client per region, all at once.
+"""
+
+from twisted.internet import defer, protocol, reactor as default_reactor, threads
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from xml.etree import ElementTree
+
+import datetime
+import hashlib
+import hmac
+import json
+import re
+import urllib
+import urlparse
+
+import boto.ec2
+
+import tx_logging
+
+API_VERSION = "2014-10-01"
+
+# instance fields with names that don't follow the camelCase -> snake_case
+# pattern, mapped to the attribute names boto uses.
+INSTANCE_FIELDS = {
+    'instanceId': 'id',
+    'dnsName': 'dns_name',
+    'kernelId': 'kernel',
+    'ramdiskId': 'ramdisk',
+}
+
+class EC2Error(Exception):
+    """
+    An error response from the EC2 API.
+    
+    Attributes match boto's EC2ResponseError, so callers can check either.
+    """
+    
+    def __init__(self, status, error_code, message):
+        Exception.__init__(self, "%s %s: %s" % (status, error_code, message))
+        self.status = status
+        self.error_code = error_code
+        self.message = message
+
+class Instance(object):
+    """
+    An EC2 instance. Only simple fields are kept - tags, state, placement
+    (availability zone), and every top-level field of the instance, as an
+    attribute named the same way boto names it (private_ip_address, key_name,
+    etc).
+    """
+    
+    def __init__(self, **kwargs):
+        self.id = None
+        self.state = None
+        self.placement = None
+        self.tags = {}
+        self.__dict__.update(kwargs)
+    
+    @property
+    def public_dns_name(self):
+        return getattr(self, 'dns_name', None)
+    
+    def __repr__(self):
+        return "Instance:%s" % (self.id,)
+
+class Reservation(object):
+    def __init__(self):
+        self.id = None
+        self.owner_id = None
+        self.instances = []
+    
+    def __repr__(self):
+        return "Reservation:%s" % (self.id,)
+
+class ResultSet(list):
+    """
+    A page of results. next_token is set if there are more pages.
+    """
+    next_token = None
+
+def attribute_name(field):
+    """
+    Convert an EC2 API field name (e.g. privateIpAddress) to the attribute
+    name boto uses (private_ip_address).
+    """
+    try:
+        return INSTANCE_FIELDS[field]
+    except KeyError:
+        return re.sub(r'([A-Z])', r'_\1', field).lower()
+
+def field_name(attribute):
+    """
+    The reverse of attribute_name() - convert a boto attribute name to the
+    EC2 API field name.
+    """
+    for field, name in INSTANCE_FIELDS.items():
+        if name == attribute:
+            return field
+    
+    head, _, tail = attribute.partition('_')
+    return head + "".join([part.capitalize() for part in tail.split('_') if part])
+
+def local_name(tag):
+    """
+    Strip the namespace from an ElementTree tag.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+class DescribeInstancesHandler(object):
+    """
+    ElementTree parser target that builds a ResultSet of Reservations from
+    a DescribeInstances response, one element at a time - the document tree
+    is never built.
+    """
+    
+    def __init__(self):
+        self.result = ResultSet()
+        self._path = []
+        self._text = []
+        self._reservation = None
+        self._instance = None
+        self._instance_depth = None
+        self._tag = None
+    
+    def start(self, tag, attrib):
+        tag = local_name(tag)
+        self._path.append(tag)
+        self._text = []
+        
+        path = self._path
+        
+        if path[1:] == ['reservationSet', 'item']:
+            self._reservation = Reservation()
+            self.result.append(self._reservation)
+        elif path[1:] == ['reservationSet', 'item', 'instancesSet', 'item']:
+            self._instance = Instance()
+            self._instance_depth = len(path)
+            self._reservation.instances.append(self._instance)
+        elif self._instance is not None and path[self._instance_depth:] == ['tagSet', 'item']:
+            self._tag = {}
+    
+    def data(self, data):
+        self._text.append(data)
+    
+    def end(self, tag):
+        tag = local_name(tag)
+        text = "".join(self._text).strip()
+        self._text = []
+        
+        path = self._path
+        
+        if self._instance is not None:
+            # relative to the instance's <item>
+            relative = path[self._instance_depth:]
+            
+            if not relative:
+                self._instance = None
+                self._instance_depth = None
+            elif len(relative) == 1:
+                if text:
+                    setattr(self._instance, attribute_name(tag), text)
+            elif relative == ['instanceState', 'name']:
+                self._instance.state = text
+            elif relative == ['instanceState', 'code']:
+                self._instance.state_code = int(text)
+            elif relative == ['placement', 'availabilityZone']:
+                self._instance.placement = text
+            elif relative[:2] == ['tagSet', 'item'] and len(relative) == 3:
+                self._tag[tag] = text
+            elif relative == ['tagSet', 'item']:
+                self._instance.tags[self._tag.get('key')] = self._tag.get('value', '')
+                self._tag = None
+        elif len(path) == 4 and path[1:3] == ['reservationSet', 'item']:
+            if tag == 'reservationId':
+                self._reservation.id = text
+            elif tag == 'ownerId':
+                self._reservation.owner_id = text
+        elif len(path) == 2 and tag == 'nextToken':
+            self.result.next_token = text or None
+        
+        path.pop()
+    
+    def close(self):
+        return self.result
+
+class ErrorHandler(object):
+    """
+    ElementTree parser target that pulls the code and message out of an
+    EC2 error response.
+    """
+    
+    def __init__(self):
+        self.code = None
+        self.message = None
+        self._text = []
+    
+    def start(self, tag, attrib):
+        self._text = []
+    
+    def data(self, data):
+        self._text.append(data)
+    
+    def end(self, tag):
+        tag = local_name(tag)
+        if tag == 'Code' and self.code is None:
+            self.code = "".join(self._text).strip()
+        elif tag == 'Message' and self.message is None:
+            self.message = "".join(self._text).strip()
+    
+    def close(self):
+        return (self.code, self.message)
+
+class ResponseParser(protocol.Protocol):
+    """
+    Feeds a response body to an ElementTree parser as it arrives, and fires
+    finished with the parser target's result.
+    
+    Use deliver() to get a finished deferred that can be cancelled - e.g.
+    by a timeout - while the body is still arriving.
+    """
+    
+    @classmethod
+    def deliver(cls, response, target):
+        """
+        Parse the body of response with target. Returns a deferred that 
+        fires with the result; cancelling it stops the body.
+        """
+        def cancel(finished):
+            parser.transport.stopProducing()
+        
+        parser = cls(defer.Deferred(cancel), target)
+        response.deliverBody(parser)
+        
+        return parser.finished
+    
+    def __init__(self, finished, target):
+        self.finished = finished
+        self.parser = ElementTree.XMLParser(target=target)
+        self.error = None
+    
+    def dataReceived(self, data):
+        if self.error is not None:
+            return
+        
+        try:
+            self.parser.feed(data)
+        except Exception, e:
+            self.error = e
+            self.transport.stopProducing()
+    
+    def connectionLost(self, reason):
+        if self.finished.called:
+            # cancelled
+            return
+        
+        if self.error is not None:
+            self.finished.errback(self.error)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            try:
+                self.finished.callback(self.parser.close())
+            except Exception, e:
+                self.finished.errback(e)
+        else:
+            self.finished.errback(reason)
+
+class EC2Client(object):
+    """
+    Base class for EC2 clients.
+    
+    Subclasses implement get_all_reservations(), which fetches a single page
+    of reservations and returns a deferred that fires with a ResultSet.
+    """
+    
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        raise NotImplementedError
+    
+    def get_all_pages(self, filters=None, page_size=1000):
+        """
+        Fetch every page of reservations matching filters. Returns a deferred
+        that fires with a single ResultSet.
+        """
+        reservations = ResultSet()
+        finished = defer.Deferred()
+        
+        def fetch(next_token):
+            d = self.get_all_reservations(
+                filters=filters,
+                max_results=page_size,
+                next_token=next_token
+            )
+            d.addCallbacks(got, finished.errback)
+        
+        def got(page):
+            reservations.extend(page)
+            if page.next_token:
+                fetch(page.next_token)
+            else:
+                finished.callback(reservations)
+        
+        fetch(None)
+        
+        return finished
+
+class BotoEC2Client(EC2Client):
+    """
+    Calls the API through boto, in the reactor's thread pool.
+    """
+    
+    _ec2 = None
+    
+    def __init__(self, region, aws_access_key_id, aws_secret_access_key):
+        self._ec2 = boto.ec2.connect_to_region(
+            region,
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key
+        )
+    
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        return threads.deferToThread(
+            self._ec2.get_all_reservations,
+            filters=filters,
+            max_results=max_results,
+            next_token=next_token
+        )
+
+class AsyncAPIClient(object):
+    """
+    Calls an AWS query API (e.g. EC2's) directly, without blocking.
+    
+    Requests are signed (AWS Signature Version 4) and sent over a pool of
+    persistent HTTP(S) connections. Responses are parsed incrementally, as
+    each chunk of the body arrives.
+    
+    Subclasses set service (the name used in signatures and endpoints) and
+    version (of the API).
+    
+    region - AWS region, e.g. us-east-1
+    endpoint - base URL of the API. Defaults to the region's public endpoint;
+               set it to point at a stand-in (see awsdns.fakeec2).
+    pool_size - maximum number of idle connections to keep open.
+    timeout - seconds to wait for a response before giving up.
+    """
+    
+    service = None
+    version = None
+    region = None
+    endpoint = None
+    timeout = None
+    log = None
+    
+    def __init__(self, region, aws_access_key_id, aws_secret_access_key,
+                 endpoint=None, pool_size=10, timeout=30, reactor=None):
+        self.region = region
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.endpoint = endpoint or "https://%s.%s.amazonaws.com/" % (self.service, region)
+        self.timeout = timeout
+        self.reactor = reactor or default_reactor
+        
+        self.pool = HTTPConnectionPool(self.reactor, persistent=True)
+        self.pool.maxPersistentPerHost = pool_size
+        self.agent = Agent(self.reactor, pool=self.pool)
+        
+        self.log = tx_logging.getLogger("awsdns:ec2client")
+    
+    def _sign(self, method, host, path, query, now):
+        """
+        Build the headers for a Signature Version 4 signed request.
+        """
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = now.strftime("%Y%m%d")
+        scope = "%s/%s/%s/aws4_request" % (date, self.region, self.service)
+        
+        canonical_request = "\n".join([
+            method,
+            path,
+            query,
+            "host:%s\nx-amz-date:%s\n" % (host, amz_date),
+            "host;x-amz-date",
+            hashlib.sha256("").hexdigest(),
+        ])
+        
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request).hexdigest(),
+        ])
+        
+        key = ("AWS4" + self.aws_secret_access_key).encode('utf-8')
+        for part in (date, self.region, self.service, "aws4_request"):
+            key = hmac.new(key, part, hashlib.sha256).digest()
+        
+        signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+        
+        return {
+            'Host': [host],
+            'X-Amz-Date': [amz_date],
+            'Authorization': ["AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=host;x-amz-date, Signature=%s" % (
+                self.aws_access_key_id, scope, signature
+            )],
+        }
+    
+    def request(self, action, params, target):
+        """
+        Call action, with the given parameters. Returns a deferred that
+        fires with the result of target (an ElementTree parser target, fed
+        the response as it arrives), or fails with EC2Error.
+        """
+        params = dict(params, Action=action, Version=self.version)
+        
+        # the canonical query string - keys sorted, everything escaped
+        query = "&".join([
+            "%s=%s" % (urllib.quote(key, safe='-_.~'), urllib.quote(str(params[key]), safe='-_.~'))
+            for key in sorted(params)
+        ])
+        
+        url = urlparse.urlparse(self.endpoint)
+        path = url.path or "/"
+        headers = self._sign("GET", url.netloc, path, query, datetime.datetime.utcnow())
+        
+        uri = "%s://%s%s?%s" % (url.scheme, url.netloc, path, query)
+        
+        d = self.agent.request("GET", uri, Headers(headers), None)
+        
+        timeout = self.reactor.callLater(self.timeout, d.cancel)
+        
+        # cancelling d cancels whichever stage it's waiting on - the request,
+        # or the body (see ResponseParser.deliver())
+        def got_response(response):
+            if response.code == 200:
+                return ResponseParser.deliver(response, target)
+            
+            finished = ResponseParser.deliver(response, ErrorHandler())
+            
+            def error((code, message)):
+                raise EC2Error(response.code, code, message)
+            
+            finished.addCallback(error)
+            return finished
+        
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        
+        d.addCallback(got_response)
+        d.addBoth(done)
+        
+        return d
+
+class AsyncEC2Client(AsyncAPIClient, EC2Client):
+    """
+    Calls the EC2 API directly, without blocking (see AsyncAPIClient).
+    """
+    
+    service = "ec2"
+    version = API_VERSION
+    
+    def _params(self, filters, max_results, next_token):
+        params = {}
+        
+        for i, (name, values) in enumerate(sorted((filters or {}).items())):
+            if isinstance(values, basestring):
+                values = [values]
+            
+            params['Filter.%s.Name' % (i + 1,)] = name
+            for j, value in enumerate(values):
+                params['Filter.%s.Value.%s' % (i + 1, j + 1)] = value
+        
+        if max_results:
+            params['MaxResults'] = str(max_results)
+        
+        if next_token:
+            params['NextToken'] = next_token
+        
+        return params
+    
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        """
+        Fetch a page of reservations. Returns a deferred that fires with a
+        ResultSet, or fails with EC2Error.
+        """
+        self.log.debug("DescribeInstances: %s" % (filters,))
+        
+        return self.request(
+            'DescribeInstances',
+            self._params(filters, max_results, next_token),
+            DescribeInstancesHandler()
+        )
+
+class MultiRegionEC2Client(EC2Client):
+    """
+    Sends each call to a client per region, all at once, and merges the
+    results. Every instance gets a region attribute, set to the region it
+    came from.
+    
+    Regions are paged through in step - a merged page's next_token holds the
+    next token of every region that has more, so max_results applies to each
+    region separately.
+    
+    If the call to any region fails, the whole call fails, rather than
+    returning a partial result that would make that region's instances look
+    like they'd gone - unless partial is on.
+    
+    clients - dictionary mapping region names to EC2 clients.
+    partial - set to True to merge the regions that answered, and log the
+              ones that failed, instead of failing the call - for lookups,
+              where an outage in one region shouldn't stop the others from 
+              resolving. The call only fails if every region does. Not for
+              paging - a failed region's next token is lost.
+    """
+    
+    clients = None
+    partial = False
+    log = None
+    
+    def __init__(self, clients, partial=False):
+        self.clients = clients
+        self.partial = partial
+        self.log = tx_logging.getLogger("awsdns:ec2client")
+    
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        if next_token:
+            tokens = dict([(str(region), token) for region, token in json.loads(next_token).items()])
+        else:
+            tokens = dict([(region, None) for region in self.clients])
+        
+        regions = sorted(tokens)
+        
+        calls = [
+            self.clients[region].get_all_reservations(
+                filters=filters,
+                max_results=max_results,
+                next_token=tokens[region]
+            )
+            for region in regions
+        ]
+        
+        if self.partial:
+            d = defer.DeferredList(calls, consumeErrors=True)
+            d.addCallback(self._answered, regions)
+        else:
+            d = defer.gatherResults(calls, consumeErrors=True)
+            d.addCallback(lambda pages: zip(regions, pages))
+        
+        def merge(pages):
+            result = ResultSet()
+            more = {}
+            
+            for region, page in pages:
+                for reservation in page:
+                    for instance in reservation.instances:
+                        instance.region = region
+                    result.append(reservation)
+                
+                if page.next_token:
+                    more[region] = page.next_token
+            
+            if more:
+                result.next_token = json.dumps(more)
+            
+            return result
+        
+        def failed(failure):
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+        
+        d.addCallbacks(merge, failed)
+        
+        return d
+    
+    def _answered(self, results, regions):
+        """
+        Return (region, page) for every region that answered, from the
+        results of a DeferredList. Fails if none did.
+        """
+        pages = []
+        
+        for region, (ok, result) in zip(regions, results):
+            if ok:
+                pages.append((region, result))
+            else:
+                self.log.warning("Lookup in %s failed: %s" % (region, result.getErrorMessage()))
+        
+        if not pages:
+            # every region failed - there's nothing to merge
+            return results[0][1]
+        
+        return pages
@@ -0,0 +1,312 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+ELB - an in-memory index of (classic) load balancers, so short names can be
+answered with a CNAME to the load balancer's DNS name.
+"""
+
+from twisted.internet import defer, task
+
+import time
+
+import tx_logging
+
+from awsdns.ec2client import AsyncAPIClient, ResultSet, local_name
+from awsdns import util
+
+API_VERSION = "2012-06-01"
+
+# load balancer names per DescribeTags call
+TAGS_BATCH = 20
+
+class LoadBalancer(object):
+    """
+    A load balancer. Tags are a dictionary, as they are for instances, so
+    util.tag_or_property() works on both.
+    """
+    
+    def __init__(self, **kwargs):
+        self.name = None
+        self.dns_name = None
+        self.scheme = None
+        self.region = None
+        self.tags = {}
+        self.__dict__.update(kwargs)
+    
+    def __repr__(self):
+        return "LoadBalancer:%s" % (self.name,)
+
+# DescribeLoadBalancers fields, mapped to LoadBalancer attributes
+LOAD_BALANCER_FIELDS = {
+    'LoadBalancerName': 'name',
+    'DNSName': 'dns_name',
+    'Scheme': 'scheme',
+    'VPCId': 'vpc_id',
+    'CanonicalHostedZoneName': 'canonical_hosted_zone_name',
+}
+
+class DescribeLoadBalancersHandler(object):
+    """
+    ElementTree parser target that builds a ResultSet of LoadBalancers from
+    a DescribeLoadBalancers response. next_token is set from NextMarker.
+    """
+    
+    def __init__(self):
+        self.result = ResultSet()
+        self._path = []
+        self._text = []
+        self._load_balancer = None
+    
+    def start(self, tag, attrib):
+        self._path.append(local_name(tag))
+        self._text = []
+        
+        if self._path[2:] == ['LoadBalancerDescriptions', 'member']:
+            self._load_balancer = LoadBalancer()
+            self.result.append(self._load_balancer)
+    
+    def data(self, data):
+        self._text.append(data)
+    
+    def end(self, tag):
+        tag = local_name(tag)
+        text = "".join(self._text).strip()
+        self._text = []
+        
+        path = self._path
+        
+        if path[2:4] == ['LoadBalancerDescriptions', 'member'] and len(path) == 5:
+            if tag in LOAD_BALANCER_FIELDS and text:
+                setattr(self._load_balancer, LOAD_BALANCER_FIELDS[tag], text)
+        elif path[2:] == ['NextMarker']:
+            self.result.next_token = text or None
+        
+        path.pop()
+    
+    def close(self):
+        return self.result
+
+class DescribeTagsHandler(object):
+    """
+    ElementTree parser target that builds a dictionary mapping load balancer
+    names to their tags, from a DescribeTags response.
+    """
+    
+    def __init__(self):
+        self.result = {}
+        self._path = []
+        self._text = []
+        self._name = None
+        self._tags = None
+        self._tag = None
+    
+    def start(self, tag, attrib):
+        self._path.append(local_name(tag))
+        self._text = []
+        
+        relative = self._path[2:]
+        
+        if relative == ['TagDescriptions', 'member']:
+            self._name = None
+            self._tags = {}
+        elif relative == ['TagDescriptions', 'member', 'Tags', 'member']:
+            self._tag = {}
+    
+    def data(self, data):
+        self._text.append(data)
+    
+    def end(self, tag):
+        tag = local_name(tag)
+        text = "".join(self._text).strip()
+        self._text = []
+        
+        relative = self._path[2:]
+        
+        if relative == ['TagDescriptions', 'member', 'LoadBalancerName']:
+            self._name = text
+        elif relative[:4] == ['TagDescriptions', 'member', 'Tags', 'member'] and len(relative) == 5:
+            self._tag[tag] = text
+        elif relative == ['TagDescriptions', 'member', 'Tags', 'member']:
+            self._tags[self._tag.get('Key')] = self._tag.get('Value', '')
+        elif relative == ['TagDescriptions', 'member']:
+            self.result[self._name] = self._tags
+        
+        self._path.pop()
+    
+    def close(self):
+        return self.result
+
+class AsyncELBClient(AsyncAPIClient):
+    """
+    Calls the (classic) Elastic Load Balancing API directly, without
+    blocking.
+    """
+    
+    service = "elasticloadbalancing"
+    version = API_VERSION
+    
+    def __init__(self, *args, **kwargs):
+        AsyncAPIClient.__init__(self, *args, **kwargs)
+        self.log = tx_logging.getLogger("awsdns:elb")
+    
+    def get_load_balancers(self, marker=None):
+        """
+        Fetch a page of load balancers. Returns a deferred that fires with a
+        ResultSet (next_token is the marker for the next page).
+        """
+        params = {}
+        if marker:
+            params['Marker'] = marker
+        
+        return self.request('DescribeLoadBalancers', params, DescribeLoadBalancersHandler())
+    
+    def get_tags(self, names):
+        """
+        Fetch the tags of up to 20 load balancers. Returns a deferred that
+        fires with a dictionary mapping names to tags.
+        """
+        params = {}
+        for i, name in enumerate(names):
+            params['LoadBalancerNames.member.%s' % (i + 1,)] = name
+        
+        return self.request('DescribeTags', params, DescribeTagsHandler())
+    
+    @defer.inlineCallbacks
+    def get_all_load_balancers(self):
+        """
+        Fetch every load balancer in the region, with its tags. Returns a
+        deferred that fires with a list of LoadBalancers.
+        """
+        load_balancers = []
+        marker = None
+        
+        while True:
+            page = yield self.get_load_balancers(marker)
+            load_balancers.extend(page)
+            
+            marker = page.next_token
+            if not marker:
+                break
+        
+        names = [load_balancer.name for load_balancer in load_balancers]
+        batches = yield defer.gatherResults([
+            self.get_tags(names[i:i + TAGS_BATCH]) for i in range(0, len(names), TAGS_BATCH)
+        ], consumeErrors=True)
+        
+        tags = {}
+        for batch in batches:
+            tags.update(batch)
+        
+        for load_balancer in load_balancers:
+            load_balancer.region = self.region
+            load_balancer.tags = tags.get(load_balancer.name, {})
+        
+        defer.returnValue(load_balancers)
+
+class LoadBalancerIndex(object):
+    """
+    Keeps a copy of every load balancer in the given regions, indexed by
+    each of keys - tags or properties (see util.tag_or_property), e.g.
+    'name' or 'tag:Service'. Values are case-insensitive.
+    
+    The index is built from bulk sweeps (DescribeLoadBalancers, then
+    DescribeTags for every 20 load balancers), at startup and then every
+    interval seconds. Like the inventory, it's rebuilt off to the side and
+    swapped in; if a sweep fails, the old index is kept. Lookups never wait
+    for the API.
+    
+    When the same value is found in more than one region, the load balancer
+    in the region listed first comes first.
+    
+    clients - list of (region, AsyncELBClient) tuples.
+    keys - list of tags or properties to index.
+    interval - number of seconds between sweeps.
+    """
+    
+    _loop = None
+    clients = None
+    keys = None
+    interval = None
+    index = None
+    load_balancers = None
+    loaded = False
+    last_sweep = None
+    log = None
+    
+    def __init__(self, clients, keys=('name',), interval=300):
+        self.clients = clients
+        self.keys = list(keys)
+        self.interval = interval
+        self.index = {}
+        self.load_balancers = []
+        self.log = tx_logging.getLogger("awsdns:elb")
+    
+    def rebuild(self, load_balancers):
+        """
+        Replace the index with one built from the given load balancers.
+        """
+        index = {}
+        
+        for load_balancer in load_balancers:
+            if not load_balancer.dns_name:
+                continue
+            
+            for key in self.keys:
+                value = util.tag_or_property(load_balancer, key)
+                if value:
+                    entries = index.setdefault(str(value).lower(), [])
+                    if load_balancer not in entries:
+                        entries.append(load_balancer)
+        
+        self.index = index
+        self.load_balancers = list(load_balancers)
+        self.loaded = True
+        self.last_sweep = time.time()
+        
+        self.log.info("ELB index rebuilt: %s load balancers, %s names" % (len(load_balancers), len(index)))
+        
+        return self
+    
+    def sweep(self):
+        """
+        Fetch every load balancer and rebuild the index. Returns a deferred.
+        Failures are logged, and the previous index is left in place.
+        """
+        d = defer.gatherResults(
+            [client.get_all_load_balancers() for region, client in self.clients],
+            consumeErrors=True
+        )
+        
+        def combine(results):
+            load_balancers = []
+            for found in results:
+                load_balancers.extend(found)
+            return load_balancers
+        
+        def failed(failure):
+            if failure.check(defer.FirstError):
+                failure = failure.value.subFailure
+            self.log.error("ELB sweep failed: %s" % (failure.getErrorMessage(),))
+        
+        d.addCallback(combine)
+        d.addCallback(self.rebuild)
+        d.addErrback(failed)
+        
+        return d
+    
+    def start(self):
+        """
+        Sweep now, and every interval seconds after that.
+        """
+        self._loop = task.LoopingCall(self.sweep)
+        return self._loop.start(self.interval, now=True)
+    
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+    
+    def lookup(self, name):
+        """
+        Return the list of load balancers indexed under name.
+        """
+        return self.index.get(str(name).lower().rstrip('.'), [])
@@ -0,0 +1,320 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Fake EC2 - a local stand-in for the EC2 API's DescribeInstances call, for
+testing AsyncEC2Client (and the rest of the server) without an AWS account.
+
+Instances are loaded from a canned DescribeInstances response, or made up
+(see synthetic()). Filters (including wildcards) and pagination are
+supported; request signatures are not checked.
+
+Load balancers, if given, are served through the ELB API's 
+DescribeLoadBalancers and DescribeTags calls, so the same server can stand
+in for both APIs (see awsdns.elb).
+"""
+
+from twisted.internet import reactor, task
+from twisted.web import resource, server
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import argparse
+import re
+
+from awsdns.ec2client import DescribeInstancesHandler, Instance, field_name
+from awsdns import util
+
+NAMESPACE = "http://ec2.amazonaws.com/doc/2014-10-01/"
+ELB_NAMESPACE = "http://elasticloadbalancing.amazonaws.com/doc/2012-06-01/"
+
+# load balancers per DescribeLoadBalancers page
+ELB_PAGE_SIZE = 400
+
+def load(path):
+    """
+    Read the instances out of a canned DescribeInstances response.
+    """
+    parser = ElementTree.XMLParser(target=DescribeInstancesHandler())
+    
+    with open(path) as fh:
+        parser.feed(fh.read())
+    
+    return util.instances(parser.close())
+
+def synthetic(count, domain=None):
+    """
+    Make up count running instances, named host0 to host(count - 1) 
+    (followed by .domain, if given), with private addresses counting up 
+    from 10.0.0.1.
+    """
+    output = []
+    
+    for i in xrange(count):
+        address = i + 1
+        name = "host%s" % (i,)
+        if domain:
+            name = "%s.%s" % (name, domain)
+        
+        output.append(Instance(
+            id="i-%08x" % (i,),
+            state='running',
+            state_code=16,
+            placement='us-east-1a',
+            instance_type='t2.micro',
+            private_ip_address="10.%s.%s.%s" % ((address >> 16) & 255, (address >> 8) & 255, address & 255),
+            tags={'Name': name},
+        ))
+    
+    return output
+
+def render_instance(instance):
+    output = ["<item>"]
+    
+    for attribute, value in sorted(instance.__dict__.items()):
+        if attribute in ('tags', 'state', 'state_code', 'placement') or value is None:
+            continue
+        tag = field_name(attribute)
+        output.append("<%s>%s</%s>" % (tag, escape(str(value)), tag))
+    
+    output.append("<instanceState><code>%s</code><name>%s</name></instanceState>" % (
+        getattr(instance, 'state_code', 16), escape(instance.state or 'running')
+    ))
+    
+    if instance.placement:
+        output.append("<placement><availabilityZone>%s</availabilityZone></placement>" % (escape(instance.placement),))
+    
+    output.append("<tagSet>")
+    for key, value in sorted(instance.tags.items()):
+        output.append("<item><key>%s</key><value>%s</value></item>" % (escape(key), escape(value)))
+    output.append("</tagSet>")
+    
+    output.append("</item>")
+    
+    return "".join(output)
+
+def render_describe_instances(instances, next_token=None):
+    """
+    Render a DescribeInstances response, with one reservation per instance.
+    """
+    output = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<DescribeInstancesResponse xmlns="%s">' % (NAMESPACE,),
+        '<requestId>fake</requestId>',
+        '<reservationSet>',
+    ]
+    
+    for instance in instances:
+        output.append("<item><reservationId>r-%s</reservationId><ownerId>000000000000</ownerId>" % (instance.id.split("-", 1)[-1],))
+        output.append("<instancesSet>%s</instancesSet></item>" % (render_instance(instance),))
+    
+    output.append('</reservationSet>')
+    
+    if next_token:
+        output.append('<nextToken>%s</nextToken>' % (next_token,))
+    
+    output.append('</DescribeInstancesResponse>')
+    
+    return "\n".join(output)
+
+def render_describe_load_balancers(load_balancers, next_marker=None):
+    output = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<DescribeLoadBalancersResponse xmlns="%s">' % (ELB_NAMESPACE,),
+        '<DescribeLoadBalancersResult>',
+        '<LoadBalancerDescriptions>',
+    ]
+    
+    for load_balancer in load_balancers:
+        output.append("<member><LoadBalancerName>%s</LoadBalancerName><DNSName>%s</DNSName><Scheme>%s</Scheme></member>" % (
+            escape(load_balancer.name), escape(load_balancer.dns_name), escape(load_balancer.scheme or 'internal')
+        ))
+    
+    output.append('</LoadBalancerDescriptions>')
+    
+    if next_marker:
+        output.append('<NextMarker>%s</NextMarker>' % (next_marker,))
+    
+    output.append('</DescribeLoadBalancersResult>')
+    output.append('</DescribeLoadBalancersResponse>')
+    
+    return "\n".join(output)
+
+def render_describe_tags(load_balancers):
+    output = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<DescribeTagsResponse xmlns="%s">' % (ELB_NAMESPACE,),
+        '<DescribeTagsResult>',
+        '<TagDescriptions>',
+    ]
+    
+    for load_balancer in load_balancers:
+        output.append("<member><LoadBalancerName>%s</LoadBalancerName><Tags>" % (escape(load_balancer.name),))
+        for key, value in sorted(load_balancer.tags.items()):
+            output.append("<member><Key>%s</Key><Value>%s</Value></member>" % (escape(key), escape(value)))
+        output.append("</Tags></member>")
+    
+    output.append('</TagDescriptions>')
+    output.append('</DescribeTagsResult>')
+    output.append('</DescribeTagsResponse>')
+    
+    return "\n".join(output)
+
+def render_error(code, message):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<Response><Errors><Error><Code>%s</Code><Message>%s</Message></Error></Errors>'
+        '<RequestID>fake</RequestID></Response>'
+    ) % (escape(code), escape(message))
+
+class FakeEC2(resource.Resource):
+    """
+    twisted.web resource that answers DescribeInstances requests.
+    
+    instances - list of instances (see load())
+    latency - seconds to wait before responding.
+    load_balancers - list of awsdns.elb.LoadBalancers, or None.
+    """
+    
+    isLeaf = True
+    
+    instances = None
+    load_balancers = None
+    latency = 0
+    requests = 0
+    
+    def __init__(self, instances, latency=0, clock=None, load_balancers=None):
+        resource.Resource.__init__(self)
+        self.instances = instances
+        self.load_balancers = load_balancers or []
+        self.latency = latency
+        self.clock = clock or reactor
+        self._indexes = {}
+    
+    def candidates(self, filters):
+        """
+        Narrow down the instances that could match filters, using an index
+        on the first filter without wildcards - so large (e.g. synthetic())
+        inventories don't have to be scanned on every request.
+        """
+        for name, values in filters.items():
+            if [v for v in values if '*' in v or '?' in v]:
+                continue
+            
+            try:
+                index = self._indexes[name]
+            except KeyError:
+                index = self._indexes[name] = {}
+                for instance in self.instances:
+                    value = util.filter_value(instance, name)
+                    if value is not None:
+                        index.setdefault(str(value), []).append(instance)
+            
+            output = []
+            for value in sorted(set(values)):
+                output.extend(index.get(value, []))
+            return output
+        
+        return self.instances
+    
+    def parse_filters(self, args):
+        filters = {}
+        
+        for key in args:
+            match = re.match(r'^Filter\.(\d+)\.Name$', key)
+            if not match:
+                continue
+            
+            prefix = "Filter.%s.Value." % (match.group(1),)
+            values = [args[k][0] for k in args if k.startswith(prefix)]
+            filters[args[key][0]] = values
+        
+        return filters
+    
+    def respond_elb(self, request):
+        args = request.args
+        action = args['Action'][0]
+        
+        if action == 'DescribeTags':
+            names = [args[key][0] for key in args if key.startswith('LoadBalancerNames.member.')]
+            return render_describe_tags([lb for lb in self.load_balancers if lb.name in names])
+        
+        start = int(args.get('Marker', ['0'])[0])
+        page = self.load_balancers[start:start + ELB_PAGE_SIZE]
+        
+        next_marker = None
+        if start + ELB_PAGE_SIZE < len(self.load_balancers):
+            next_marker = str(start + ELB_PAGE_SIZE)
+        
+        return render_describe_load_balancers(page, next_marker)
+    
+    def respond(self, request):
+        args = request.args
+        action = args.get('Action', [None])[0]
+        
+        if action in ('DescribeLoadBalancers', 'DescribeTags'):
+            return self.respond_elb(request)
+        
+        if action != 'DescribeInstances':
+            request.setResponseCode(400)
+            return render_error("InvalidAction", "Only DescribeInstances, DescribeLoadBalancers and DescribeTags are supported")
+        
+        filters = self.parse_filters(args)
+        found = [instance for instance in self.candidates(filters) if util.matches(instance, filters)]
+        
+        start = int(args.get('NextToken', ['0'])[0])
+        
+        try:
+            max_results = int(args['MaxResults'][0])
+        except KeyError:
+            max_results = len(found)
+        
+        page = found[start:start + max_results]
+        next_token = None
+        if start + max_results < len(found):
+            next_token = str(start + max_results)
+        
+        return render_describe_instances(page, next_token)
+    
+    def render_GET(self, request):
+        self.requests += 1
+        request.setHeader("Content-Type", "text/xml;charset=UTF-8")
+        
+        if not self.latency:
+            return self.respond(request)
+        
+        def respond():
+            request.write(self.respond(request))
+            request.finish()
+        
+        d = task.deferLater(self.clock, self.latency, respond)
+        # the client went away - nothing to do
+        d.addErrback(lambda failure: None)
+        
+        return server.NOT_DONE_YET
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve canned DescribeInstances responses.")
+    parser.add_argument("response", nargs="?", help="a DescribeInstances response (XML) to load instances from")
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N",
+        help="make up N instances (host0, host1, ...) instead of loading them")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--interface", default="127.0.0.1")
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before each response")
+    args = parser.parse_args()
+    
+    if args.synthetic:
+        instances = synthetic(args.synthetic)
+    elif args.response:
+        instances = load(args.response)
+    else:
+        parser.error("give a response to load, or --synthetic")
+    
+    print "Serving %s instances on http://%s:%s/" % (len(instances), args.interface, args.port)
+    
+    site = server.Site(FakeEC2(instances, args.latency))
+    reactor.listenTCP(args.port, site, interface=args.interface)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Forwarding cache - keeps answers from the upstream DNS server for as long as
+their records say they can be kept.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.names import dns, error
+
+import collections
+
+import tx_logging
+
+def negative_ttl(authority):
+    """
+    Return how long a negative answer can be cached for, from the SOA record
+    in its authority section (the lower of the record's TTL and its minimum
+    field, as in RFC 2308), or None if there isn't one.
+    """
+    for record in authority:
+        if record.type == dns.SOA:
+            return min(record.ttl, record.payload.minimum)
+    
+    return None
+
+def message_ttl(message, default=None):
+    """
+    Return how long a message (a tuple of answer, authority and additional
+    lists) can be cached for - the lowest TTL of its answers, or for a
+    message with no answers, its negative_ttl(). Returns default if neither
+    can be worked out.
+    """
+    answers, authority, additional = message
+    
+    if answers:
+        return min([record.ttl for record in answers])
+    
+    ttl = negative_ttl(authority)
+    if ttl is None:
+        return default
+    
+    return ttl
+
+def age_records(records, elapsed):
+    """
+    Return copies of records, with elapsed seconds taken off their TTLs.
+    """
+    return [
+        dns.RRHeader(
+            record.name.name, record.type, record.cls,
+            max(0, record.ttl - elapsed), record.payload, record.auth
+        )
+        for record in records
+    ]
+
+def cap_records(records, ttl):
+    """
+    Return copies of records, with no TTL above ttl.
+    """
+    return [
+        dns.RRHeader(
+            record.name.name, record.type, record.cls,
+            min(record.ttl, ttl), record.payload, record.auth
+        )
+        for record in records
+    ]
+
+class ForwardingCache(object):
+    """
+    Caches answers from the upstream DNS server, keyed by (name, class,
+    type) - names are case-insensitive.
+    
+    Answers are kept for the lowest TTL of their records. Negative answers
+    (NXDOMAIN, or no records) are kept for the time given by the SOA record
+    upstream sends with them, capped at negative_ttl; they aren't kept at all
+    if there's no SOA. When served, TTLs are reduced by the time the answer
+    has been cached.
+    
+    Once there are more than size answers, the least recently used are
+    dropped.
+    
+    size - maximum number of answers to keep.
+    negative_ttl - maximum number of seconds to keep a negative answer.
+    """
+    
+    _entries = None
+    size = None
+    negative_ttl = None
+    clock = None
+    log = None
+    hits = 0
+    misses = 0
+    
+    def __init__(self, size=10000, negative_ttl=60, clock=None):
+        self._entries = collections.OrderedDict()
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.clock = clock or reactor
+        self.log = tx_logging.getLogger("awsdns:forward")
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def key(self, name, cls, type):
+        return (str(name).lower(), cls, type)
+    
+    def get(self, name, cls, type):
+        """
+        Return a deferred that fires with the cached answer (or fails with
+        DNSNameError, for a cached NXDOMAIN), or None if there isn't one.
+        """
+        key = self.key(name, cls, type)
+        
+        try:
+            stored, expires, message, nxdomain = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        
+        now = self.clock.seconds()
+        if expires <= now:
+            self.misses += 1
+            return None
+        
+        # most recently used goes at the end
+        self._entries[key] = (stored, expires, message, nxdomain)
+        self.hits += 1
+        
+        if nxdomain:
+            return defer.fail(error.DNSNameError(message))
+        
+        elapsed = int(now - stored)
+        return defer.succeed(tuple([age_records(section, elapsed) for section in message]))
+    
+    def put(self, name, cls, type, message, nxdomain=False):
+        """
+        Cache an answer - a tuple of answer, authority and additional lists,
+        or for an NXDOMAIN, the dns.Message that came with it.
+        """
+        if nxdomain:
+            ttl = negative_ttl(message.authority)
+        else:
+            ttl = message_ttl(message)
+        
+        if ttl is None:
+            return
+        
+        if nxdomain or not message[0]:
+            ttl = min(ttl, self.negative_ttl)
+        
+        if ttl <= 0:
+            return
+        
+        self.log.debug("Caching %s %s for %ss" % (name, dns.QUERY_TYPES.get(type, type), ttl))
+        
+        key = self.key(name, cls, type)
+        now = self.clock.seconds()
+        
+        self._entries.pop(key, None)
+        self._entries[key] = (now, now + ttl, message, nxdomain)
+        
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+    
+    def lookup(self, name, cls, type, query):
+        """
+        Return the cached answer for a query, or call query (a function that
+        takes name, cls and type, and returns a deferred answer - e.g. 
+        twisted.names.client.Resolver._lookup) and cache the result.
+        """
+        d = self.get(name, cls, type)
+        if d is not None:
+            return d
+        
+        d = defer.maybeDeferred(query, name, cls, type)
+        
+        def found(message):
+            self.put(name, cls, type, message)
+            return message
+        
+        def failed(failure):
+            failure.trap(error.DNSNameError)
+            
+            message = failure.value.args and failure.value.args[0]
+            if isinstance(message, dns.Message):
+                self.put(name, cls, type, message, nxdomain=True)
+            
+            return failure
+        
+        d.addCallbacks(found, failed)
+        
+        return d
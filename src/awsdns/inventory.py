@@ -0,0 +1,247 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Inventory - an in-memory index of every instance in the region.
+"""
+
+from twisted.internet import task
+
+import time
+
+import tx_logging
+
+import util
+
+class Inventory(object):
+    """
+    Keeps a copy of every instance in the region, indexed by the forward
+    property (e.g. tag:Name) and the reverse property (e.g. private_ip_address).
+    
+    The index is built from a single, paginated DescribeInstances sweep,
+    instead of one filtered call per lookup. Sweeps happen at startup, and
+    then every interval seconds.
+    
+    Each index maps a value to a list of instances, so lookups are simple
+    dictionary access (instances maps the instance id to the instance):
+    
+        forward = {'bootstrapper-test': [Instance:i-d20eee82]}
+        reverse = {'172.31.31.48': [Instance:i-d20eee82]}
+    
+    ec2 - an EC2 client (see awsdns.ec2client).
+    forward_prop, reverse_prop - tags or properties to index (see
+                                 util.tag_or_property)
+    interval - number of seconds between sweeps.
+    page_size - number of reservations to request per API call.
+    fold_case - set to True to index forward values lower-cased, so 
+                lookups are case-insensitive (see routing.Canonicalizer).
+    """
+    
+    _ec2 = None
+    _loop = None
+    forward = None
+    reverse = None
+    instances = None
+    forward_prop = None
+    reverse_prop = None
+    interval = None
+    page_size = None
+    fold_case = False
+    loaded = False
+    last_sweep = None
+    log = None
+    
+    def __init__(self, ec2, forward_prop, reverse_prop, interval=300, page_size=1000, fold_case=False):
+        self._ec2 = ec2
+        self.forward_prop = forward_prop
+        self.reverse_prop = reverse_prop
+        self.interval = interval
+        self.page_size = page_size
+        self.fold_case = fold_case
+        self.forward = {}
+        self.reverse = {}
+        self.instances = {}
+        self.log = tx_logging.getLogger("awsdns:inventory")
+    
+    def _fetch(self, filters=None):
+        """
+        Page through every reservation in the region (optionally limited by 
+        filters). Returns a deferred.
+        """
+        d = self._ec2.get_all_pages(filters, self.page_size)
+        
+        def fetched(reservations):
+            self.log.debug("Fetched %s reservations" % (len(reservations),))
+            return reservations
+        
+        d.addCallback(fetched)
+        
+        return d
+    
+    def _signature(self, instance):
+        """
+        The parts of an instance that affect the indexes. Used to tell if an 
+        instance has changed.
+        """
+        return (
+            getattr(instance, 'state', None),
+            util.tag_or_property(instance, self.forward_prop),
+            util.tag_or_property(instance, self.reverse_prop),
+        )
+    
+    def _forward_key(self, value):
+        """
+        The key a forward value is indexed under.
+        """
+        value = util.encode(value)
+        
+        if self.fold_case:
+            return value.lower()
+        
+        return value
+    
+    def _add(self, forward, reverse, instance):
+        """
+        Add a single instance to the given indexes.
+        """
+        if getattr(instance, 'state', None) in ('shutting-down', 'terminated'):
+            return
+        
+        forward_value = util.tag_or_property(instance, self.forward_prop)
+        if forward_value:
+            forward.setdefault(self._forward_key(forward_value), []).append(instance)
+        
+        reverse_value = util.tag_or_property(instance, self.reverse_prop)
+        if reverse_value:
+            reverse.setdefault(util.encode(reverse_value), []).append(instance)
+    
+    def _discard(self, index, value, instance_id):
+        """
+        Remove an instance from a single index entry.
+        """
+        if not value:
+            return
+        
+        value = util.encode(value)
+        remaining = [i for i in index.get(value, []) if i.id != instance_id]
+        
+        if remaining:
+            index[value] = remaining
+        else:
+            index.pop(value, None)
+    
+    def _remove(self, instance):
+        """
+        Remove an instance from the indexes, using the values it was indexed
+        under.
+        """
+        forward_value = util.tag_or_property(instance, self.forward_prop)
+        self._discard(self.forward, forward_value and self._forward_key(forward_value), instance.id)
+        self._discard(self.reverse, util.tag_or_property(instance, self.reverse_prop), instance.id)
+        del self.instances[instance.id]
+    
+    def apply(self, instances):
+        """
+        Patch the indexes in place with a list of changed instances, instead
+        of rebuilding them.
+        
+        Instances that are new, or whose state or indexed values differ from 
+        the ones already in the index are re-indexed; terminated instances 
+        are dropped.
+        
+        Returns the number of instances that actually changed.
+        """
+        changes = 0
+        
+        for instance in instances:
+            current = self.instances.get(instance.id)
+            
+            if current is not None:
+                if self._signature(current) == self._signature(instance):
+                    # pick up any other changes (e.g. extra tags)
+                    self._remove(current)
+                    self._add(self.forward, self.reverse, instance)
+                    self.instances[instance.id] = instance
+                    continue
+                self._remove(current)
+                
+                if getattr(instance, 'state', None) in ('shutting-down', 'terminated'):
+                    # gone
+                    changes += 1
+                    continue
+            elif getattr(instance, 'state', None) in ('shutting-down', 'terminated'):
+                continue
+            
+            self._add(self.forward, self.reverse, instance)
+            self.instances[instance.id] = instance
+            changes += 1
+        
+        return changes
+    
+    def rebuild(self, reservations):
+        """
+        Replace the indexes with ones built from the given reservation list.
+        
+        The new indexes are built off to the side and swapped in, so lookups
+        never see a partially built index.
+        """
+        forward = {}
+        reverse = {}
+        instances = {}
+        
+        for instance in util.instances(reservations):
+            if getattr(instance, 'state', None) in ('shutting-down', 'terminated'):
+                continue
+            
+            self._add(forward, reverse, instance)
+            instances[instance.id] = instance
+        
+        self.forward = forward
+        self.reverse = reverse
+        self.instances = instances
+        self.loaded = True
+        self.last_sweep = time.time()
+        
+        self.log.info("Inventory rebuilt: %s names, %s addresses" % (len(forward), len(reverse)))
+        
+        return self
+    
+    def sweep(self):
+        """
+        Fetch every instance in the region and rebuild the indexes.
+        
+        Returns a deferred. Failures are logged, and the previous indexes are
+        left in place.
+        """
+        d = self._fetch()
+        d.addCallback(self.rebuild)
+        
+        def failed(failure):
+            self.log.error("Inventory sweep failed: %s" % (failure.getErrorMessage(),))
+        
+        d.addErrback(failed)
+        
+        return d
+    
+    def start(self):
+        """
+        Sweep now, and every interval seconds after that.
+        """
+        self._loop = task.LoopingCall(self.sweep)
+        return self._loop.start(self.interval, now=True)
+    
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+    
+    def lookup_forward(self, value):
+        """
+        Return the list of instances whose forward property matches value.
+        """
+        return self.forward.get(self._forward_key(value), [])
+    
+    def lookup_reverse(self, value):
+        """
+        Return the list of instances whose reverse property matches value.
+        """
+        return self.reverse.get(value, [])
+
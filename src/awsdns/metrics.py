@@ -0,0 +1,332 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Metrics - counters and latency histograms, served over HTTP in the
+Prometheus text format.
+"""
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+import bisect
+
+from awsdns.ec2client import EC2Client
+
+# seconds - from a cache hit to a slow EC2 call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (name, value))
+    
+    return "{%s}" % (",".join(pairs),)
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return value and "1" or "0"
+    return repr(float(value))
+
+class Metric(object):
+    """
+    Base class - a named, documented metric, with optional labels.
+    """
+    
+    type = None
+    name = None
+    help = None
+    labels = ()
+    
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+    
+    def samples(self):
+        """
+        Return a list of (suffix, label names, label values, value) tuples.
+        """
+        raise NotImplementedError
+    
+    def render(self):
+        output = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        
+        for suffix, names, values, value in self.samples():
+            output.append("%s%s%s %s" % (self.name, suffix, format_labels(names, values), format_value(value)))
+        
+        return "\n".join(output)
+
+class Counter(Metric):
+    """
+    A count that only goes up. inc() takes a value for each label.
+    """
+    
+    type = 'counter'
+    
+    def __init__(self, name, help, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self._values = {}
+    
+    def inc(self, *values):
+        self._values[values] = self._values.get(values, 0) + 1
+    
+    def samples(self):
+        return [("", self.labels, values, value) for values, value in sorted(self._values.items())]
+
+class Callback(Metric):
+    """
+    A counter or gauge whose value is read when it's scraped - for numbers
+    that are already kept elsewhere (e.g. ResolverCache.hits).
+    
+    function returns a number, or if there are labels, a dictionary mapping
+    tuples of label values to numbers.
+    """
+    
+    def __init__(self, name, help, type, function, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.type = type
+        self.function = function
+    
+    def samples(self):
+        value = self.function()
+        
+        if not self.labels:
+            return [("", (), (), value)]
+        
+        return [("", self.labels, values, v) for values, v in sorted(value.items())]
+
+class Histogram(Metric):
+    """
+    Counts observations (e.g. latencies, in seconds) into buckets.
+    """
+    
+    type = 'histogram'
+    clock = None
+    
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, clock=None):
+        Metric.__init__(self, name, help)
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.clock = clock or reactor
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def time(self, d):
+        """
+        Observe the time until deferred d fires. Returns d.
+        """
+        started = self.clock.seconds()
+        
+        def done(result):
+            self.observe(self.clock.seconds() - started)
+            return result
+        
+        return d.addBoth(done)
+    
+    def samples(self):
+        output = []
+        total = 0
+        
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            output.append(("_bucket", ("le",), (repr(float(bound)),), total))
+        
+        output.append(("_bucket", ("le",), ("+Inf",), self.count))
+        output.append(("_sum", (), (), self.sum))
+        output.append(("_count", (), (), self.count))
+        
+        return output
+
+class Registry(object):
+    """
+    A collection of metrics, rendered together.
+    """
+    
+    def __init__(self):
+        self.metrics = []
+    
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+    
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+    
+    def callback(self, name, help, type, function, labels=()):
+        return self.add(Callback(name, help, type, function, labels))
+    
+    def render(self):
+        return "\n".join([metric.render() for metric in self.metrics]) + "\n"
+
+class ResolverMetrics(Registry):
+    """
+    The metrics for an EC2Resolver.
+    
+    Counters and histograms that the resolver updates itself are attributes;
+    everything its parts already count (the caches, rate limiter, upstream
+    pool, etc) is read from them when scraped.
+    """
+    
+    def __init__(self, resolver):
+        Registry.__init__(self)
+        
+        self.queries = self.counter(
+            "awsdns_queries_total", "Queries, by record type.", ("type",))
+        self.resolutions = self.counter(
+            "awsdns_resolutions_total",
+            "Lookups that missed the cache, by where the answer came from.", ("source",))
+        self.response_latency = self.histogram(
+            "awsdns_response_seconds", "Time to answer a query, including cache hits.")
+        self.upstream_latency = self.histogram(
+            "awsdns_upstream_lookup_seconds", "Time to get an answer from the upstream DNS servers.")
+        self.ec2_latency = self.histogram(
+            "awsdns_ec2_call_seconds", "Time taken by EC2 API calls (not counting rate limiting).")
+        
+        cache = lambda: resolver.cache.stats()
+        
+        self.callback(
+            "awsdns_cache_requests_total", "Resolver cache requests, by outcome.", "counter",
+            lambda: dict([
+                ((result,), cache()[key]) for result, key in (
+                    ("hit", 'hits'),
+                    ("miss", 'misses'),
+                    ("coalesced", 'coalesced'),
+                    ("stale", 'stale_hits'),
+                    ("negative", 'negative_hits'),
+                )
+            ]),
+            ("result",)
+        )
+        self.callback(
+            "awsdns_cache_entries", "Entries in the resolver cache.", "gauge",
+            lambda: {
+                ("positive",): cache()['entries'],
+                ("negative",): cache()['negative_entries'],
+            },
+            ("kind",)
+        )
+        
+        def forward_cache():
+            if resolver.forward_cache is None:
+                return {}
+            return {
+                ("hit",): resolver.forward_cache.hits,
+                ("miss",): resolver.forward_cache.misses,
+            }
+        
+        self.callback(
+            "awsdns_forward_cache_requests_total", "Forwarding cache requests, by outcome.", "counter",
+            forward_cache, ("result",)
+        )
+        
+        def limiters(key):
+            return dict([
+                ((region,), limiter.stats()[key]) for region, limiter in resolver.limiters.items()
+            ])
+        
+        self.callback(
+            "awsdns_api_calls_total", "EC2 API calls started, by region.", "counter",
+            lambda: limiters('calls'), ("region",))
+        self.callback(
+            "awsdns_api_throttled_total", "EC2 API calls throttled by AWS, by region.", "counter",
+            lambda: limiters('throttled'), ("region",))
+        self.callback(
+            "awsdns_api_queue_depth", "EC2 API calls waiting for the rate limiter, by region.", "gauge",
+            lambda: limiters('depth'), ("region",))
+        self.callback(
+            "awsdns_api_active", "EC2 API calls in flight, by region.", "gauge",
+            lambda: limiters('active'), ("region",))
+        self.callback(
+            "awsdns_api_rate", "Current EC2 API call rate limit per second, by region.", "gauge",
+            lambda: limiters('rate'), ("region",))
+        self.callback(
+            "awsdns_batched_lookups_total", "EC2 lookups sent through the batcher.", "counter",
+            lambda: resolver.batcher.lookups)
+        
+        upstreams = lambda: resolver.upstreams.stats()
+        
+        self.callback(
+            "awsdns_upstream_srtt_seconds", "Smoothed round trip time, by upstream DNS server.", "gauge",
+            lambda: dict([((s['address'],), s['srtt']) for s in upstreams()]), ("upstream",))
+        self.callback(
+            "awsdns_upstream_healthy", "1 if an upstream DNS server is in use, 0 if it's been ejected.", "gauge",
+            lambda: dict([((s['address'],), s['healthy']) for s in upstreams()]), ("upstream",))
+        self.callback(
+            "awsdns_upstream_hedges_total", "Queries also sent to a second upstream DNS server.", "counter",
+            lambda: resolver.upstreams.hedges)
+        
+        def inventory():
+            if resolver.inventory is None:
+                return {}
+            return {
+                ("names",): len(resolver.inventory.forward),
+                ("addresses",): len(resolver.inventory.reverse),
+            }
+        
+        self.callback(
+            "awsdns_inventory_size", "Names and addresses in the inventory.", "gauge",
+            inventory, ("index",))
+        
+        def elb_index():
+            if resolver.elb_index is None:
+                return 0
+            return len(resolver.elb_index.load_balancers)
+        
+        self.callback(
+            "awsdns_elb_index_size", "Load balancers in the ELB index.", "gauge", elb_index)
+
+class TimedEC2Client(EC2Client):
+    """
+    Records how long each of an EC2 client's calls take, in histogram.
+    """
+    
+    def __init__(self, client, histogram):
+        self.client = client
+        self.histogram = histogram
+    
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        d = self.client.get_all_reservations(
+            filters=filters,
+            max_results=max_results,
+            next_token=next_token
+        )
+        return self.histogram.time(d)
+
+class MetricsResource(resource.Resource):
+    """
+    twisted.web resource that serves a Registry in the Prometheus text
+    format.
+    """
+    
+    isLeaf = True
+    
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+    
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return self.registry.render()
+
+def listen(port, registry, interface='127.0.0.1'):
+    """
+    Serve registry over HTTP, on the given port.
+    """
+    return reactor.listenTCP(port, server.Site(MetricsResource(registry)), interface=interface)
@@ -0,0 +1,218 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Rate limiting for calls to the AWS API.
+"""
+
+from twisted.internet import defer, reactor
+
+import heapq
+import itertools
+import random
+
+import tx_logging
+
+from awsdns.ec2client import EC2Client
+
+# lower numbers go first
+PRIORITY_QUERY = 0
+PRIORITY_BACKGROUND = 10
+
+# error codes AWS uses when it's throttling requests
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+def is_throttled(failure):
+    """
+    Returns True if failure is AWS telling us to slow down.
+    """
+    error = failure.value
+    return (
+        getattr(error, 'error_code', None) in THROTTLE_CODES or
+        getattr(error, 'status', None) == 503
+    )
+
+class RateLimiter(object):
+    """
+    Runs calls through a token bucket, with a cap on the number in flight.
+    
+    Calls are queued by priority (lower first, then first come, first
+    served), and started as tokens and concurrency allow. Tokens are added
+    at rate per second, up to burst.
+    
+    When a call is throttled by AWS, no further calls are started for a
+    random delay (exponential backoff with full jitter), the rate is halved,
+    and the call is retried at the front of its priority. Each successful
+    call afterwards nudges the rate back up, so the limiter settles just
+    under whatever AWS will tolerate.
+    
+    rate - calls per second.
+    burst - maximum number of calls that can be started at once, after a
+            quiet period.
+    concurrency - maximum number of calls in flight.
+    retries - number of times to retry a throttled call before giving up.
+    backoff - base delay for backing off, in seconds.
+    max_backoff - maximum delay, in seconds.
+    """
+    
+    rate = None
+    max_rate = None
+    min_rate = None
+    burst = None
+    concurrency = None
+    retries = None
+    backoff = None
+    max_backoff = None
+    clock = None
+    log = None
+    
+    def __init__(self, rate=20, burst=40, concurrency=10, retries=5, backoff=0.5,
+                 max_backoff=30, clock=None):
+        self.rate = self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 32
+        self.burst = burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock or reactor
+        self.log = tx_logging.getLogger("awsdns:ratelimit")
+        
+        self._queue = []
+        self._counter = itertools.count()
+        self._tokens = float(burst)
+        self._updated = self.clock.seconds()
+        self._paused_until = 0
+        self._wakeup = None
+        self._failures = 0
+        
+        self.active = 0
+        self.calls = 0
+        self.throttled = 0
+        self.max_depth = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+    
+    def stats(self):
+        """
+        Return a dictionary of statistics - current queue depth and calls
+        in flight, totals, and how long calls waited in the queue.
+        """
+        return {
+            'depth': len(self._queue),
+            'max_depth': self.max_depth,
+            'active': self.active,
+            'calls': self.calls,
+            'throttled': self.throttled,
+            'rate': self.rate,
+            'wait_avg': self.waits and self.wait_total / self.waits or 0.0,
+            'wait_max': self.wait_max,
+        }
+    
+    def submit(self, priority, f, *args, **kwargs):
+        """
+        Queue a call to f. Returns a deferred that fires with its result,
+        once it has been run.
+        """
+        d = defer.Deferred()
+        job = [priority, next(self._counter), self.clock.seconds(), 0, d, f, args, kwargs]
+        
+        heapq.heappush(self._queue, job)
+        self.max_depth = max(self.max_depth, len(self._queue))
+        
+        self._dispatch()
+        
+        return d
+    
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def _schedule(self, delay):
+        """
+        Try dispatching again after delay seconds.
+        """
+        if self._wakeup is not None and self._wakeup.active():
+            return
+        
+        self._wakeup = self.clock.callLater(delay, self._dispatch)
+    
+    def _dispatch(self):
+        now = self.clock.seconds()
+        
+        while self._queue and self.active < self.concurrency:
+            if now < self._paused_until:
+                self._schedule(self._paused_until - now)
+                return
+            
+            self._refill(now)
+            if self._tokens < 1:
+                self._schedule((1 - self._tokens) / self.rate)
+                return
+            
+            self._tokens -= 1
+            job = heapq.heappop(self._queue)
+            
+            wait = now - job[2]
+            self.waits += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            
+            self._run(job)
+    
+    def _run(self, job):
+        priority, seq, queued, attempt, d, f, args, kwargs = job
+        
+        self.active += 1
+        self.calls += 1
+        
+        call = defer.maybeDeferred(f, *args, **kwargs)
+        
+        def succeeded(result):
+            self.active -= 1
+            self._failures = 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            d.callback(result)
+            self._dispatch()
+        
+        def failed(failure):
+            self.active -= 1
+            
+            if not is_throttled(failure) or attempt >= self.retries:
+                d.errback(failure)
+                self._dispatch()
+                return
+            
+            self.throttled += 1
+            self._failures += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** self._failures))
+            self._paused_until = max(self._paused_until, self.clock.seconds() + delay)
+            
+            self.log.warning("Throttled by AWS - backing off for %.2fs, rate now %.2f/s" % (delay, self.rate))
+            
+            # keep its place in line
+            heapq.heappush(self._queue, [priority, seq, queued, attempt + 1, d, f, args, kwargs])
+            self._dispatch()
+        
+        call.addCallbacks(succeeded, failed)
+
+class LimitedEC2Client(EC2Client):
+    """
+    Sends an EC2 client's calls through a RateLimiter, at the given priority.
+    """
+    
+    def __init__(self, client, limiter, priority=PRIORITY_QUERY):
+        self.client = client
+        self.limiter = limiter
+        self.priority = priority
+    
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        return self.limiter.submit(
+            self.priority,
+            self.client.get_all_reservations,
+            filters=filters,
+            max_results=max_results,
+            next_token=next_token
+        )
@@ -6,15 +6,28 @@ Resolver - the "meat" of the server
 
 from twisted.internet.protocol import Factory, Protocol
 from twisted.names import client, server, dns, error
-from twisted.internet import defer, threads
+from twisted.internet import defer
 
 import datetime
+import socket
 
 from twisted.python import log, failure
 
-import boto.ec2
-
 from awsdns.cache import ResolverCache
+from awsdns.ec2client import BotoEC2Client, AsyncEC2Client, MultiRegionEC2Client
+from awsdns.static import StaticEC2Client
+from awsdns.elb import AsyncELBClient, LoadBalancerIndex
+from awsdns.batch import LookupBatcher
+from awsdns.ratelimit import RateLimiter, LimitedEC2Client, PRIORITY_QUERY, PRIORITY_BACKGROUND
+from awsdns.inventory import Inventory
+from awsdns.sync import InventorySync, EventFeed
+from awsdns.snapshot import Snapshot
+from awsdns.routing import Router, Canonicalizer, ROUTE_EC2, ROUTE_UPSTREAM
+from awsdns.reverse import ReverseAuthority, AuthoritativeNameError
+from awsdns.forward import ForwardingCache, message_ttl
+from awsdns.upstream import UpstreamPool
+from awsdns.metrics import ResolverMetrics, TimedEC2Client
+from awsdns import compact, util
 
 import ConfigParser
 
@@ -31,39 +44,261 @@ class EC2Resolver(client.Resolver):
     
     aws_access_key_id = None
     aws_secret_access_key = None
-    aws_region = None
+    aws_regions = None
     config = None
     forward_cache = None
     reverse_cache = None
     ttl = None
+    extra_additional = None
     autorefresh = None
+    inventory = None
+    inventory_enabled = None
+    inventory_interval = None
+    inventory_sync = None
+    inventory_sync_interval = None
+    inventory_events = None
+    elb = None
+    elb_index = None
+    elb_keys = None
+    elb_interval = None
+    elb_endpoint = None
+    negative_ttl = None
+    negative_size = None
+    stale_grace = None
+    compact_cache = None
+    inventory_gate = None
+    ec2_client = None
+    ec2_endpoint = None
+    static = None
+    inventory_file = None
+    inventory_file_interval = None
+    limiters = None
+    api_rate = None
+    api_burst = None
+    api_concurrency = None
+    api_retries = None
+    batcher = None
+    batch_window = None
+    batch_size = None
+    wire_cache = None
+    snapshot = None
+    snapshot_path = None
+    snapshot_interval = None
+    worker = False
+    router = None
+    zones = None
+    networks = None
+    search_suffixes = None
+    authoritative_reverse = None
+    reverse_authority = None
+    soa_mname = None
+    soa_rname = None
+    fold_case = None
+    canonicalizer = None
+    spellings = None
+    forward_cache = None
+    forward_cache_size = None
+    upstreams = None
+    upstream_timeout = None
+    upstream_max_failures = None
+    upstream_probe_interval = None
+    metrics = None
+    metrics_port = None
+    metrics_interface = None
+    admin_port = None
+    admin_interface = None
+    admin_token = None
+    wire_cache_size = None
     log = None
     
     def __init__(self, config, *args, **kwargs):
         self.config = config
         
+        # worker processes answer from the poller's snapshot only (see 
+        # awsdns.workers)
+        self.worker = kwargs.pop('worker', False)
+        
         self.parse_config()
         
-        self._ec2 = boto.ec2.connect_to_region(
-            self.aws_region, 
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key
+        self.metrics = ResolverMetrics(self)
+        
+        self.limiters = {}
+        
+        if self.ec2_client == 'file':
+            # the file is the whole inventory - nothing else is asked
+            self._ec2 = background = self.static = StaticEC2Client(
+                self.inventory_file,
+                interval=self.inventory_file_interval
+            )
+            self.static.load()
+            self.inventory_enabled = True
+        else:
+            queries = {}
+            background = {}
+            
+            for region in self.aws_regions:
+                ec2 = TimedEC2Client(self.make_client(region), self.metrics.ec2_latency)
+                
+                # every call to AWS goes through the region's limiter - 
+                # lookups for clients ahead of background work
+                limiter = self.limiters[region] = RateLimiter(
+                    rate=self.api_rate,
+                    burst=self.api_burst,
+                    concurrency=self.api_concurrency,
+                    retries=self.api_retries
+                )
+                
+                queries[region] = LimitedEC2Client(ec2, limiter, PRIORITY_QUERY)
+                background[region] = LimitedEC2Client(ec2, limiter, PRIORITY_BACKGROUND)
+            
+            # every region is asked at once, and the answers merged - a 
+            # region that's down only fails lookups for its own instances, 
+            # but fails a whole sweep, so its instances aren't dropped
+            self._ec2 = MultiRegionEC2Client(queries, partial=True)
+            background = MultiRegionEC2Client(background)
+        
+        self.batcher = LookupBatcher(
+            self._ec2,
+            window=self.batch_window,
+            size=self.batch_size,
+            fold_case=self.fold_case
         )
         
-        self.cache = ResolverCache(self._lookup_wrapper, self.autorefresh)
+        self.router = Router(self.zones, self.networks)
+        self.canonicalizer = Canonicalizer(self.search_suffixes, self.fold_case)
+        
+        # EC2 filters are case-sensitive, but cache keys are folded - so the
+        # case instances were found under is kept here (see _spelling())
+        self.spellings = {}
+        
+        if self.authoritative_reverse:
+            self.reverse_authority = ReverseAuthority(
+                self.networks,
+                self.soa_mname,
+                self.soa_rname,
+                ttl=self.negative_ttl or 60
+            )
+        
+        if self.elb:
+            self.elb_index = LoadBalancerIndex(
+                [
+                    (region, AsyncELBClient(
+                        region,
+                        self.aws_access_key_id,
+                        self.aws_secret_access_key,
+                        endpoint=self.elb_endpoint
+                    ))
+                    for region in self.aws_regions
+                ],
+                keys=self.elb_keys,
+                interval=self.elb_interval
+            )
+        
+        if self.forward_cache_size:
+            self.forward_cache = ForwardingCache(
+                self.forward_cache_size,
+                negative_ttl=self.negative_ttl
+            )
+        
+        self.cache = ResolverCache(
+            self._lookup_wrapper,
+            self.autorefresh,
+            negative_ttl=self.negative_ttl,
+            negative_size=self.negative_size,
+            stale_grace=self.stale_grace,
+            pack=self.compact_cache and compact.pack or None,
+            unpack=self.compact_cache and compact.unpack or None
+        )
+        
+        if self.inventory_enabled:
+            self.inventory = Inventory(
+                background,
+                self.forward_filter,
+                self.reverse_filter,
+                interval=self.inventory_interval,
+                fold_case=self.fold_case
+            )
+            
+            if self.static is not None:
+                # changes to the file are patched in as they're picked up
+                self.static.on_change = self.inventory.apply
+                self.inventory.sweep()
+            elif self.inventory_sync_interval and not self.worker:
+                feed = None
+                if self.inventory_events:
+                    feed = EventFeed(self.inventory_events)
+                
+                self.inventory_sync = InventorySync(
+                    self.inventory,
+                    interval=self.inventory_sync_interval,
+                    feed=feed
+                )
         
         self.log = tx_logging.getLogger("awsdns:resolver")
         
+        if self.snapshot_path:
+            self.snapshot = Snapshot(
+                self.snapshot_path,
+                self.cache,
+                self.inventory,
+                interval=self.snapshot_interval,
+                readonly=self.worker,
+                elb_index=self.elb_index
+            )
+            # come up warm - before the server starts listening
+            self.snapshot.load()
+        
         client.Resolver.__init__(self, *args, **kwargs)
+        
+        self.upstreams = UpstreamPool(
+            self.servers,
+            timeout=self.upstream_timeout,
+            max_failures=self.upstream_max_failures,
+            probe_interval=self.upstream_probe_interval
+        )
+    
+    def make_client(self, region):
+        """
+        Return a new EC2 client (see ec2_client) for region.
+        """
+        if self.ec2_client == 'async':
+            return AsyncEC2Client(
+                region,
+                self.aws_access_key_id,
+                self.aws_secret_access_key,
+                endpoint=self.ec2_endpoint
+            )
+        
+        return BotoEC2Client(
+            region, 
+            self.aws_access_key_id,
+            self.aws_secret_access_key
+        )
     
     def parse_config(self):
         """
         Parses the configuration, handles errors, sets defaults.
         """
         
-        self.aws_region = self.config.get('awsdns', 'aws_region')
-        self.aws_access_key_id = self.config.get('awsdns', 'aws_access_key_id')
-        self.aws_secret_access_key = self.config.get('awsdns', 'aws_secret_access_key')
+        try:
+            self.ec2_client = self.config.get('awsdns', 'ec2_client').lower()
+        except ConfigParser.NoOptionError:
+            self.ec2_client = 'boto'
+        
+        if self.ec2_client not in ('boto', 'async', 'file'):
+            raise ValueError, "ec2_client must be 'boto', 'async' or 'file', not '%s'" % (self.ec2_client)
+        
+        try:
+            self.aws_regions = self.config.get('awsdns', 'aws_region').split()
+            self.aws_access_key_id = self.config.get('awsdns', 'aws_access_key_id')
+            self.aws_secret_access_key = self.config.get('awsdns', 'aws_secret_access_key')
+        except ConfigParser.NoOptionError:
+            # not needed to read instances from a file
+            if self.ec2_client != 'file':
+                raise
+        
+        if self.ec2_client != 'file' and not self.aws_regions:
+            raise ValueError, "No aws_region given"
         
         try:
             self.forward_filter = self.config.get('awsdns', 'forward')
@@ -73,7 +308,7 @@ class EC2Resolver(client.Resolver):
         try:
             self.reverse_filter = self.config.get('awsdns', 'reverse')
         except ConfigParser.NoOptionError:
-            self.forward_filter = 'private_ip_address'
+            self.reverse_filter = 'private_ip_address'
         
         try:
             extra = self.config.get('awsdns', 'extra')
@@ -81,6 +316,92 @@ class EC2Resolver(client.Resolver):
         except ConfigParser.NoOptionError:
             self.extra = []
         
+        try:
+            self.extra_additional = self.config.getboolean('awsdns', 'extra_additional')
+        except ConfigParser.NoOptionError:
+            self.extra_additional = False
+        
+        try:
+            self.zones = self.config.get('awsdns', 'zones').split()
+        except ConfigParser.NoOptionError:
+            self.zones = []
+        
+        try:
+            self.networks = self.config.get('awsdns', 'networks').split()
+        except ConfigParser.NoOptionError:
+            self.networks = []
+        
+        try:
+            self.authoritative_reverse = self.config.getboolean('awsdns', 'authoritative_reverse')
+        except ConfigParser.NoOptionError:
+            self.authoritative_reverse = False
+        
+        if self.authoritative_reverse and not self.networks:
+            raise ValueError, "authoritative_reverse requires networks"
+        
+        try:
+            self.soa_mname = self.config.get('awsdns', 'soa_mname') or socket.getfqdn()
+        except ConfigParser.NoOptionError:
+            self.soa_mname = socket.getfqdn()
+        
+        try:
+            self.soa_rname = self.config.get('awsdns', 'soa_rname') or "hostmaster.%s" % (self.soa_mname,)
+        except ConfigParser.NoOptionError:
+            self.soa_rname = "hostmaster.%s" % (self.soa_mname,)
+        
+        try:
+            self.search_suffixes = self.config.get('awsdns', 'search_suffixes').split()
+        except ConfigParser.NoOptionError:
+            self.search_suffixes = []
+        
+        try:
+            self.forward_cache_size = self.config.getint('awsdns', 'forward_cache_size')
+        except ConfigParser.NoOptionError:
+            self.forward_cache_size = 10000
+        
+        try:
+            self.upstream_timeout = self.config.getfloat('awsdns', 'upstream_timeout')
+        except ConfigParser.NoOptionError:
+            self.upstream_timeout = 2.0
+        
+        try:
+            self.upstream_max_failures = self.config.getint('awsdns', 'upstream_max_failures')
+        except ConfigParser.NoOptionError:
+            self.upstream_max_failures = 3
+        
+        try:
+            self.upstream_probe_interval = self.config.getint('awsdns', 'upstream_probe_interval')
+        except ConfigParser.NoOptionError:
+            self.upstream_probe_interval = 10
+        
+        try:
+            self.metrics_port = self.config.getint('awsdns', 'metrics_port')
+        except ConfigParser.NoOptionError:
+            self.metrics_port = 0
+        
+        try:
+            self.metrics_interface = self.config.get('awsdns', 'metrics_interface')
+        except ConfigParser.NoOptionError:
+            self.metrics_interface = '127.0.0.1'
+        
+        try:
+            self.admin_port = self.config.getint('awsdns', 'admin_port')
+        except ConfigParser.NoOptionError:
+            self.admin_port = 0
+        
+        try:
+            self.admin_interface = self.config.get('awsdns', 'admin_interface')
+        except ConfigParser.NoOptionError:
+            self.admin_interface = '127.0.0.1'
+        
+        try:
+            self.admin_token = self.config.get('awsdns', 'admin_token').strip()
+        except ConfigParser.NoOptionError:
+            self.admin_token = None
+        
+        if self.admin_port and not self.admin_token:
+            raise ValueError, "admin_port requires admin_token"
+        
         try:
             self.autorefresh = self.config.getboolean('awsdns', 'autorefresh')
         except ConfigParser.NoOptionError:
@@ -90,6 +411,192 @@ class EC2Resolver(client.Resolver):
             self.ttl = self.config.getint('awsdns', 'ttl')
         except ConfigParser.NoOptionError:
             self.ttl = 3600
+        
+        try:
+            self.inventory_enabled = self.config.getboolean('awsdns', 'inventory')
+        except ConfigParser.NoOptionError:
+            self.inventory_enabled = False
+        
+        try:
+            self.fold_case = self.config.getboolean('awsdns', 'fold_case')
+        except ConfigParser.NoOptionError:
+            # EC2 filters are case-sensitive - only the inventory can look
+            # names up ignoring case
+            self.fold_case = self.inventory_enabled or self.ec2_client == 'file'
+        
+        try:
+            self.inventory_interval = self.config.getint('awsdns', 'inventory_interval')
+        except ConfigParser.NoOptionError:
+            self.inventory_interval = 300
+        
+        try:
+            self.inventory_sync_interval = self.config.getint('awsdns', 'inventory_sync_interval')
+        except ConfigParser.NoOptionError:
+            self.inventory_sync_interval = 0
+        
+        try:
+            self.inventory_events = self.config.get('awsdns', 'inventory_events')
+        except ConfigParser.NoOptionError:
+            self.inventory_events = None
+        
+        try:
+            self.elb = self.config.getboolean('awsdns', 'elb')
+        except ConfigParser.NoOptionError:
+            self.elb = False
+        
+        if self.elb and self.ec2_client == 'file':
+            raise ValueError, "elb can't be used with ec2_client 'file'"
+        
+        try:
+            self.elb_keys = self.config.get('awsdns', 'elb_keys').split()
+        except ConfigParser.NoOptionError:
+            self.elb_keys = ['name']
+        
+        try:
+            self.elb_interval = self.config.getint('awsdns', 'elb_interval')
+        except ConfigParser.NoOptionError:
+            self.elb_interval = 300
+        
+        try:
+            self.elb_endpoint = self.config.get('awsdns', 'elb_endpoint')
+        except ConfigParser.NoOptionError:
+            self.elb_endpoint = None
+        
+        try:
+            self.negative_ttl = self.config.getint('awsdns', 'negative_ttl')
+        except ConfigParser.NoOptionError:
+            self.negative_ttl = 60
+        
+        try:
+            self.negative_size = self.config.getint('awsdns', 'negative_size')
+        except ConfigParser.NoOptionError:
+            self.negative_size = 10000
+        
+        try:
+            self.stale_grace = self.config.getint('awsdns', 'stale_grace')
+        except ConfigParser.NoOptionError:
+            self.stale_grace = 0
+        
+        try:
+            self.compact_cache = self.config.getboolean('awsdns', 'compact_cache')
+        except ConfigParser.NoOptionError:
+            self.compact_cache = True
+        
+        try:
+            self.inventory_gate = self.config.getboolean('awsdns', 'inventory_gate')
+        except ConfigParser.NoOptionError:
+            self.inventory_gate = False
+        
+        try:
+            self.ec2_endpoint = self.config.get('awsdns', 'ec2_endpoint')
+        except ConfigParser.NoOptionError:
+            self.ec2_endpoint = None
+        
+        try:
+            self.inventory_file = self.config.get('awsdns', 'inventory_file')
+        except ConfigParser.NoOptionError:
+            self.inventory_file = None
+        
+        if self.ec2_client == 'file' and not self.inventory_file:
+            raise ValueError, "ec2_client 'file' requires inventory_file"
+        
+        try:
+            self.inventory_file_interval = self.config.getint('awsdns', 'inventory_file_interval')
+        except ConfigParser.NoOptionError:
+            self.inventory_file_interval = 5
+        
+        try:
+            self.api_rate = self.config.getfloat('awsdns', 'api_rate')
+        except ConfigParser.NoOptionError:
+            self.api_rate = 20
+        
+        try:
+            self.api_burst = self.config.getint('awsdns', 'api_burst')
+        except ConfigParser.NoOptionError:
+            self.api_burst = 40
+        
+        try:
+            self.api_concurrency = self.config.getint('awsdns', 'api_concurrency')
+        except ConfigParser.NoOptionError:
+            self.api_concurrency = 10
+        
+        try:
+            self.api_retries = self.config.getint('awsdns', 'api_retries')
+        except ConfigParser.NoOptionError:
+            self.api_retries = 5
+        
+        try:
+            self.batch_window = self.config.getfloat('awsdns', 'batch_window')
+        except ConfigParser.NoOptionError:
+            self.batch_window = 0.005
+        
+        try:
+            self.batch_size = self.config.getint('awsdns', 'batch_size')
+        except ConfigParser.NoOptionError:
+            self.batch_size = 50
+        
+        try:
+            self.wire_cache = self.config.getboolean('awsdns', 'wire_cache')
+        except ConfigParser.NoOptionError:
+            self.wire_cache = False
+        
+        try:
+            self.wire_cache_size = self.config.getint('awsdns', 'wire_cache_size')
+        except ConfigParser.NoOptionError:
+            self.wire_cache_size = 10000
+        
+        try:
+            self.snapshot_path = self.config.get('awsdns', 'snapshot')
+        except ConfigParser.NoOptionError:
+            self.snapshot_path = None
+        
+        try:
+            self.snapshot_interval = self.config.getint('awsdns', 'snapshot_interval')
+        except ConfigParser.NoOptionError:
+            self.snapshot_interval = 60
+    
+    def start(self):
+        """
+        Start any background work (e.g. inventory sweeps). Call once the 
+        reactor is running.
+        """
+        if self.inventory is not None and not self.worker:
+            self.inventory.start()
+        
+        if self.inventory_sync is not None:
+            self.inventory_sync.start()
+        
+        if self.elb_index is not None and not self.worker:
+            self.elb_index.start()
+        
+        if self.static is not None and not self.worker:
+            self.static.start()
+        
+        if self.snapshot is not None:
+            self.snapshot.start()
+        
+        self.upstreams.start()
+    
+    def stop(self):
+        """
+        Stop background work, saving a final snapshot. Call at shutdown.
+        """
+        if self.inventory_sync is not None:
+            self.inventory_sync.stop()
+        
+        if self.static is not None:
+            self.static.stop()
+        
+        if self.elb_index is not None:
+            self.elb_index.stop()
+        
+        if self.inventory is not None:
+            self.inventory.stop()
+        
+        if self.snapshot is not None:
+            self.snapshot.stop()
+        
+        self.upstreams.stop()
     
     def _tag_or_property(self, instance, check, default=None):
         """
@@ -101,21 +608,19 @@ class EC2Resolver(client.Resolver):
         
         Returns default if property or tag doesn't exist.
         """
-        if check.startswith("tag:"):
-            prefix, tag = check.split(":")
-            return instance.tags.get(tag, default)
-        else:
-            return getattr(instance, check, default)
+        return util.tag_or_property(instance, check, default)
     
-    def create_message(self, instances, name, prop, record=dns.A):
+    def create_message(self, instances, name, prop, record=dns.A, auth=False):
         """
         Construct a message to return to the client.
         
-        instances is a reservation list (the output from ec2_connection.get_all_instances)
+        instances is a list of instances (see util.instances)
         name is the query value
         prop is the property to inspect on each instance to return
         record is a constant that indicates what type of record to create in the 
-               payload.
+               payload. For dns.TXT, the answers are the extra properties,
+               and prop is ignored.
+        auth is True if the records are authoritative (see awsdns.reverse)
         """
         output = ([], [], [])
         
@@ -123,7 +628,11 @@ class EC2Resolver(client.Resolver):
             self.log.debug("No instances found for '%s'" % (name))
             return output
         
-        for instance in instances[0].instances:
+        for instance in instances:
+            
+            if record == dns.TXT:
+                output[0].extend(self._extras(instance, name, auth))
+                continue
             
             value = self._tag_or_property(instance, prop)
             self.log.debug("%s: %s %s" % (name, prop, value))
@@ -137,20 +646,44 @@ class EC2Resolver(client.Resolver):
             else:
                 raise ValueError, "Record constant '%s' is not supported" % (record)
             
-            answer = dns.RRHeader(name, type=record, payload=payload, ttl=self.ttl)
+            answer = dns.RRHeader(name, type=record, payload=payload, ttl=self.ttl, auth=auth)
             
             output[0].append(answer)
             
-            for extra_prop in self.extra:
-                extra_value = self._tag_or_property(instance, extra_prop)
-                self.log.debug("%s: %s = %s" % (name, extra_prop, extra_value))
-                if extra_value:
-                    string = "%s = %s" % (extra_prop, extra_value)
-                    extra = dns.Record_TXT(str(string))
-                    extra_rr = dns.RRHeader(name, type=dns.TXT, payload=extra, ttl=self.ttl)
-                    output[2].append(extra_rr)
+            if self.extra_additional:
+                output[2].extend(self._extras(instance, name, auth))
+        
+        return output
+    
+    def _extras(self, instance, name, auth=False):
+        """
+        Return a TXT record for each of the extra properties the instance
+        has.
+        """
+        output = []
+        
+        for extra_prop in self.extra:
+            extra_value = self._tag_or_property(instance, extra_prop)
+            self.log.debug("%s: %s = %s" % (name, extra_prop, extra_value))
+            if extra_value:
+                string = "%s = %s" % (extra_prop, extra_value)
+                extra = dns.Record_TXT(str(string))
+                output.append(dns.RRHeader(name, type=dns.TXT, payload=extra, ttl=self.ttl, auth=auth))
         
         return output
+    
+    def _lookup_type(self, name, type):
+        """
+        The kind of lookup that finds the instances for a query. TXT queries
+        find them the same way as PTR queries, for in-addr.arpa names, and A
+        queries for everything else.
+        """
+        if type == dns.TXT:
+            if str(name).lower().endswith('.in-addr.arpa'):
+                return dns.PTR
+            return dns.A
+        
+        return type
 
         
     def _reverse_ip(self, name):
@@ -163,40 +696,330 @@ class EC2Resolver(client.Resolver):
         
         return ip
         
-    def _lookup_wrapper(self, info):
+    def _lookup_inventory(self, name, type):
+        """
+        Build a message from the in-memory inventory, without calling the 
+        EC2 API.
+        """
+        lookup = self._lookup_type(name, type)
+        
+        if lookup == dns.PTR:
+            instances = self.inventory.lookup_reverse(self._reverse_ip(name))
+            return self.create_message(instances, name, self.forward_filter, record=type)
+        elif lookup == dns.A:
+            instances = self.inventory.lookup_forward(name)
+            return self.create_message(instances, name, self.reverse_filter, record=type)
+        
+        return ([], [], [])
+    
+    def _definitely_missing(self, name, type):
+        """
+        Returns True if the inventory has no instance matching this query, 
+        so there's no point asking the EC2 API.
+        """
+        if not self.inventory_gate or self.inventory is None or not self.inventory.loaded:
+            return False
+        
+        lookup = self._lookup_type(name, type)
+        
+        if lookup == dns.PTR:
+            return not self.inventory.lookup_reverse(self._reverse_ip(name))
+        elif lookup == dns.A:
+            return not self.inventory.lookup_forward(name)
+        
+        return False
+    
+    def _spelling(self, short, name):
+        """
+        Return the value to look instances up by in EC2, for short (the 
+        short name, folded if fold_case is on) and name (the name that was 
+        asked for). EC2 filters are case-sensitive, so that's the case the 
+        instance was last found under, if it's known, or the case name was
+        asked in.
+        """
+        if not self.fold_case:
+            return short
+        
+        return self.spellings.get(short) or self.canonicalizer.short(name, fold_case=False)
+    
+    def _learn_spelling(self, instances, short):
+        """
+        Remember the case the instances for short (a folded name) were found
+        under, if it isn't short itself, so lookups that don't know it (e.g.
+        refreshes, or queries in another case) can ask EC2 for it.
+        """
+        self.spellings.pop(short, None)
+        
+        for instance in instances:
+            value = util.tag_or_property(instance, self.forward_filter)
+            if value:
+                value = util.encode(value)
+            
+            if value and value != short and value.lower() == short:
+                self.spellings[short] = value
+                break
+        
+        return instances
+    
+    def _lookup_ec2(self, name, type, auth=False, spelling=None):
+        """
+        Look up a name (or address) in EC2. Returns a deferred message (see
+        create_message() for auth). spelling is the value to give EC2 for 
+        names, if it's not name itself (see _spelling()).
+        """
+        if self.worker:
+            # only the poller talks to EC2
+            self.log.debug("Not in inventory: %s" % (name,))
+            self.metrics.resolutions.inc('skipped')
+            return defer.succeed(([], [], []))
+        
+        if self.static is not None:
+            # every instance in the file is already in the inventory
+            self.log.debug("Not in inventory file: %s" % (name,))
+            self.metrics.resolutions.inc('skipped')
+            return defer.succeed(([], [], []))
+        
+        if self._definitely_missing(name, type):
+            self.log.debug("Not in inventory, skipping EC2: %s" % (name,))
+            self.metrics.resolutions.inc('skipped')
+            return defer.succeed(([], [], []))
+        
+        self.metrics.resolutions.inc('ec2')
+        
+        lookup = self._lookup_type(name, type)
+        
+        if lookup == dns.PTR:
+            ip = self._reverse_ip(name)
+            d = self.batcher.lookup(util.ec2_filter(self.reverse_filter), self.reverse_filter, ip)
+            d.addCallback(self.create_message, name, self.forward_filter, record=type, auth=auth)
+        elif lookup == dns.A:
+            d = self.batcher.lookup(util.ec2_filter(self.forward_filter), self.forward_filter, str(spelling or name))
+            if self.fold_case:
+                d.addCallback(self._learn_spelling, str(name))
+            d.addCallback(self.create_message, name, self.reverse_filter, record=type, auth=auth)
+        else:
+            raise ValueError, "Record constant '%s' is not supported" % (type)
+        
+        return d
+    
+    def _lookup_wrapper(self, info, asked=None):
+        """
+        Look up a cache key (see ResolverCache). asked is the name as it was
+        asked for, if it's known - the key's name is canonical (see 
+        routing.Canonicalizer), and EC2 needs the case it was asked in.
+        """
         name, cls, type = info
+        route = self.router.route(name)
+        # instances (and load balancers) are found by the name without its 
+        # search suffix
+        short = self.canonicalizer.short(name)
+        spelling = self._spelling(short, asked or name)
+        # until the case an instance goes by is known, a miss in EC2 might 
+        # only be the wrong case - it isn't kept under the folded name, or
+        # every other spelling would get it too (the inventory is looked up
+        # ignoring case, so its misses are real)
+        known = (
+            not self.fold_case or
+            short in self.spellings or
+            (self.inventory is not None and self.inventory.loaded)
+        )
         
-        d = client.Resolver._lookup(self, name, cls, type, None)
+        if self.reverse_authority is not None:
+            found = self.reverse_authority.find(name)
+            if found is not None:
+                return self._lookup_reverse(info, *found)
+        
+        if route != ROUTE_UPSTREAM and self.inventory is not None and self.inventory.loaded:
+            message = self._lookup_inventory(short, type)
+            if message[0]:
+                self.log.debug("inventory hit: %s" % (name,))
+                self.metrics.resolutions.inc('inventory')
+                return (info, message, self.ttl)
+        
+        if route != ROUTE_UPSTREAM and self.elb_index is not None and type in (dns.A, dns.CNAME):
+            load_balancers = self.elb_index.lookup(short)
+            if load_balancers:
+                self.log.debug("ELB hit: %s" % (name,))
+                self.metrics.resolutions.inc('elb')
+                
+                d = self._lookup_elb(short, cls, type, load_balancers[0])
+                d.addCallback(lambda message: (info, message, message_ttl(message, self.ttl)))
+                return d
         
         def relookup(failure):
             failure.trap(error.DNSNameError)
             
-            if type == dns.PTR:
-                ip = self._reverse_ip(name)
-                d = threads.deferToThread(self._ec2.get_all_instances, filters={self.reverse_filter: ip})
-                d.addCallback(self.create_message, name, self.forward_filter, record=dns.PTR)
-            elif type == dns.A:
-                d = threads.deferToThread(self._ec2.get_all_instances, filters={self.forward_filter: str(name)})
-                d.addCallback(self.create_message, name, self.reverse_filter, record=dns.A)
-            else:
-                raise ValueError, "Record constant '%s' is not supported" % (type)
-                
+            d = self._lookup_ec2(short, type, spelling=spelling)
+            d.addCallback(format)
+            
             return d
             
         def format(message):
             """ 
             Format the output of _lookup so it fits the cache format
             """ 
+            if not message[0] and not known and self._lookup_type(name, type) == dns.A:
+                self.log.debug("Not caching a miss for %s under its folded name" % (spelling,))
+                return (info, message, 0)
+            
             return (info, message, self.ttl)
+        
+        def upstream(message):
+            # upstream answers are only good for as long as their records say
+            return (info, message, message_ttl(message, self.ttl))
+        
+        if route == ROUTE_EC2:
+            self.log.debug("%s is in an EC2 zone, skipping upstream" % (name,))
+            
+            if type in (dns.A, dns.PTR, dns.TXT):
+                d = self._lookup_ec2(short, type, spelling=spelling)
+            else:
+                # nothing else is kept for EC2 names
+                d = defer.succeed(([], [], []))
             
-        d.addErrback(relookup)
+            d.addCallback(format)
+        else:
+            # no zones set up - try upstream, then EC2
+            d = self._lookup_upstream(name, cls, type)
+            d.addCallbacks(upstream, relookup)
+        
+        return d
+    
+    def _lookup_reverse(self, info, apex, address):
+        """
+        Answer a name in one of our reverse zones (see awsdns.reverse),
+        authoritatively. PTR (and TXT) queries for addresses are answered 
+        from the inventory, if it's loaded - without calling EC2 - and 
+        addresses nobody has get the zone's SOA, for a negative answer. Everything else
+        gets an empty answer with the SOA, except SOA queries for the zone 
+        itself.
+        """
+        name, cls, type = info
+        
+        serial = None
+        if self.inventory is not None and self.inventory.last_sweep:
+            serial = int(self.inventory.last_sweep)
+        
+        soa = self.reverse_authority.soa(apex, serial)
+        
+        def format(message):
+            if message[0]:
+                return (info, message, self.ttl)
+            return (info, ([], [soa], []), soa.ttl)
+        
+        if type == dns.SOA and name == apex:
+            return (info, ([soa], [], []), soa.ttl)
+        
+        if type not in (dns.PTR, dns.TXT) or address is None:
+            return format(([], [], []))
+        
+        if self.inventory is not None and self.inventory.loaded:
+            self.metrics.resolutions.inc('inventory')
+            instances = self.inventory.lookup_reverse(address)
+            return format(self.create_message(instances, name, self.forward_filter, record=type, auth=True))
+        
+        d = self._lookup_ec2(name, type, auth=True)
         d.addCallback(format)
         
         return d
+    
+    def _name_error(self, message, name):
+        """
+        Turn an empty answer for an address in one of our reverse zones into
+        an NXDOMAIN, with the zone's SOA.
+        """
+        if not message[0] and message[1]:
+            found = self.reverse_authority.find(name)
+            if found is not None and found[1] is not None:
+                raise AuthoritativeNameError(name, message[1])
+        
+        return message
+    
+    def _lookup_elb(self, name, cls, type, load_balancer):
+        """
+        Answer with a CNAME to a load balancer's DNS name. For A queries, the
+        load balancer's addresses follow, from the upstream DNS servers (if
+        they can be found), so clients don't have to chase the CNAME. 
+        Returns a deferred message.
+        """
+        # the index may change at the next sweep
+        ttl = min(self.ttl, self.elb_interval)
+        
+        cname = dns.RRHeader(
+            name,
+            type=dns.CNAME,
+            payload=dns.Record_CNAME(load_balancer.dns_name, ttl),
+            ttl=ttl
+        )
+        
+        if type == dns.CNAME:
+            return defer.succeed(([cname], [], []))
+        
+        d = self._lookup_upstream(load_balancer.dns_name, cls, type)
+        
+        def chased((answers, authority, additional)):
+            return ([cname] + list(answers), [], [])
+        
+        def failed(reason):
+            self.log.warning("Couldn't look up %s: %s" % (load_balancer.dns_name, reason.getErrorMessage()))
+            return ([cname], [], [])
+        
+        d.addCallbacks(chased, failed)
+        
+        return d
+    
+    def _lookup_upstream(self, name, cls, type):
+        """
+        Ask the upstream DNS servers - through the forwarding cache, if it's
+        on.
+        """
+        def query(name, cls, type):
+            self.metrics.resolutions.inc('upstream')
+            return self.metrics.upstream_latency.time(self.upstreams.lookup(name, cls, type))
+        
+        if self.forward_cache is None:
+            return query(name, cls, type)
+        
+        return self.forward_cache.lookup(name, cls, type, query)
+        
+    def _rename(self, message, canonical, name):
+        """
+        Give the records in a message cached under a canonical name (see
+        routing.Canonicalizer) the name that was actually asked for. The
+        cached records are left alone.
+        """
+        owners = (canonical.lower(), self.canonicalizer.short(canonical).lower())
+        
+        def rename(records):
+            output = []
+            
+            for record in records:
+                owner = str(record.name)
+                if owner != name and owner.lower() in owners:
+                    record = dns.RRHeader(name, record.type, record.cls, record.ttl, record.payload, record.auth)
+                output.append(record)
+            
+            return output
         
+        return tuple([rename(records) for records in message])
+    
     def _lookup(self, name, cls, type, timeout):
         self.log.debug("NAME: %s, CLS: %s, TYPE: %s, TIMEOUT: %s" % (name, cls, type, timeout))   
         
-        d = self.cache[(name, cls, type)]
+        self.metrics.queries.inc(dns.QUERY_TYPES.get(type, type))
         
-        return d
+        canonical = self.canonicalizer.canonical(name)
+        
+        if self.router.route(canonical) == ROUTE_UPSTREAM:
+            # nothing of ours - don't keep it in the resolver cache
+            d = self._lookup_upstream(name, cls, type)
+        else:
+            # the cache only has the canonical name - the callback needs the
+            # case it was asked in (see _lookup_wrapper())
+            d = self.cache.get((canonical, cls, type), name)
+            d.addCallback(self._rename, canonical, name)
+            
+            if self.reverse_authority is not None and type == dns.PTR:
+                d.addCallback(self._name_error, canonical)
+        
+        return self.metrics.response_latency.time(d)
@@ -0,0 +1,229 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Reverse authority - answers reverse (in-addr.arpa) lookups for our own
+networks authoritatively, with an SOA, so addresses nobody has get a
+proper, cacheable NXDOMAIN.
+"""
+
+from twisted.names import dns, error, server
+
+import socket
+import struct
+import time
+
+from awsdns.routing import parse_cidr
+
+class RadixTree(object):
+    """
+    IPv4 CIDR blocks, stored as a binary trie with one level per bit of
+    the prefix. Finding the most specific block an address falls in (see
+    lookup()) takes at most 32 steps, no matter how many blocks there are.
+    
+    Each node is a [zero, one, value] list.
+    """
+    
+    _root = None
+    
+    def __init__(self):
+        self._root = [None, None, None]
+    
+    def add(self, cidr, value):
+        """
+        Store value under a CIDR block (e.g. '10.1.0.0/16').
+        """
+        network, bits = parse_cidr(cidr)
+        node = self._root
+        
+        for i in range(bits):
+            bit = (network >> (31 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        
+        node[2] = value
+    
+    def lookup(self, address):
+        """
+        Return the value of the longest block that address (an integer)
+        falls in, or None.
+        """
+        node = self._root
+        found = node[2]
+        
+        for i in range(32):
+            node = node[(address >> (31 - i)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                found = node[2]
+        
+        return found
+
+def parse_reverse(name):
+    """
+    Parse an in-addr.arpa name. Returns the address it covers (as an
+    integer, padded with zeros) and the number of octets it gives, or None
+    if name isn't one - e.g. '1.0.1.10.in-addr.arpa' is (167837953, 4) and
+    '1.10.in-addr.arpa' is (167837696, 2).
+    """
+    labels = str(name).lower().rstrip('.').split('.')
+    
+    if labels[-2:] != ['in-addr', 'arpa'] or not 1 <= len(labels) - 2 <= 4:
+        return None
+    
+    octets = labels[:-2]
+    octets.reverse()
+    
+    for octet in octets:
+        if not octet.isdigit() or int(octet) > 255:
+            return None
+    
+    padded = [int(octet) for octet in octets] + [0] * (4 - len(octets))
+    
+    return struct.unpack("!I", struct.pack("!4B", *padded))[0], len(octets)
+
+class ReverseZone(object):
+    """
+    One of our networks.
+    
+    Reverse zones are cut on octet boundaries, so a block that isn't (e.g.
+    a /20) is answered as the zones that cover it (sixteen /24s) - see
+    routing.cidr_zones().
+    """
+    
+    cidr = None
+    octets = None
+    
+    def __init__(self, cidr):
+        self.cidr = cidr
+        network, bits = parse_cidr(cidr)
+        self.octets = (bits + 7) // 8
+    
+    def apex(self, address):
+        """
+        The name of the zone address (an integer) is in.
+        """
+        octets = socket.inet_ntoa(struct.pack("!I", address)).split('.')[:self.octets]
+        octets.reverse()
+        return ".".join(octets + ['in-addr', 'arpa'])
+
+class ReverseAuthority(object):
+    """
+    Decides which in-addr.arpa names are ours - the ones under networks,
+    kept in a RadixTree - and builds the SOA records for their zones.
+    
+    networks - list of CIDR blocks.
+    mname - the name of the primary server, for SOA records.
+    rname - the mailbox of the person responsible for the zones, as a name
+            (hostmaster.example.com).
+    ttl - TTL of SOA records, and of negative answers (the SOA minimum, see
+          RFC 2308).
+    serial - SOA serial number to use when none is given. Defaults to the
+             time the authority was created.
+    """
+    
+    tree = None
+    mname = None
+    rname = None
+    ttl = None
+    serial = None
+    
+    # SOA timers, in seconds - only used by secondaries, which we don't have
+    refresh = 3600
+    retry = 600
+    expire = 86400
+    
+    def __init__(self, networks, mname, rname, ttl=60, serial=None):
+        self.tree = RadixTree()
+        self.mname = mname
+        self.rname = rname
+        self.ttl = ttl
+        self.serial = serial or int(time.time())
+        
+        for network in networks:
+            self.tree.add(network, ReverseZone(network))
+    
+    def find(self, name):
+        """
+        Returns the zone apex, and the address (a dotted quad, or None if
+        name isn't a whole address), if name is ours. Returns None if not.
+        """
+        parsed = parse_reverse(name)
+        if parsed is None:
+            return None
+        
+        address, octets = parsed
+        zone = self.tree.lookup(address)
+        
+        if zone is None or octets < zone.octets:
+            # not a network of ours, or above the zone cut
+            return None
+        
+        if octets == 4:
+            return zone.apex(address), socket.inet_ntoa(struct.pack("!I", address))
+        
+        return zone.apex(address), None
+    
+    def soa(self, apex, serial=None):
+        """
+        The SOA record for the zone at apex.
+        """
+        return dns.RRHeader(
+            apex,
+            type=dns.SOA,
+            ttl=self.ttl,
+            auth=True,
+            payload=dns.Record_SOA(
+                mname=self.mname,
+                rname=self.rname,
+                serial=serial or self.serial,
+                refresh=self.refresh,
+                retry=self.retry,
+                expire=self.expire,
+                minimum=self.ttl,
+                ttl=self.ttl
+            )
+        )
+
+class AuthoritativeNameError(error.AuthoritativeDomainError):
+    """
+    The name doesn't exist, and we're sure of it. authority is the list of
+    records (the zone's SOA) to send in the authority section, so the
+    answer can be cached.
+    """
+    
+    def __init__(self, name, authority):
+        error.AuthoritativeDomainError.__init__(self, name)
+        self.authority = authority
+
+class AuthoritativeServerFactory(server.DNSServerFactory):
+    """
+    A DNSServerFactory that sends the authority records of an
+    AuthoritativeNameError with its NXDOMAIN response. Responses with
+    authoritative records in the authority section (e.g. negative answers
+    with an SOA) get the AA flag, like ones with authoritative answers.
+    """
+    
+    def _responseFromMessage(self, message, rCode=dns.OK, answers=None, authority=None, additional=None):
+        response = server.DNSServerFactory._responseFromMessage(
+            self, message, rCode, answers, authority, additional
+        )
+        
+        if not response.auth and [record for record in response.authority if record.auth]:
+            response.auth = True
+        
+        return response
+    
+    def gotResolverError(self, failure, protocol, message, address):
+        if not failure.check(AuthoritativeNameError):
+            return server.DNSServerFactory.gotResolverError(self, failure, protocol, message, address)
+        
+        response = self._responseFromMessage(
+            message=message,
+            rCode=dns.ENAME,
+            authority=failure.value.authority
+        )
+        
+        self.sendReply(protocol, response, address)
+        self._verboseLog("Lookup failed - %s doesn't exist" % (failure.value,))
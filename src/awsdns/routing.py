@@ -0,0 +1,211 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Routing - decides, by name, whether a query is for EC2 or for the upstream
+DNS server.
+"""
+
+import struct
+import socket
+
+# where a query should go
+ROUTE_EC2 = 'ec2'
+ROUTE_UPSTREAM = 'upstream'
+
+def labels(name):
+    """
+    Split a domain name into its labels, lower-cased, last label first.
+    """
+    output = [label for label in str(name).lower().split('.') if label]
+    output.reverse()
+    return output
+
+def parse_cidr(cidr):
+    """
+    Split an IPv4 CIDR block into its network address (as an integer, with
+    the host bits cleared) and prefix length.
+    """
+    try:
+        address, bits = cidr.split('/')
+        bits = int(bits)
+        network = struct.unpack("!I", socket.inet_aton(address))[0]
+    except (ValueError, socket.error):
+        raise ValueError, "Invalid CIDR block: '%s'" % (cidr,)
+    
+    if not 0 <= bits <= 32:
+        raise ValueError, "Invalid CIDR block: '%s'" % (cidr,)
+    
+    return network & ~((1 << (32 - bits)) - 1) & 0xffffffff, bits
+
+def cidr_zones(cidr):
+    """
+    Return the in-addr.arpa zones that cover an IPv4 CIDR block, e.g.
+    10.1.0.0/16 is 1.10.in-addr.arpa. Prefixes that don't fall on an octet
+    boundary are rounded up to the next one, so 10.0.0.0/20 is 16 zones:
+    0.0.10.in-addr.arpa through 15.0.10.in-addr.arpa.
+    """
+    network, bits = parse_cidr(cidr)
+    
+    octets = (bits + 7) // 8
+    step = 1 << (32 - octets * 8)
+    
+    zones = []
+    for start in range(network, network + (1 << (32 - bits)), step):
+        parts = socket.inet_ntoa(struct.pack("!I", start)).split('.')[:octets]
+        parts.reverse()
+        zones.append(".".join(parts + ['in-addr', 'arpa']))
+    
+    return zones
+
+class SuffixTrie(object):
+    """
+    A set of domain name suffixes, stored as a trie of labels (last label
+    first), so finding the suffix that matches a name takes one dictionary
+    lookup per label, no matter how many suffixes there are.
+    """
+    
+    _root = None
+    
+    # marks the end of a suffix - can't clash with a label, which has no dots
+    END = '.'
+    
+    def __init__(self, suffixes=()):
+        self._root = {}
+        
+        for suffix in suffixes:
+            self.add(suffix)
+    
+    def add(self, suffix):
+        node = self._root
+        for label in labels(suffix):
+            node = node.setdefault(label, {})
+        node[self.END] = suffix
+    
+    def match(self, name):
+        """
+        Return the longest suffix that name falls under, or None.
+        """
+        node = self._root
+        found = node.get(self.END)
+        
+        for label in labels(name):
+            try:
+                node = node[label]
+            except KeyError:
+                break
+            found = node.get(self.END, found)
+        
+        return found
+    
+    def __contains__(self, name):
+        return self.match(name) is not None
+
+class Canonicalizer(object):
+    """
+    Maps the different ways clients write the same name to a single
+    canonical name, so they share a cache entry (and an API call).
+    
+    Names are lower-cased (unless fold_case is off), and names under one of
+    the search suffixes - or with no dots at all, the ones a stub resolver
+    expands with its search list - are qualified with the first suffix. With
+    suffixes 'ec2.internal' and 'prod.example.com', 'WEB1', 'web1.',
+    'web1.ec2.internal' and 'web1.prod.example.com' are all
+    'web1.ec2.internal'. Suffixes are found with a SuffixTrie.
+    
+    suffixes - search suffixes, first choice first.
+    fold_case - set to False to leave the case of names alone.
+    """
+    
+    trie = None
+    suffixes = None
+    fold_case = True
+    
+    def __init__(self, suffixes=(), fold_case=True):
+        self.suffixes = [str(suffix).lower().strip('.') for suffix in suffixes if str(suffix).strip('.')]
+        self.trie = SuffixTrie(self.suffixes)
+        self.fold_case = fold_case
+    
+    def split(self, name, fold_case=None):
+        """
+        Return the short name (without a trailing dot, lower-cased if 
+        fold_case is on) and the search suffix that was stripped from it,
+        or None. fold_case overrides the canonicalizer's own setting.
+        """
+        if fold_case is None:
+            fold_case = self.fold_case
+        
+        name = str(name).rstrip('.')
+        if fold_case:
+            name = name.lower()
+        
+        # suffixes are always matched ignoring case
+        suffix = self.trie.match(name.lower())
+        if suffix and len(name) > len(suffix) + 1:
+            return name[:-(len(suffix) + 1)], suffix
+        
+        return name, None
+    
+    def short(self, name, fold_case=None):
+        """
+        Return name without its search suffix - the value instances are
+        looked up by.
+        """
+        return self.split(name, fold_case)[0]
+    
+    def canonical(self, name):
+        """
+        Return the canonical name for name.
+        """
+        short, suffix = self.split(name)
+        
+        if self.suffixes and (suffix is not None or '.' not in short):
+            return "%s.%s" % (short, self.suffixes[0])
+        
+        return short
+    
+    def variants(self, name):
+        """
+        Return the names (ignoring case) that have the same canonical name
+        as name - e.g. to drop them all from the wire cache.
+        """
+        canonical = self.canonical(name)
+        short, suffix = self.split(canonical)
+        
+        if suffix is None:
+            return [canonical]
+        
+        output = ["%s.%s" % (short, other) for other in self.suffixes]
+        if '.' not in short:
+            output.append(short)
+        
+        return output
+
+class Router(object):
+    """
+    Routes queries under zones (domain suffixes) or networks (CIDR blocks,
+    for reverse lookups) to EC2, and everything else upstream.
+    
+    If neither is given, route() returns None - there's no way to tell, so
+    the query should be tried upstream first, and then EC2.
+    """
+    
+    trie = None
+    enabled = False
+    
+    def __init__(self, zones=(), networks=()):
+        self.trie = SuffixTrie(zones)
+        
+        for network in networks:
+            for zone in cidr_zones(network):
+                self.trie.add(zone)
+        
+        self.enabled = bool(zones or networks)
+    
+    def route(self, name):
+        if not self.enabled:
+            return None
+        
+        if name in self.trie:
+            return ROUTE_EC2
+        
+        return ROUTE_UPSTREAM
@@ -0,0 +1,301 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Snapshots - saves the cache (and inventory, and ELB index) to disk, so a
+restarted server comes up warm.
+"""
+
+from twisted.internet import task
+from twisted.names import dns
+
+import base64
+import json
+import os
+import time
+
+import tx_logging
+
+from awsdns.ec2client import Instance, Reservation
+from awsdns.elb import LoadBalancer
+from awsdns.forward import cap_records
+
+# version 1 was marshal'd, which is tied to the interpreter version
+VERSION = 2
+
+# only simple values survive the trip to disk
+SIMPLE_TYPES = (basestring, bool, int, long, float)
+
+def encode_message(message):
+    """
+    Encode a message (a tuple of answer, authority and additional lists) in
+    DNS wire format.
+    """
+    m = dns.Message()
+    m.answers, m.authority, m.additional = [list(section) for section in message]
+    return m.toStr()
+
+def decode_message(data):
+    """
+    The reverse of encode_message().
+    """
+    m = dns.Message()
+    m.fromStr(data)
+    return (m.answers, m.authority, m.additional)
+
+def age_message(message, ttl):
+    """
+    Return a copy of message with no record's TTL above ttl - the number of
+    seconds the message has left.
+    """
+    ttl = max(1, int(ttl))
+    
+    return tuple([cap_records(section, ttl) for section in message])
+
+def to_bytes(value):
+    """
+    Turn the unicode strings json.loads() returns back into byte strings,
+    like the ones that were saved - all the way down.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_bytes(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(to_bytes(key), to_bytes(item)) for key, item in value.items()])
+    
+    return value
+
+def simple_fields(obj):
+    """
+    Return the simple fields of an object, and its tags, as a dictionary.
+    """
+    fields = dict([
+        (key, value) for key, value in vars(obj).items()
+        if not key.startswith('_') and isinstance(value, SIMPLE_TYPES)
+    ])
+    
+    fields['tags'] = dict(getattr(obj, 'tags', None) or {})
+    
+    return fields
+
+def instance_fields(instance):
+    """
+    Return the simple fields of an instance (boto's, or awsdns.ec2client's)
+    as a dictionary - enough to rebuild it as an ec2client.Instance.
+    """
+    fields = simple_fields(instance)
+    
+    fields['id'] = instance.id
+    fields['state'] = getattr(instance, 'state', None)
+    fields['placement'] = getattr(instance, 'placement', None)
+    
+    return fields
+
+class Snapshot(object):
+    """
+    Periodically writes the contents of a ResolverCache (and, optionally, an
+    Inventory and a LoadBalancerIndex) to path, and reads them back at
+    startup.
+    
+    Cache entries are stored in DNS wire format, with the number of seconds
+    they had left to live - entries that have run out by the time the
+    snapshot is loaded are skipped, and the rest are restored with their 
+    records' TTLs cut to the time they have left. Instances are stored as their simple
+    fields (see instance_fields()), and load balancers as theirs.
+    
+    The file is written to a temporary file and renamed over the old one, so
+    a crash mid-write never leaves a partial snapshot behind. It's JSON, so
+    it can be read by any version of Python (and doesn't run anything when
+    it's read), with a format version that's checked on the way in.
+    
+    A read-only snapshot is never saved - instead, every interval seconds,
+    the inventory is reloaded from it if the file has changed. That's how
+    worker processes (see awsdns.workers) share the inventory kept by the 
+    poller.
+    
+    cache - a ResolverCache.
+    inventory - an Inventory, or None.
+    elb_index - an awsdns.elb.LoadBalancerIndex, or None.
+    interval - number of seconds between saves (or checks for changes).
+    readonly - set to True to follow a snapshot written by another process.
+    """
+    
+    _loop = None
+    _signature = None
+    path = None
+    cache = None
+    inventory = None
+    elb_index = None
+    interval = None
+    readonly = False
+    log = None
+    
+    def __init__(self, path, cache, inventory=None, interval=60, readonly=False, elb_index=None):
+        self.path = path
+        self.cache = cache
+        self.inventory = inventory
+        self.elb_index = elb_index
+        self.interval = interval
+        self.readonly = readonly
+        self.log = tx_logging.getLogger("awsdns:snapshot")
+    
+    def dump(self):
+        """
+        Return the snapshot, as a string.
+        """
+        entries = [
+            (name, base64.b64encode(encode_message(message)), ttl)
+            for name, message, ttl in self.cache.entries()
+        ]
+        
+        inventory = None
+        if self.inventory is not None and self.inventory.loaded:
+            inventory = {
+                'last_sweep': self.inventory.last_sweep,
+                'instances': [instance_fields(i) for i in self.inventory.instances.values()],
+            }
+        
+        load_balancers = None
+        if self.elb_index is not None and self.elb_index.loaded:
+            load_balancers = [simple_fields(lb) for lb in self.elb_index.load_balancers]
+        
+        return json.dumps({
+            'version': VERSION,
+            'written': time.time(),
+            'cache': entries,
+            'inventory': inventory,
+            'load_balancers': load_balancers,
+        })
+    
+    def save(self):
+        """
+        Write a snapshot to path.
+        """
+        try:
+            data = self.dump()
+            
+            temp = "%s.tmp" % (self.path,)
+            with open(temp, "wb") as fh:
+                fh.write(data)
+            os.rename(temp, self.path)
+        except Exception, e:
+            self.log.error("Couldn't save snapshot to %s: %s" % (self.path, e))
+            return
+        
+        self.log.debug("Saved snapshot to %s (%s bytes)" % (self.path, len(data)))
+    
+    def signature(self):
+        """
+        Something that changes whenever the file at path is replaced, or None
+        if there's nothing there.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+    
+    def read(self):
+        """
+        Read the snapshot at path. Returns None if there isn't one.
+        """
+        self._signature = self.signature()
+        
+        if self._signature is None or not self._signature[2]:
+            return None
+        
+        with open(self.path, "rb") as fh:
+            snapshot = to_bytes(json.load(fh))
+        
+        version = isinstance(snapshot, dict) and snapshot.get('version')
+        if version != VERSION:
+            raise ValueError, "Unsupported snapshot version: %s" % (version,)
+        
+        return snapshot
+    
+    def load(self):
+        """
+        Restore the cache and inventory from the snapshot at path, if there
+        is one. Returns the number of cache entries restored.
+        """
+        try:
+            snapshot = self.read()
+        except Exception, e:
+            self.log.error("Couldn't read snapshot from %s: %s" % (self.path, e))
+            return 0
+        
+        if snapshot is None:
+            return 0
+        
+        age = max(0, time.time() - snapshot['written'])
+        restored = 0
+        
+        for name, data, ttl in snapshot['cache']:
+            if ttl <= age:
+                continue
+            
+            if isinstance(name, list):
+                # keys are (name, class, type) tuples, which JSON makes lists
+                name = tuple(name)
+            
+            message = age_message(decode_message(base64.b64decode(data)), ttl - age)
+            self.cache.cache((name, message, ttl - age))
+            restored += 1
+        
+        self.restore_inventory(snapshot)
+        
+        self.log.info("Restored %s cache entries from %s (%.0fs old)" % (restored, self.path, age))
+        
+        return restored
+    
+    def restore_inventory(self, snapshot):
+        if self.elb_index is not None and snapshot.get('load_balancers') is not None:
+            self.elb_index.rebuild([LoadBalancer(**fields) for fields in snapshot['load_balancers']])
+        
+        if self.inventory is None or snapshot['inventory'] is None:
+            return
+        
+        reservation = Reservation()
+        reservation.instances = [Instance(**fields) for fields in snapshot['inventory']['instances']]
+        
+        self.inventory.rebuild([reservation])
+        self.inventory.last_sweep = snapshot['inventory']['last_sweep']
+    
+    def reload(self):
+        """
+        Reload the inventory, if the snapshot has changed since it was last
+        read.
+        """
+        if self.signature() == self._signature:
+            return
+        
+        try:
+            snapshot = self.read()
+        except Exception, e:
+            self.log.error("Couldn't read snapshot from %s: %s" % (self.path, e))
+            return
+        
+        if snapshot is not None:
+            self.restore_inventory(snapshot)
+    
+    def start(self):
+        """
+        Save (or reload, if read-only) every interval seconds.
+        """
+        if self.readonly:
+            self._loop = task.LoopingCall(self.reload)
+        else:
+            self._loop = task.LoopingCall(self.save)
+        
+        return self._loop.start(self.interval, now=False)
+    
+    def stop(self):
+        """
+        Stop, and save one last time (unless read-only).
+        """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        
+        if not self.readonly:
+            self.save()
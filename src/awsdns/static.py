@@ -0,0 +1,207 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Static inventory - serves instances from a JSON or CSV file (e.g. an export
+from a CMDB) instead of the EC2 API.
+"""
+
+from twisted.internet import defer, task
+
+import csv
+import json
+import os
+
+import tx_logging
+
+from awsdns.ec2client import EC2Client, Instance, Reservation, ResultSet
+from awsdns.snapshot import instance_fields
+from awsdns import util
+
+def make_instance(fields):
+    """
+    Build an Instance from a dictionary of fields, named the way boto names
+    them (id, private_ip_address, etc). Tags can be given as a 'tags'
+    dictionary, or as 'tag:Key' fields. Empty fields are skipped.
+    """
+    kwargs = {'state': 'running', 'tags': {}}
+    
+    for key, value in fields.items():
+        if value is None or value == "":
+            continue
+        
+        if key == 'tags':
+            kwargs['tags'].update(value)
+        elif key.startswith("tag:"):
+            kwargs['tags'][key.split(":", 1)[1]] = value
+        else:
+            kwargs[str(key)] = value
+    
+    if not kwargs.get('id'):
+        raise ValueError, "Instance has no id: %r" % (fields,)
+    
+    return Instance(**kwargs)
+
+def read_json(fh):
+    """
+    Read a JSON list of objects, one per instance.
+    """
+    rows = json.load(fh)
+    
+    if not isinstance(rows, list):
+        raise ValueError, "Expected a list of instances"
+    
+    return rows
+
+def read_csv(fh):
+    """
+    Read a CSV file with a header row, one instance per row after that.
+    """
+    return list(csv.DictReader(fh))
+
+READERS = {
+    '.json': read_json,
+    '.csv': read_csv,
+}
+
+def load(path):
+    """
+    Read the instances out of a JSON or CSV file (by extension). Returns a
+    dictionary mapping instance ids to instances.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    
+    try:
+        reader = READERS[extension]
+    except KeyError:
+        raise ValueError, "Don't know how to read '%s' - use .json or .csv" % (path,)
+    
+    with open(path) as fh:
+        rows = reader(fh)
+    
+    instances = {}
+    for row in rows:
+        instance = make_instance(row)
+        instances[instance.id] = instance
+    
+    return instances
+
+class StaticEC2Client(EC2Client):
+    """
+    An EC2 client that answers from a file (see load()), instead of calling
+    the API. Filters and pagination work as they do in AWS.
+    
+    Every interval seconds, the file is checked for changes. When it
+    changes, it's read again, and only the instances that were added,
+    changed or removed (as 'terminated') are passed to on_change - e.g.
+    Inventory.apply(). If the file can't be read, the instances from the
+    last good read are kept.
+    
+    path - a .json or .csv file.
+    interval - number of seconds between checks for changes.
+    on_change - function that takes a list of changed instances, or None.
+    """
+    
+    _loop = None
+    _signature = None
+    path = None
+    interval = None
+    instances = None
+    on_change = None
+    log = None
+    
+    def __init__(self, path, interval=5, on_change=None):
+        self.path = path
+        self.interval = interval
+        self.on_change = on_change
+        self.instances = {}
+        self.log = tx_logging.getLogger("awsdns:static")
+    
+    def signature(self):
+        """
+        Something that changes whenever the file at path is written to or
+        replaced, or None if there's nothing there.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+    
+    def load(self):
+        """
+        Read the file. Returns the list of instances that changed since the
+        last read. Errors are raised.
+        """
+        signature = self.signature()
+        instances = load(self.path)
+        
+        changed = []
+        
+        for instance_id, instance in instances.items():
+            current = self.instances.get(instance_id)
+            if current is None or instance_fields(current) != instance_fields(instance):
+                changed.append(instance)
+        
+        for instance_id in self.instances:
+            if instance_id not in instances:
+                changed.append(Instance(id=instance_id, state='terminated'))
+        
+        self.instances = instances
+        self._signature = signature
+        
+        self.log.info("Loaded %s instances from %s (%s changed)" % (len(instances), self.path, len(changed)))
+        
+        return changed
+    
+    def reload(self):
+        """
+        Read the file again if it's changed, and pass the changes to
+        on_change.
+        """
+        if self.signature() == self._signature:
+            return
+        
+        try:
+            changed = self.load()
+        except Exception, e:
+            self.log.error("Couldn't read instances from %s: %s" % (self.path, e))
+            return
+        
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+    
+    def start(self):
+        self._loop = task.LoopingCall(self.reload)
+        return self._loop.start(self.interval, now=False)
+    
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+    
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        filters = dict([
+            (name, isinstance(values, basestring) and [values] or values)
+            for name, values in (filters or {}).items()
+        ])
+        
+        found = [
+            instance for instance_id, instance in sorted(self.instances.items())
+            if util.matches(instance, filters)
+        ]
+        
+        start = int(next_token or 0)
+        end = len(found)
+        if max_results:
+            end = min(end, start + max_results)
+        
+        result = ResultSet()
+        for instance in found[start:end]:
+            reservation = Reservation()
+            reservation.instances = [instance]
+            result.append(reservation)
+        
+        if end < len(found):
+            result.next_token = str(end)
+        
+        return defer.succeed(result)
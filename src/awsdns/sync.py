@@ -0,0 +1,230 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Sync - keeps the inventory up to date between full sweeps, by fetching only
+the instances that have changed.
+"""
+
+from twisted.internet import defer, task
+
+import datetime
+import json
+import os
+import time
+
+import tx_logging
+
+import util
+
+# states an instance passes through on its way in or out of the index
+TRANSITIONAL_STATES = ['pending', 'stopping', 'shutting-down', 'terminated']
+
+class EventFeed(object):
+    """
+    Reads instance ids from a change-event feed - a file of JSON objects,
+    one per line, appended to by some other process (e.g. a forwarder for
+    EC2 instance state-change notifications).
+    
+    The instance id is taken from the 'instance-id' key, either at the top
+    level or inside 'detail':
+    
+        {"detail": {"instance-id": "i-d20eee82", "state": "running"}}
+    
+    Only lines written since the last read are returned. If the file
+    shrinks (e.g. it was rotated), it is read from the beginning.
+    """
+    
+    path = None
+    offset = 0
+    log = None
+    
+    def __init__(self, path):
+        self.path = path
+        self.log = tx_logging.getLogger("awsdns:sync")
+    
+    def read(self):
+        """
+        Return a list of instance ids from new events in the feed.
+        """
+        ids = []
+        
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return ids
+        
+        if size < self.offset:
+            self.offset = 0
+        
+        with open(self.path) as fh:
+            fh.seek(self.offset)
+            
+            while True:
+                line = fh.readline()
+                # leave partially written lines for the next read
+                if not line.endswith("\n"):
+                    break
+                
+                self.offset += len(line)
+                
+                try:
+                    event = json.loads(line)
+                    instance_id = event.get('detail', event)['instance-id']
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    self.log.warning("Ignoring bad event: %r" % (line,))
+                    continue
+                
+                if instance_id not in ids:
+                    ids.append(instance_id)
+        
+        return ids
+
+class InventorySync(object):
+    """
+    Patches an Inventory in place with the instances that changed since the
+    last sync, instead of rebuilding it from a full sweep.
+    
+    Each sync asks EC2 for:
+    
+    * instances launched since the last sync (launch-time filter)
+    * instances in a transitional state (pending, stopping, etc)
+    * instances named in the event feed, if there is one
+    
+    Changes that none of these will catch (e.g. a re-tagged instance) are
+    picked up by the inventory's regular full sweep.
+    
+    After each sync, the number of changed instances and how long it took to
+    fetch and apply them are logged, and kept in the last_* attributes.
+    
+    inventory - the Inventory to keep up to date.
+    interval - number of seconds between syncs.
+    feed - an EventFeed, or None.
+    """
+    
+    _loop = None
+    inventory = None
+    interval = None
+    feed = None
+    last_sync = None
+    last_changes = None
+    last_fetch_time = None
+    last_apply_time = None
+    log = None
+    
+    def __init__(self, inventory, interval=60, feed=None):
+        self.inventory = inventory
+        self.interval = interval
+        self.feed = feed
+        self.log = tx_logging.getLogger("awsdns:sync")
+    
+    def _launch_times(self, since, now):
+        """
+        Build launch-time filter values covering every hour from since to
+        now (the filter only supports wildcards, not ranges).
+        """
+        start = datetime.datetime.utcfromtimestamp(since).replace(minute=0, second=0, microsecond=0)
+        end = datetime.datetime.utcfromtimestamp(now)
+        
+        values = []
+        
+        while start <= end:
+            values.append(start.strftime("%Y-%m-%dT%H*"))
+            start += datetime.timedelta(hours=1)
+        
+        return values
+    
+    def queries(self, now=None):
+        """
+        Return the list of filters to query, one API call (or set of pages)
+        each.
+        """
+        if now is None:
+            now = time.time()
+        
+        # allow for clock skew, and instances that were pending during the
+        # last sync
+        since = (self.last_sync or self.inventory.last_sweep or now) - self.interval
+        
+        queries = [
+            {'launch-time': self._launch_times(since, now)},
+            {'instance-state-name': TRANSITIONAL_STATES},
+        ]
+        
+        if self.feed is not None:
+            ids = self.feed.read()
+            if ids:
+                queries.append({'instance-id': ids})
+        
+        return queries
+    
+    def _fetch(self, queries):
+        """
+        Run each query against EC2 (all at once). Returns a deferred that 
+        fires with every instance found.
+        """
+        d = defer.gatherResults([self.inventory._fetch(filters) for filters in queries], consumeErrors=True)
+        
+        def combine(results):
+            instances = []
+            for reservations in results:
+                instances.extend(util.instances(reservations))
+            return instances
+        
+        d.addCallback(combine)
+        
+        return d
+    
+    def sync(self):
+        """
+        Fetch the changed instances and apply them to the inventory.
+        
+        Returns a deferred that fires with the number of changed instances.
+        Failures are logged, and the inventory is left as-is.
+        """
+        if not self.inventory.loaded:
+            self.log.debug("Inventory not loaded yet, skipping sync")
+            return defer.succeed(0)
+        
+        started = time.time()
+        queries = self.queries(started)
+        
+        d = self._fetch(queries)
+        
+        def apply(instances):
+            fetched = time.time()
+            changes = self.inventory.apply(instances)
+            applied = time.time()
+            
+            self.last_sync = started
+            self.last_changes = changes
+            self.last_fetch_time = fetched - started
+            self.last_apply_time = applied - fetched
+            
+            self.log.info("Inventory sync: %s changes (%s instances fetched in %.3fs, applied in %.6fs)" % (
+                changes, len(instances), self.last_fetch_time, self.last_apply_time
+            ))
+            
+            return changes
+        
+        def failed(failure):
+            if failure.check(defer.FirstError):
+                failure = failure.value.subFailure
+            self.log.error("Inventory sync failed: %s" % (failure.getErrorMessage(),))
+            return 0
+        
+        d.addCallback(apply)
+        d.addErrback(failed)
+        
+        return d
+    
+    def start(self):
+        """
+        Sync every interval seconds, starting one interval from now (the
+        inventory's initial sweep covers the first one).
+        """
+        self._loop = task.LoopingCall(self.sync)
+        return self._loop.start(self.interval, now=False)
+    
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
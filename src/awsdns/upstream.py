@@ -0,0 +1,311 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Upstream - spreads queries for names that aren't ours across several DNS
+servers, preferring the fastest healthy one.
+"""
+
+from twisted.internet import defer, reactor, task
+from twisted.names import client, dns, error
+from twisted.python import failure
+
+import tx_logging
+
+# errors that are real answers from the server - no point asking another one
+ANSWER_ERRORS = (error.DNSNameError, error.DNSFormatError, error.DNSNotImplementedError)
+
+class Upstream(object):
+    """
+    A single upstream DNS server, and how it's been doing.
+    
+    Round trip times are smoothed the same way TCP does it (RFC 6298):
+    srtt is an exponentially weighted moving average, and rttvar the
+    average deviation from it. failure_rate is a moving average of failed
+    queries (0 to 1), and failures the number of failures in a row.
+    """
+    
+    address = None
+    resolver = None
+    srtt = None
+    rttvar = None
+    failure_rate = 0.0
+    failures = 0
+    healthy = True
+    queries = 0
+    
+    # weights for new samples
+    alpha = 0.125
+    beta = 0.25
+    
+    def __init__(self, address):
+        self.address = address
+        self.resolver = client.Resolver(servers=[address])
+    
+    def __repr__(self):
+        return "Upstream:%s:%s" % self.address
+    
+    def succeeded(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        
+        self.failure_rate *= (1 - self.alpha)
+        self.failures = 0
+        self.healthy = True
+    
+    def failed(self):
+        self.failure_rate = (1 - self.alpha) * self.failure_rate + self.alpha
+        self.failures += 1
+    
+    def expected(self, timeout):
+        """
+        Expected time to get an answer - the round trip time, plus the
+        timeout for the fraction of queries that fail. Servers that haven't
+        answered anything yet come first, so they get measured.
+        """
+        return (self.srtt or 0.0) + self.failure_rate * timeout
+    
+    def hedge_delay(self, minimum, maximum):
+        """
+        How long to wait for an answer before asking another server too.
+        """
+        if self.srtt is None:
+            return maximum
+        
+        return max(minimum, min(maximum, self.srtt + 4 * self.rttvar))
+
+class HedgedQuery(object):
+    """
+    A single query, sent to the upstreams in order until one answers.
+    
+    The next upstream is asked as soon as one fails, or if it takes longer
+    than its hedge delay to answer - whichever answers first wins.
+    """
+    
+    def __init__(self, pool, query, upstreams):
+        self.pool = pool
+        self.query = query
+        self.upstreams = list(upstreams)
+        self.deferred = defer.Deferred()
+        self.pending = 0
+        self.finished = False
+        self.timer = None
+    
+    def start(self):
+        self.send()
+        return self.deferred
+    
+    def send(self):
+        """
+        Ask the next upstream. Returns False if there are none left.
+        """
+        if not self.upstreams:
+            return False
+        
+        upstream = self.upstreams.pop(0)
+        self.pending += 1
+        
+        d = self.pool.send(upstream, self.query)
+        d.addCallbacks(self.answered, self.failed)
+        
+        if self.upstreams:
+            delay = upstream.hedge_delay(self.pool.hedge_min, self.pool.hedge_max)
+            self.timer = self.pool.clock.callLater(delay, self.hedge)
+        
+        return True
+    
+    def hedge(self):
+        self.timer = None
+        
+        if not self.finished:
+            self.pool.hedges += 1
+            self.send()
+    
+    def answered(self, result):
+        self.pending -= 1
+        self.finish(result)
+    
+    def failed(self, reason):
+        self.pending -= 1
+        
+        if reason.check(*ANSWER_ERRORS):
+            return self.finish(reason)
+        
+        if self.finished:
+            return
+        
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+            self.timer = None
+        
+        if not self.send() and not self.pending:
+            self.finish(reason)
+    
+    def finish(self, result):
+        if self.finished:
+            return
+        
+        self.finished = True
+        
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        
+        if isinstance(result, failure.Failure):
+            self.deferred.errback(result)
+        else:
+            self.deferred.callback(result)
+
+class UpstreamPool(object):
+    """
+    Sends queries to the fastest healthy upstream server (see
+    Upstream.expected()), hedging to the next fastest if it's slow to answer.
+    
+    An upstream is ejected (marked unhealthy) after max_failures failures in
+    a row, or when it fails a health probe. Every probe_interval seconds,
+    every upstream is sent a probe query (probe_name, type NS); unhealthy
+    upstreams that answer are let back in. Unhealthy upstreams are only
+    used when there's nothing else left to try.
+    
+    With a single upstream, queries that aren't answered within the hedge
+    delay are sent to it again.
+    
+    servers - list of (host, port) tuples.
+    timeout - seconds to wait for an answer from one upstream.
+    hedge_min, hedge_max - bounds on the hedge delay, in seconds. Defaults
+                           to 0.02 and half the timeout.
+    """
+    
+    _loop = None
+    upstreams = None
+    timeout = None
+    hedge_min = None
+    hedge_max = None
+    max_failures = None
+    probe_interval = None
+    probe_name = None
+    clock = None
+    log = None
+    queries = 0
+    hedges = 0
+    
+    def __init__(self, servers, timeout=2.0, hedge_min=0.02, hedge_max=None, max_failures=3,
+                 probe_interval=10, probe_name='.', clock=None):
+        self.upstreams = [Upstream(address) for address in servers]
+        self.timeout = timeout
+        self.hedge_min = hedge_min
+        self.hedge_max = hedge_max or timeout / 2.0
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.probe_name = probe_name
+        self.clock = clock or reactor
+        self.log = tx_logging.getLogger("awsdns:upstream")
+    
+    def ranked(self):
+        """
+        Return the upstreams in the order they should be tried.
+        """
+        return sorted(
+            self.upstreams,
+            key=lambda upstream: (not upstream.healthy, upstream.expected(self.timeout))
+        )
+    
+    def send(self, upstream, query):
+        """
+        Send a query to a single upstream, keeping track of how it does.
+        Returns a deferred answer (a tuple of answer, authority and
+        additional lists).
+        """
+        upstream.queries += 1
+        started = self.clock.seconds()
+        
+        d = upstream.resolver.queryUDP([query], timeout=(self.timeout,))
+        d.addCallback(upstream.resolver.filterAnswers)
+        
+        def succeeded(result):
+            upstream.succeeded(self.clock.seconds() - started)
+            return result
+        
+        def failed(failure):
+            if failure.check(*ANSWER_ERRORS):
+                upstream.succeeded(self.clock.seconds() - started)
+                return failure
+            
+            upstream.failed()
+            
+            if upstream.healthy and upstream.failures >= self.max_failures:
+                self.eject(upstream, "%s failures in a row" % (upstream.failures,))
+            
+            return failure
+        
+        d.addCallbacks(succeeded, failed)
+        
+        return d
+    
+    def eject(self, upstream, reason):
+        upstream.healthy = False
+        self.log.warning("Ejecting upstream %s:%s (%s)" % (upstream.address + (reason,)))
+    
+    def lookup(self, name, cls, type):
+        """
+        Look up a name. Returns a deferred answer, like
+        twisted.names.client.Resolver._lookup.
+        """
+        self.queries += 1
+        upstreams = self.ranked()
+        
+        if len(upstreams) == 1:
+            # nowhere else to go - ask again
+            upstreams = upstreams * 2
+        
+        return HedgedQuery(self, dns.Query(name, type, cls), upstreams).start()
+    
+    def probe(self):
+        """
+        Send a health probe to every upstream.
+        """
+        query = dns.Query(self.probe_name, dns.NS, dns.IN)
+        
+        for upstream in self.upstreams:
+            d = self.send(upstream, query)
+            
+            def succeeded(result, upstream=upstream):
+                if not upstream.healthy:
+                    self.log.info("Upstream %s:%s is back" % upstream.address)
+                upstream.healthy = True
+            
+            def failed(failure, upstream=upstream):
+                if failure.check(*ANSWER_ERRORS):
+                    return succeeded(None)
+                
+                if upstream.healthy:
+                    self.eject(upstream, "failed health probe: %s" % (failure.getErrorMessage(),))
+            
+            d.addCallbacks(succeeded, failed)
+    
+    def start(self):
+        self._loop = task.LoopingCall(self.probe)
+        return self._loop.start(self.probe_interval, now=False)
+    
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+    
+    def stats(self):
+        """
+        Return a list of dictionaries - one per upstream - with its address,
+        health, and timings.
+        """
+        return [
+            {
+                'address': "%s:%s" % upstream.address,
+                'healthy': upstream.healthy,
+                'srtt': upstream.srtt,
+                'rttvar': upstream.rttvar,
+                'failure_rate': upstream.failure_rate,
+                'queries': upstream.queries,
+            }
+            for upstream in self.upstreams
+        ]
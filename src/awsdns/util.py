@@ -3,6 +3,7 @@ AWSDNS - DNS for EC2 instances in Amazon Web Services
 
 Utility functions
 """
+import fnmatch
 import logging 
 
 def logging_constant(const):
@@ -29,3 +30,118 @@ def logging_constant(const):
         return value
     except AttributeError:
         raise ValueError, "'%s' is not a valid log level" % (const)
+
+def tag_or_property(instance, check, default=None):
+    """
+    Given an EC2 instance object, and a property or to check, return the value
+    
+    If check is a tag:XXXXXX filter, returns the tag value.
+    
+    Otherwise, assumes check is a property.
+    
+    Returns default if property or tag doesn't exist.
+    """
+    if check.startswith("tag:"):
+        prefix, tag = check.split(":", 1)
+        return instance.tags.get(tag, default)
+    else:
+        return getattr(instance, check, default)
+
+def encode(value):
+    """
+    Return a tag or property value as a byte string, like the names in DNS
+    queries - unicode values (e.g. tags with non-ASCII characters, from the
+    API) are encoded as UTF-8.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    
+    return str(value)
+
+def instances(reservations):
+    """
+    Flatten a reservation list (the output from 
+    ec2_connection.get_all_instances) into a list of instances.
+    """
+    output = []
+    
+    for reservation in reservations:
+        output.extend(reservation.instances)
+    
+    return output
+
+# properties with filters that aren't just named with dashes
+FILTERS = {
+    'id': 'instance-id',
+    'state': 'instance-state-name',
+    'placement': 'availability-zone',
+}
+
+def ec2_filter(check):
+    """
+    Given a tag or property (see tag_or_property), return the name of the
+    matching DescribeInstances filter.
+    
+    Tags are used as-is. Properties use dashes instead of underscores (e.g.
+    private_ip_address -> private-ip-address).
+    """
+    if check.startswith("tag:"):
+        return check
+    
+    try:
+        return FILTERS[check]
+    except KeyError:
+        return check.replace("_", "-")
+
+def filter_value(instance, name):
+    """
+    Return the value of the given DescribeInstances filter for instance.
+    """
+    if name.startswith("tag:"):
+        return tag_or_property(instance, name)
+    elif name == 'instance-id':
+        return instance.id
+    elif name == 'instance-state-name':
+        return instance.state
+    elif name == 'availability-zone':
+        return instance.placement
+    
+    return getattr(instance, name.replace('-', '_'), None)
+
+def matches(instance, filters):
+    """
+    Returns True if instance matches every filter. Each filter matches if
+    any of its values (which may contain * and ? wildcards) match.
+    """
+    for name, values in filters.items():
+        value = filter_value(instance, name)
+        
+        if value is None:
+            return False
+        
+        if not [v for v in values if fnmatch.fnmatchcase(str(value), v)]:
+            return False
+    
+    return True
+
+def parse_servers(value, port=53):
+    """
+    Parse a whitespace separated list of DNS servers - each one an address,
+    optionally followed by :port - into a list of (address, port) tuples.
+    """
+    output = []
+    
+    for server in value.split():
+        if ":" in server:
+            server, server_port = server.rsplit(":", 1)
+            try:
+                output.append((server, int(server_port)))
+            except ValueError:
+                raise ValueError, "'%s' is not a valid port" % (server_port)
+        else:
+            output.append((server, port))
+    
+    if not output:
+        raise ValueError, "No DNS servers given"
+    
+    return output
@@ -0,0 +1,163 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Hierarchical timing wheel - tracks expiry times for lots of keys, without
+scheduling a reactor call for each one.
+"""
+
+import math
+import time
+
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel (see Varghese & Lauck, "Hashed and
+    Hierarchical Timing Wheels").
+    
+    Time is divided into ticks of resolution seconds. There are several
+    levels of slots: level 0 has one slot per tick, level 1 one slot per
+    2**bits ticks, and so on. A key is put in the lowest level that can hold
+    its expiry time; as time passes, slots in the higher levels are emptied
+    ("cascaded") into the lower ones, until the key reaches level 0 and
+    expires.
+    
+    Adding, removing and expiring a key are all O(1) - the cost of advancing
+    the wheel depends on the number of ticks that have passed and the number
+    of keys that expire, not on the number of keys being tracked.
+    
+    With the defaults (1 second resolution, 4 levels of 256 slots), expiry
+    times up to 2**32 seconds away are supported; anything beyond that is
+    re-scheduled when it reaches the end of the wheel.
+    
+    resolution - length of a tick, in seconds.
+    bits - log2 of the number of slots per level.
+    levels - number of levels.
+    clock - a function returning the current time, in seconds.
+    """
+    
+    resolution = None
+    bits = None
+    levels = None
+    clock = None
+    _mask = None
+    _slots = None
+    _where = None
+    _tick = None
+    
+    def __init__(self, resolution=1.0, bits=8, levels=4, clock=time.time):
+        self.resolution = resolution
+        self.bits = bits
+        self.levels = levels
+        self.clock = clock
+        
+        self._mask = (1 << bits) - 1
+        self._slots = [[set() for i in xrange(1 << bits)] for level in xrange(levels)]
+        self._where = {}
+        self._tick = self._ticks(self.clock())
+    
+    def __len__(self):
+        return len(self._where)
+    
+    def __contains__(self, key):
+        return key in self._where
+    
+    def _ticks(self, seconds):
+        return int(seconds / self.resolution)
+    
+    def _place(self, key, expires):
+        """
+        Put key in the slot for the given expiry tick.
+        """
+        delta = max(expires - self._tick, 0)
+        span = 1 << (self.bits * self.levels)
+        
+        if delta >= span:
+            # past the end of the wheel - park it in the furthest slot, it
+            # will be re-placed when it gets there.
+            delta = span - 1
+        
+        target = self._tick + delta
+        
+        level = 0
+        while delta >= (1 << (self.bits * (level + 1))):
+            level += 1
+        
+        slot = self._slots[level][(target >> (self.bits * level)) & self._mask]
+        slot.add(key)
+        self._where[key] = (expires, slot)
+    
+    def add(self, key, delay):
+        """
+        Expire key delay seconds from now. Replaces any existing expiry time
+        for key.
+        """
+        self.remove(key)
+        
+        if not self._where:
+            # nothing to cascade - skip straight to now
+            self._tick = max(self._tick, self._ticks(self.clock()))
+        
+        expires = int(math.ceil((self.clock() + delay) / self.resolution))
+        # the current tick has already been processed
+        expires = max(expires, self._tick + 1)
+        
+        self._place(key, expires)
+    
+    def remove(self, key):
+        """
+        Stop tracking key. Does nothing if key isn't being tracked.
+        """
+        try:
+            expires, slot = self._where.pop(key)
+        except KeyError:
+            return
+        
+        slot.discard(key)
+    
+    def _cascade(self, level):
+        """
+        Move the keys in the current slot of the given level down to the
+        lower levels.
+        """
+        index = (self._tick >> (self.bits * level)) & self._mask
+        slot = self._slots[level][index]
+        self._slots[level][index] = set()
+        
+        for key in slot:
+            self._place(key, self._where[key][0])
+    
+    def advance(self, now=None):
+        """
+        Move the wheel forward to now, and return a list of the keys that
+        expired along the way.
+        """
+        if now is None:
+            now = self.clock()
+        
+        target = self._ticks(now)
+        expired = []
+        
+        while self._tick < target:
+            self._tick += 1
+            
+            level = 1
+            while level < self.levels and not self._tick & ((1 << (self.bits * level)) - 1):
+                self._cascade(level)
+                level += 1
+            
+            index = self._tick & self._mask
+            slot = self._slots[0][index]
+            
+            if not slot:
+                continue
+            
+            self._slots[0][index] = set()
+            
+            for key in slot:
+                expires = self._where[key][0]
+                if expires > self._tick:
+                    self._place(key, expires)
+                else:
+                    del self._where[key]
+                    expired.append(key)
+        
+        return expired
@@ -0,0 +1,252 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Wire cache - keeps encoded responses, so a repeated query can be answered
+without decoding it, resolving it, or building and encoding a new message.
+"""
+
+from twisted.internet import reactor
+from twisted.names import dns
+
+import collections
+import struct
+
+def question_key(data):
+    """
+    Given a raw query, return its question section - name (lower-cased),
+    type and class - to use as a cache key.
+    
+    Returns None if the query isn't a simple one: a standard query, with a
+    single question, and nothing else (EDNS queries carry an OPT record in
+    the additional section, so they're left to the normal path).
+    """
+    if len(data) < 17:
+        return None
+    
+    flags = ord(data[2])
+    if flags & 0x80 or (flags >> 3) & 0x0f != dns.OP_QUERY:
+        return None
+    
+    if data[4:12] != "\x00\x01\x00\x00\x00\x00\x00\x00":
+        return None
+    
+    position = 12
+    while True:
+        if position >= len(data):
+            return None
+        
+        length = ord(data[position])
+        if length == 0:
+            break
+        if length & 0xc0:
+            # no compression pointers in a question this simple
+            return None
+        
+        position += 1 + length
+    
+    name_end = position + 1
+    if name_end + 4 != len(data):
+        return None
+    
+    return data[12:name_end].lower() + data[name_end:]
+
+def wire_key(name, type, cls=dns.IN):
+    """
+    Build the question_key() for a name, type and class - e.g. to drop a 
+    name from a WireCache.
+    """
+    encoded = "".join([chr(len(label)) + label for label in str(name).lower().split('.') if label])
+    return encoded + "\x00" + struct.pack("!HH", type, cls)
+
+def skip_name(data, position):
+    """
+    Return the position just past the (possibly compressed) name that
+    starts at position in data.
+    """
+    while True:
+        length = ord(data[position])
+        if length & 0xc0 == 0xc0:
+            # a pointer ends the name
+            return position + 2
+        if length == 0:
+            return position + 1
+        
+        position += 1 + length
+
+def ttl_offsets(data):
+    """
+    Return the offsets of the TTL of every record in an encoded message, or
+    None if it can't be parsed.
+    """
+    try:
+        questions, answers, authority, additional = struct.unpack("!4H", data[4:12])
+        position = 12
+        
+        for i in range(questions):
+            position = skip_name(data, position) + 4
+        
+        offsets = []
+        for i in range(answers + authority + additional):
+            # type and class come before the TTL, the RDATA length after it
+            position = skip_name(data, position) + 4
+            offsets.append(position)
+            length = struct.unpack("!H", data[position + 4:position + 6])[0]
+            position += 6 + length
+    except (IndexError, struct.error):
+        return None
+    
+    if position != len(data):
+        return None
+    
+    return offsets
+
+def age(data, offsets, elapsed):
+    """
+    Return data, with the TTLs at offsets counted down by elapsed seconds.
+    """
+    parts = []
+    last = 0
+    
+    for offset in offsets:
+        ttl = struct.unpack("!I", data[offset:offset + 4])[0]
+        parts.append(data[last:offset])
+        parts.append(struct.pack("!I", max(ttl - elapsed, 0)))
+        last = offset + 4
+    
+    parts.append(data[last:])
+    
+    return "".join(parts)
+
+class WireCache(object):
+    """
+    Encoded responses, keyed by question (see question_key()), minus their
+    2 byte message id.
+    
+    Entries are kept for the lowest TTL of the records in the response (or
+    negative_ttl, for responses with no records). When there are more than
+    size entries, the least recently used are dropped.
+    
+    The offset of every TTL in a response is kept with it, so the TTLs can
+    be counted down by the time it's been cached for on the way out (see
+    age()) - a response served near the end of its life doesn't claim to be
+    good for its whole TTL again.
+    """
+    
+    size = None
+    negative_ttl = None
+    clock = None
+    hits = 0
+    misses = 0
+    
+    def __init__(self, size=10000, negative_ttl=60, clock=None):
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.clock = clock or reactor
+        self._entries = collections.OrderedDict()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, key):
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        
+        stored, expires, data, offsets = entry
+        now = self.clock.seconds()
+        
+        if expires <= now:
+            self.misses += 1
+            return None
+        
+        # most recently used goes at the end
+        self._entries[key] = entry
+        self.hits += 1
+        
+        elapsed = int(now - stored)
+        if elapsed and offsets:
+            return age(data, offsets, elapsed)
+        
+        return data
+    
+    def put(self, key, message, data):
+        """
+        Cache the encoded response data for the given message.
+        """
+        records = message.answers + message.authority + message.additional
+        
+        if records:
+            ttl = min([record.ttl for record in records])
+        else:
+            ttl = self.negative_ttl
+        
+        if ttl <= 0:
+            return
+        
+        offsets = ttl_offsets(data)
+        if offsets is None:
+            return
+        
+        # the message id isn't kept, so neither are the 2 bytes it takes
+        now = self.clock.seconds()
+        self._entries.pop(key, None)
+        self._entries[key] = (now, now + ttl, data[2:], [offset - 2 for offset in offsets])
+        
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+    
+    def remove(self, key):
+        self._entries.pop(key, None)
+    
+    def clear(self):
+        self._entries.clear()
+
+class CachingDNSDatagramProtocol(dns.DNSDatagramProtocol):
+    """
+    A DNS server protocol that answers repeated queries from a WireCache.
+    
+    On a hit, the cached response is sent with the query's message id, RD
+    and CD flags, and question, and its TTLs counted down - nothing else is
+    decoded or encoded. On a miss, the
+    query is handled as normal, and the response is cached on the way out.
+    """
+    
+    wire_cache = None
+    
+    def __init__(self, controller, wire_cache, reactor=None):
+        dns.DNSDatagramProtocol.__init__(self, controller, reactor=reactor)
+        self.wire_cache = wire_cache
+        self._waiting = {}
+    
+    def datagramReceived(self, data, addr):
+        key = question_key(data)
+        
+        if key is None:
+            return dns.DNSDatagramProtocol.datagramReceived(self, data, addr)
+        
+        cached = self.wire_cache.get(key)
+        
+        if cached is None:
+            # remember the key, so the response can be cached
+            self._waiting[(data[:2], addr)] = key
+            return dns.DNSDatagramProtocol.datagramReceived(self, data, addr)
+        
+        flags = struct.unpack("!H", data[2:4])[0] & 0x0110
+        cached_flags = struct.unpack("!H", cached[:2])[0] & ~0x0110
+        
+        # the question is copied from the query too, so its case matches
+        self.transport.write(
+            data[:2] + struct.pack("!H", cached_flags | flags) + cached[2:10] + data[12:] + cached[len(data) - 2:],
+            addr
+        )
+    
+    def writeMessage(self, message, address):
+        data = message.toStr()
+        self.transport.write(data, address)
+        
+        key = self._waiting.pop((data[:2], address), None)
+        
+        if key is not None and message.answer and not message.trunc and message.rCode in (dns.OK, dns.ENAME):
+            self.wire_cache.put(key, message, data)
@@ -0,0 +1,129 @@
+"""
+AWSDNS - DNS for EC2 instances in Amazon Web Services
+
+Workers - runs the server as several processes sharing port 53, so it can
+use more than one core.
+
+The main process (the poller) is the only one that talks to EC2: it keeps
+the inventory up to date and saves it to the snapshot file (see
+awsdns.snapshot). Each worker answers queries from its own copy of the
+inventory, reloaded whenever the snapshot changes. Workers bind port 53
+with SO_REUSEPORT, so the kernel spreads queries across them.
+"""
+
+from twisted.internet import reactor, protocol
+
+import os
+import signal
+import socket
+import sys
+
+import tx_logging
+
+# Python 2 doesn't define SO_REUSEPORT - this is the Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+def reuseport_socket(type, port, interface=''):
+    """
+    Return a non-blocking socket, bound to port with SO_REUSEPORT set.
+    """
+    sock = socket.socket(socket.AF_INET, type)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind((interface, port))
+    
+    return sock
+
+def listen_reuseport(port, datagram_protocol, factory, interface=''):
+    """
+    Listen for UDP (with datagram_protocol) and TCP (with factory) on port,
+    sharing it with any other process that does the same.
+    
+    Returns the UDP and TCP ports.
+    """
+    udp = reuseport_socket(socket.SOCK_DGRAM, port, interface)
+    tcp = reuseport_socket(socket.SOCK_STREAM, port, interface)
+    tcp.listen(50)
+    
+    try:
+        # the reactor takes a copy of each file descriptor
+        return (
+            reactor.adoptDatagramPort(udp.fileno(), socket.AF_INET, datagram_protocol),
+            reactor.adoptStreamPort(tcp.fileno(), socket.AF_INET, factory),
+        )
+    finally:
+        udp.close()
+        tcp.close()
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """
+    Tells the supervisor when a worker exits.
+    """
+    
+    def __init__(self, supervisor, number):
+        self.supervisor = supervisor
+        self.number = number
+    
+    def processEnded(self, reason):
+        self.supervisor.ended(self, reason)
+
+class Supervisor(object):
+    """
+    Starts count worker processes, and restarts any that exit until stop()
+    is called.
+    
+    Workers run this same program, as "python -c 'from awsdns import main;
+    main()' --worker N" (N being the worker's number, from 0), and share 
+    this process's stdout and stderr.
+    """
+    
+    count = None
+    restart_delay = 1
+    stopping = False
+    log = None
+    
+    def __init__(self, count):
+        self.count = count
+        self.log = tx_logging.getLogger("awsdns:workers")
+        self._processes = {}
+    
+    def spawn(self, number):
+        args = [sys.executable, "-c", "from awsdns import main; main()", "--worker", str(number)]
+        
+        process = reactor.spawnProcess(
+            WorkerProtocol(self, number),
+            sys.executable,
+            args,
+            env=os.environ,
+            childFDs={1: 1, 2: 2}
+        )
+        self._processes[number] = process
+        
+        self.log.info("Started worker %s (pid %s)" % (number, process.pid))
+    
+    def start(self):
+        for number in range(self.count):
+            self.spawn(number)
+    
+    def ended(self, worker, reason):
+        self._processes.pop(worker.number, None)
+        
+        if self.stopping:
+            return
+        
+        self.log.warning("Worker %s exited (%s) - restarting" % (worker.number, reason.getErrorMessage()))
+        # don't spin if it can't start at all
+        reactor.callLater(self.restart_delay, self.spawn, worker.number)
+    
+    def stop(self):
+        """
+        Stop restarting workers, and ask the running ones to exit.
+        """
+        self.stopping = True
+        
+        for process in self._processes.values():
+            try:
+                process.signalProcess(signal.SIGTERM)
+            except Exception, e:
+                self.log.debug("Couldn't signal pid %s: %s" % (process.pid, e))